@@ -38,6 +38,8 @@ from quickff.program import *
 from quickff.cost import *
 from quickff.io import *
 from quickff.tools import *
+from quickff.symmetry import *
+from quickff.topology import *
 from quickff.log import *
 from quickff.settings import *
 from quickff.scripts import *
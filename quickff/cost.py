@@ -40,7 +40,7 @@ class HessianFCCost(object):
         A class to implement the least-square cost function to fit the force
         field hessian to the ab initio hessian.
     '''
-    def __init__(self, system, ai, valence, fit_indices, ffrefs=[], do_mass_weighting=True):
+    def __init__(self, system, ai, valence, fit_indices, ffrefs=[], do_mass_weighting=True, screen_indices=[], screen_tol=None):
         '''
             **Arguments**
 
@@ -66,13 +66,27 @@ class HessianFCCost(object):
 
             do_mass_weighting
 
+            screen_indices
+                a list of indices (subset of fit_indices) of terms that are
+                screened before constructing the cost function. To this end,
+                all other fitted terms (e.g. the diagonal terms) are fitted
+                first without the screened terms. A screened term is removed
+                from the fit if its contribution (see get_contributions) to
+                the remaining residual hessian is smaller than screen_tol,
+                assuming its force constant is the optimal force constant of
+                a fit of this term alone to that residual. The overlaps
+                required for screening are reused in the cost matrix, only
+                the overlaps between screened terms are computed afterwards
+                and only for the terms that are kept.
+
+            screen_tol
+                the threshold for screening the terms in screen_indices, no
+                screening is done if it is None
         '''
         #initialization
-        self.init = np.zeros(len(fit_indices), float)
-        self.upper = np.zeros(len(fit_indices), float)+np.inf
-        self.lower = np.zeros(len(fit_indices), float)
-        self.A = np.zeros([len(fit_indices), len(fit_indices)], float)
-        self.B = np.zeros([len(fit_indices)], float)
+        fit_indices = list(fit_indices)
+        upper = np.zeros(len(fit_indices), float)+np.inf
+        lower = np.zeros(len(fit_indices), float)
         ndofs = 3*system.natom
         masses3 = np.array([[mass,]*3 for mass in system.masses]).reshape(len(system.masses)*3)
         masses3_inv_sqrt = np.diag(1.0/np.sqrt(masses3))
@@ -101,23 +115,90 @@ class HessianFCCost(object):
                 hcovs[i] = hcov
                 #set upper and lower
                 if master.kind==4:
-                    self.upper[i] = 200*kjmol
+                    upper[i] = 200*kjmol
                 if master.kind==3:
-                    self.lower[i] = -np.inf
+                    lower[i] = -np.inf
             else:
                 if do_mass_weighting:
                     hcov = np.dot(masses3_inv_sqrt, np.dot(valence.get_hessian_contrib(master.index), masses3_inv_sqrt))
                 else:
                     hcov = valence.get_hessian_contrib(master.index)
                 href -= hcov
-        #construct the cost matrices A and B
-        for index1, hcov1 in enumerate(hcovs):
-            self.B[index1] = np.sum(href*hcov1)
-            self.A[index1,index1] = np.sum(hcov1*hcov1)
-            for index2, hcov2 in enumerate(hcovs[:index1]):
-                tmp = np.sum(hcov1*hcov2)
-                self.A[index1,index2] = tmp
-                self.A[index2,index1] = tmp
+        #the elements of the cost matrix A are only computed when needed,
+        #such that the overlaps of screened out terms are never computed
+        self.href_norm = np.sqrt(np.sum(href*href))
+        A = np.zeros([len(fit_indices), len(fit_indices)], float)+np.nan
+        def get_A(rows0, rows1):
+            for i in rows0:
+                for j in rows1:
+                    if np.isnan(A[i,j]):
+                        A[i,j] = A[j,i] = np.sum(hcovs[i]*hcovs[j])
+            return A[np.ix_(rows0, rows1)]
+        B = np.array([np.sum(href*hcov) for hcov in hcovs])
+        keep = np.ones(len(fit_indices), bool)
+        self.screened = []
+        if screen_tol is not None and len(screen_indices)>0:
+            screen = [i for i, index in enumerate(fit_indices) if index in screen_indices]
+            others = [i for i, index in enumerate(fit_indices) if index not in screen_indices]
+            #residual of the reference hessian after fitting the other terms
+            Bres = B[screen].copy()
+            if len(others)>0:
+                fcs = boxqp(get_A(others, others), B[others], lower[others], upper[others], np.zeros(len(others)))
+                Bres -= np.dot(get_A(screen, others), fcs)
+            diag = np.array([get_A([i], [i])[0,0] for i in screen])
+            contribs = self._contributions(abs(Bres)/np.where(diag>0, diag, 1.0), diag)
+            for i, contrib in zip(screen, contribs):
+                if contrib<screen_tol:
+                    keep[i] = False
+                    self.screened.append(fit_indices[i])
+            log.dump('Screened out %i of %i terms with relative contribution below %.1e' %(len(self.screened), len(screen), screen_tol))
+        rows = np.where(keep)[0]
+        self.fit_indices = [fit_indices[i] for i in rows]
+        self.init = np.zeros(len(rows), float)
+        self.upper = upper[rows]
+        self.lower = lower[rows]
+        self.B = B[rows]
+        #construct the cost matrix A
+        self.A = get_A(rows, rows).copy()
+
+    def _contributions(self, fcs, diag):
+        'Norm of the hessian contributions relative to the reference hessian'
+        if self.href_norm==0.0: return np.zeros(len(fcs))
+        return abs(fcs)*np.sqrt(diag)/self.href_norm
+
+    def get_contributions(self, fcs):
+        '''
+            Compute the Frobenius norm of the hessian contribution of every
+            fitted term with the given force constants, relative to the
+            norm of the reference hessian (i.e. the ab initio hessian minus
+            all contributions that are not fitted).
+
+            **Arguments**
+
+            fcs
+                a numpy array with the force constants of the terms in
+                self.fit_indices
+        '''
+        return self._contributions(np.asarray(fcs), np.diag(self.A))
+
+    def remove(self, indices):
+        '''
+            Remove the given terms from the cost function. This is equivalent
+            to, but much cheaper than, constructing a new cost function in
+            which the force constants of these terms are fixed to zero.
+
+            **Arguments**
+
+            indices
+                a list of term indices that are present in self.fit_indices
+        '''
+        rows = np.array([i for i, index in enumerate(self.fit_indices) if index not in indices], int)
+        self.fit_indices = [self.fit_indices[i] for i in rows]
+        self.A = self.A[np.ix_(rows, rows)]
+        self.B = self.B[rows]
+        self.init = self.init[rows]
+        self.upper = self.upper[rows]
+        self.lower = self.lower[rows]
 
 
     def estimate(self, init=None, lower=None, upper=None, do_svd=False, svd_rcond=0.0):
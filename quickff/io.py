@@ -29,22 +29,26 @@ from __future__ import print_function, absolute_import, unicode_literals
 '''Readers ab initio vibrational calculations.
 '''
 
-import numpy as np
+import numpy as np, pickle, os
 import xml.etree.ElementTree as ET
+import h5py as h5
 
 from molmod.periodic import periodic
-from molmod.units import angstrom, electronvolt, amu, kcalmol, kjmol, deg
+from molmod.units import angstrom, electronvolt, amu, kcalmol, kjmol, deg, \
+    parse_unit
 from molmod.io.fchk import FCHKFile
 
 from yaff.pes.ext import PairPotEI
 from yaff.pes.ff import ForcePartPair
 from yaff.pes.parameters import *
 
+from quickff.perturbation import Trajectory
 from quickff.log import log
 
 
 __all__ = ['VASPRun', 'read_abinitio', 'make_yaff_ei', 'dump_charmm22_prm',
-           'dump_charmm22_psf', 'dump_yaff']
+           'dump_charmm22_psf', 'dump_yaff', 'TrajectoryStore',
+           'dump_trajectories_extxyz', 'read_trajectory']
 
 
 class VASPRun(object):
@@ -982,3 +986,256 @@ def dump_yaff(valence, fn):
         print('', file=f)
         print('', file=f)
     f.close()
+
+
+class TrajectoryStore(object):
+    '''
+        HDF5 file to store perturbation trajectories. Every trajectory is
+        stored in a separate group of /trajectories named after the atom
+        indices of its term (e.g. 0-1-2 for a bend). Trajectories are written
+        one at a time as soon as they are available and can be loaded
+        separately, in which case the coordinates are only read from the file
+        when they are accessed.
+    '''
+    def __init__(self, fn):
+        '''
+            **Arguments**
+
+            fn
+                the name of the HDF5 file, it is created if it does not exist
+        '''
+        self.fn = fn
+
+    @staticmethod
+    def get_key(term):
+        'Return the name of the group in which the trajectory of term is stored'
+        return '-'.join([str(i) for i in term.get_atoms()])
+
+    def keys(self):
+        '''
+            Return the keys of all completely written trajectories in the file.
+        '''
+        keys = []
+        if not os.path.isfile(self.fn):
+            return keys
+        with h5.File(self.fn, 'r') as f:
+            if 'trajectories' in f:
+                for key, grp in f['trajectories'].items():
+                    if grp.attrs.get('complete', False):
+                        keys.append(key)
+        return keys
+
+    def append(self, trajectory):
+        '''
+            Write the given trajectory to the file. An existing trajectory with
+            the same key is overwritten.
+        '''
+        self.extend([trajectory])
+
+    def extend(self, trajectories):
+        '''
+            Write all given trajectories to the file, which is only opened
+            once. Existing trajectories with the same key are overwritten.
+        '''
+        with h5.File(self.fn, 'a') as f:
+            for trajectory in trajectories:
+                self._write(f, trajectory)
+
+    def _write(self, f, trajectory):
+        'Write a single trajectory to the opened HDF5 file f'
+        key = self.get_key(trajectory.term)
+        if 'numbers' not in f:
+            f['numbers'] = trajectory.numbers
+        trajs = f.require_group('trajectories')
+        if key in trajs:
+            del trajs[key]
+        grp = trajs.create_group(key)
+        grp.attrs['term'] = np.void(pickle.dumps(trajectory.term))
+        grp.attrs['basename'] = trajectory.term.basename
+        grp.attrs['index'] = trajectory.term.index
+        grp.attrs['qunit'] = trajectory.qunit
+        grp.attrs['kunit'] = trajectory.kunit
+        grp.attrs['step'] = trajectory.step
+        grp.attrs['active'] = trajectory.active
+        for name in ['fc', 'rv']:
+            value = getattr(trajectory, name)
+            if value is None: value = np.nan
+            grp.attrs[name] = value
+        grp['targets'] = trajectory.targets
+        grp['values'] = trajectory.values
+        if trajectory._disps is not None:
+            #compressed trajectory, the reference positions are shared
+            #between all trajectories through a hard link
+            pos0 = trajectory._pos0
+            if 'pos0' not in f:
+                f['pos0'] = pos0
+            if np.array_equal(f['pos0'][:], pos0):
+                grp['pos0'] = f['pos0']
+            else:
+                grp['pos0'] = pos0
+            grp['atoms'] = trajectory._atoms
+            disps = trajectory._disps
+            grp.create_dataset('disps', data=disps, chunks=self._get_chunks(disps))
+        else:
+            coords = trajectory.coords
+            grp.create_dataset('coords', data=coords, chunks=self._get_chunks(coords))
+        grp.attrs['complete'] = True
+
+    def _get_chunks(self, data):
+        'Chunk datasets per frame'
+        if data.size==0: return None
+        return (1,) + data.shape[1:]
+
+    def read_coords(self, key):
+        '''
+            Read the coordinates of the trajectory with the given key.
+        '''
+        with h5.File(self.fn, 'r') as f:
+            grp = f['trajectories/%s' %key]
+            if 'coords' in grp:
+                return grp['coords'][:]
+            pos0 = grp['pos0'][:]
+            atoms = grp['atoms'][:]
+            disps = grp['disps'][:]
+        coords = np.tile(pos0, (len(disps), 1, 1))
+        coords[:, atoms, :] += disps
+        return coords
+
+    def load(self, key, numbers=None):
+        '''
+            Load the trajectory with the given key. The coordinates are not
+            read, but will be read from file when accessed.
+
+            **Optional Arguments**
+
+            numbers
+                the atomic numbers, if not given they are read from file
+        '''
+        with h5.File(self.fn, 'r') as f:
+            if numbers is None:
+                numbers = f['numbers'][:]
+            grp = f['trajectories/%s' %key]
+            state = {
+                'term': pickle.loads(grp.attrs['term'].tobytes()),
+                'numbers': numbers,
+                'qunit': grp.attrs['qunit'],
+                'kunit': grp.attrs['kunit'],
+                'step': grp.attrs['step'],
+                'active': bool(grp.attrs['active']),
+                'targets': grp['targets'][:],
+                'values': grp['values'][:],
+            }
+            for name in ['fc', 'rv']:
+                value = grp.attrs[name]
+                if np.isnan(value): value = None
+                state[name] = value
+        trajectory = Trajectory.__new__(Trajectory)
+        trajectory.__setstate__(state)
+        trajectory.set_store(self, key)
+        return trajectory
+
+    def load_all(self):
+        '''
+            Load all completely written trajectories in the file (with lazy
+            coordinates).
+        '''
+        keys = self.keys()
+        if len(keys)==0: return []
+        with h5.File(self.fn, 'r') as f:
+            numbers = f['numbers'][:]
+        return [self.load(key, numbers=numbers) for key in keys]
+
+
+def dump_trajectories_extxyz(trajectories, fn):
+    '''
+        Write all given perturbation trajectories as consecutive frames of a
+        single extended XYZ file. The comment line of each frame contains the
+        metadata of its trajectory (key, term basename and index, frame, value
+        of the perturbed internal coordinate and its unit). Each trajectory is
+        formatted in memory and written to the file at once.
+
+        **Arguments**
+
+        trajectories
+            a list of Trajectory instances
+
+        fn
+            the name of the extended XYZ file
+    '''
+    with open(fn, 'w') as f:
+        for trajectory in trajectories:
+            if trajectory is None: continue
+            if 'active' in list(trajectory.__dict__.keys()) and not trajectory.active: continue
+            symbols = [periodic[Z].symbol for Z in trajectory.numbers]
+            natom = len(symbols)
+            key = TrajectoryStore.get_key(trajectory.term)
+            qunit = trajectory.qunit
+            lines = []
+            for iframe, coord in enumerate(trajectory.coords):
+                lines.append('%i' %natom)
+                lines.append(
+                    'Properties=species:S:1:pos:R:3 key=%s term=%s index=%i '
+                    'frame=%i value=%.10e unit=%s' %(
+                        key, trajectory.term.basename, trajectory.term.index,
+                        iframe, trajectory.values[iframe]/parse_unit(qunit), qunit
+                ))
+                for symbol, (x, y, z) in zip(symbols, coord/angstrom):
+                    lines.append('%2s %15.10f %15.10f %15.10f' %(symbol, x, y, z))
+            lines.append('')
+            f.write('\n'.join(lines))
+
+
+def _parse_extxyz_comment(line):
+    'Parse the key=value pairs in the comment line of an extended XYZ frame'
+    info = {}
+    for word in line.split():
+        if '=' in word:
+            key, value = word.split('=', 1)
+            info[key] = value
+    return info
+
+
+def read_trajectory(fn, key):
+    '''
+        Read the frames of a single perturbation trajectory from a file
+        written by dump_trajectories_extxyz or by a TrajectoryStore.
+
+        **Arguments**
+
+        fn
+            the name of an extended XYZ (.xyz) or HDF5 (.h5) file
+
+        key
+            the key of the trajectory, i.e. the atom indices of its term
+            joined by dashes (see TrajectoryStore.get_key)
+
+        **Returns**
+
+        values
+            numpy array [nsteps] with the values of the perturbed internal
+            coordinate (in atomic units)
+
+        coords
+            numpy array [nsteps,natom,3] with the coordinates (in atomic
+            units)
+    '''
+    if fn.split('.')[-1] in ['h5', 'hdf5']:
+        store = TrajectoryStore(fn)
+        with h5.File(fn, 'r') as f:
+            values = f['trajectories/%s/values' %key][:]
+        return values, store.read_coords(key)
+    values = []
+    coords = []
+    with open(fn, 'r') as f:
+        while True:
+            line = f.readline()
+            if len(line.strip())==0: break
+            natom = int(line)
+            info = _parse_extxyz_comment(f.readline())
+            lines = [f.readline() for i in range(natom)]
+            if info.get('key')!=key: continue
+            values.append(float(info['value'])*parse_unit(info['unit']))
+            coords.append(np.array([line.split()[1:4] for line in lines], float)*angstrom)
+    if len(coords)==0:
+        raise ValueError('No trajectory with key %s found in %s' %(key, fn))
+    return np.array(values), np.array(coords)
@@ -33,12 +33,22 @@ from __future__ import print_function, absolute_import
 __all__ = ['ParaContext', 'paracontext']
 
 class FakeFuture(object):
+    '''
+        Serial stand-in for a scoop future. The function is only evaluated
+        when the result is first requested, such that results can be
+        processed one at a time (e.g. with wait_first).
+    '''
     def __init__(self, fun, *args, **kargs):
+        self.fun = fun
         self.args = args
         self.kargs = kargs
-        self._result = fun(*args, **kargs)
+        self._done = False
+        self._result = None
 
     def result(self):
+        if not self._done:
+            self._result = self.fun(*self.args, **self.kargs)
+            self._done = True
         return self._result
 
 
@@ -38,10 +38,13 @@ from yaff.pes.iclist import Bond, BendAngle, BendCos, DihedAngle, OopDist
 from quickff.tools import fitpar
 from quickff.log import log
 
-import numpy as np, scipy.optimize, warnings
+import numpy as np, scipy.optimize, warnings, multiprocessing, functools
 warnings.filterwarnings('ignore', 'The iteration is not making good progress')
 
-__all__ = ['Trajectory', 'RelaxedStrain']
+__all__ = [
+    'Trajectory', 'RelaxedStrain', 'HessianProjection', 'plot_trajectory_data',
+    'render_trajectory_plots'
+]
 
 class Trajectory(object):
     '''
@@ -88,7 +91,177 @@ class Trajectory(object):
         self.fc = None
         self.rv = None
 
-    def plot(self, ai, ffrefs=[], valence=None, fn='default', eunit='kjmol', suffix=''):
+    def __setstate__(self, state):
+        #trajectories pickled before the introduction of the compact
+        #coordinate storage contain the full coords array
+        if 'coords' in state:
+            state['_coords'] = state.pop('coords')
+            state['_pos0'] = None
+            state['_atoms'] = None
+            state['_disps'] = None
+        if '_store' not in state:
+            state['_store'] = None
+        self.__dict__.update(state)
+
+    def _get_coords(self):
+        '''
+            Return the coordinates of all frames as a numpy array
+            [nsteps,natom,3], rebuilt from the stored displacements if the
+            trajectory was compressed or read from file if the trajectory
+            was loaded lazily from a TrajectoryStore. In the latter two
+            cases, a new read-only array is returned, as in-place changes
+            would be lost. The coordinates can still be replaced by
+            assigning to the coords attribute.
+        '''
+        if self._coords is not None:
+            return self._coords
+        if self._disps is None:
+            store, key = self._store
+            coords = store.read_coords(key)
+        else:
+            coords = np.tile(self._pos0, (len(self._disps), 1, 1))
+            coords[:, self._atoms, :] += self._disps
+        coords.setflags(write=False)
+        return coords
+
+    def _set_coords(self, coords):
+        self._coords = coords
+        self._pos0 = None
+        self._atoms = None
+        self._disps = None
+        self._store = None
+
+    def set_store(self, store, key):
+        '''
+            Drop the coordinates from memory and read them on demand from the
+            group with the given key in the given TrajectoryStore. The coords
+            attribute then returns a read-only array.
+        '''
+        self.coords = None
+        self._store = (store, key)
+
+    coords = property(_get_coords, _set_coords)
+
+    def compress(self, pos0, tol=0.0, single_precision=False):
+        '''
+            Store the coordinates as displacements with respect to the
+            reference positions pos0, only retaining the atoms that are
+            displaced more than tol in at least one frame. The coords
+            attribute remains available and is rebuilt on access as a
+            read-only array.
+
+            **Arguments**
+
+            pos0
+                numpy array [natom,3] with the reference positions
+
+            **Optional Arguments**
+
+            tol
+                atoms with a displacement below tol in every frame are
+                assumed to be fixed at their reference position
+
+            single_precision
+                if set to True, the displacements are stored in single
+                precision
+        '''
+        if self._coords is None or len(self._coords)==0: return
+        disps = self._coords - pos0
+        atoms = np.where(np.sqrt((disps**2).sum(axis=2)).max(axis=0)>tol)[0]
+        if single_precision:
+            dtype = np.float32
+        else:
+            dtype = float
+        self._coords = None
+        self._pos0 = pos0
+        self._atoms = atoms
+        self._disps = disps[:, atoms, :].astype(dtype)
+
+    def get_ffref_energies(self, ffrefs, delta_tol=None):
+        '''
+            Compute the energy of each of the given references along the
+            trajectory. Returns a numpy array [nref,nsteps], or None if the
+            trajectory is deactivated.
+
+            **Arguments**
+
+            ffrefs
+                a list of Reference instances representing possible a priori
+                determined contributions to the force field (such as eg.
+                electrostatics and van der Waals)
+
+            **Optional Arguments**
+
+            delta_tol
+                if given, the energies are computed incrementally with
+                respect to the first frame, see Reference.delta_energy
+        '''
+        if 'active' in list(self.__dict__.keys()) and not self.active: return None
+        coords = self.coords
+        energies = np.zeros([len(ffrefs), len(coords)], float)
+        for i, ffref in enumerate(ffrefs):
+            if delta_tol is None:
+                energies[i] = ffref.energy_many(coords)
+            else:
+                energies[i] = [ffref.delta_energy(pos, coords[0], tol=delta_tol) for pos in coords]
+        return energies
+
+    def get_plot_data(self, ai, ffrefs=[], valence=None, delta_tol=None):
+        '''
+            Compute the energy contributions along the perturbation trajectory
+            that are visualized by the plot method. The result is a dictionary
+            that can be rendered with plot_trajectory_data (possibly in
+            another process). The parameters of valence are not modified.
+            Returns None if the trajectory is deactivated. The meaning of the
+            arguments is the same as in the plot method.
+        '''
+        if 'active' in list(self.__dict__.keys()) and not self.active: return None
+        coords = self.coords
+        curves = []
+        #ai
+        data = ai.energy_many(coords)
+        curves.append(('AI ref', data, {'linestyle': 'none', 'marker': 'o', 'markerfacecolor': 'k', 'markersize': 12, 'markeredgecolor': 'k'}))
+        #ffrefs
+        totff = np.zeros([len(coords)], float)
+        colors = ['b', 'g', 'm', 'y', 'c']
+        for i, ffref in enumerate(ffrefs):
+            if delta_tol is None:
+                data = ffref.energy_many(coords)
+            else:
+                data = np.array([ffref.delta_energy(pos, coords[0], tol=delta_tol) for pos in coords])
+            totff += data
+            curves.append((ffref.name, data, {'linestyle': ':', 'color': colors[i], 'linewidth': 2.0}))
+        #residual valence model if given
+        if valence is not None:
+            for term in valence.iter_terms():
+                valence.check_params(term, ['all'])
+            fc = valence.get_params(self.term.index, only='fc')
+            rv = valence.get_params(self.term.index, only='rv')
+            #switch off the current term in a private copy of the parameter
+            #table, the shared parameters remain untouched
+            vtab = valence.get_vtab()
+            valence.set_params(self.term.index, fc=0.0, rv0=0.0, vtab=vtab)
+            if delta_tol is None:
+                data = valence.calc_energies(coords, vtab=vtab)
+            else:
+                data = np.array([valence.calc_delta_energy(pos, coords[0], tol=delta_tol, vtab=vtab) for pos in coords])
+            totff += data
+            curves.append(('Residual Valence', data, {'linestyle': '--', 'color': 'r', 'linewidth':2.0}))
+        else:
+            fc = self.fc
+            rv = self.rv
+        #contribution of current term
+        data = 0.5*fc*(self.values-rv)**2
+        totff += data
+        curves.append(('PT Term', data, {'linestyle': '-', 'color': 'r', 'linewidth':2.0}))
+        curves.append(('Total FF', totff, {'linestyle': '-', 'color': [0.4,0.4,0.4], 'linewidth':3.0}))
+        return {
+            'basename': self.term.basename, 'index': self.term.index,
+            'qunit': self.qunit, 'kunit': self.kunit, 'step': self.step,
+            'values': self.values.copy(), 'curves': curves,
+        }
+
+    def plot(self, ai, ffrefs=[], valence=None, fn='default', eunit='kjmol', suffix='', delta_tol=None):
         '''
             Method to plot the energy contributions along a perturbation
             trajectory associated to a given ic. This method assumes that the
@@ -123,66 +296,16 @@ class Trajectory(object):
             suffix
                 a string to be added to the filename at the end. Is overwritten
                 when fn is specified.
+
+            delta_tol
+                if given, the energies of the ffrefs and the valence
+                contribution are computed incrementally with respect to the
+                first frame, only accounting for atoms displaced more than
+                delta_tol (see Reference.delta_energy and
+                ValenceFF.calc_delta_energy)
         '''
-        import matplotlib.pyplot as pp
-        if 'active' in list(self.__dict__.keys()) and not self.active: return
-        fig, ax = pp.subplots()
-        def add_plot(xs, ys, prefix, kwargs):
-            pars = fitpar(xs, ys, rcond=1e-6)
-            k = 2*pars[0]
-            if k==0: q0 = np.nan
-            else: q0 = -pars[1]/k
-            label = '%s (K=%.0f q0=%.3f)' %(prefix, k/parse_unit(self.kunit), q0/parse_unit(self.qunit))
-            kwargs['label'] = label
-            ax.plot(xs/parse_unit(self.qunit), ys/parse_unit(eunit), **kwargs)
-        #ai
-        data = np.array([ai.energy(pos) for pos in self.coords])
-        e_max = max(np.ceil(max(data-min(data))/parse_unit(eunit)), 1.0)
-        add_plot(self.values, data-min(data), 'AI ref', {'linestyle': 'none', 'marker': 'o', 'markerfacecolor': 'k', 'markersize': 12, 'markeredgecolor': 'k'})
-        #ffrefs
-        totff = np.zeros([len(self.coords)], float)
-        colors = ['b', 'g', 'm', 'y', 'c']
-        for i, ffref in enumerate(ffrefs):
-            data = np.array([ffref.energy(pos) for pos in self.coords])
-            totff += data
-            add_plot(self.values, data-min(data), ffref.name, {'linestyle': ':', 'color': colors[i], 'linewidth': 2.0})
-        #residual valence model if given
-        if valence is not None:
-            for term in valence.iter_terms():
-                valence.check_params(term, ['all'])
-            fc = valence.get_params(self.term.index, only='fc')
-            rv = valence.get_params(self.term.index, only='rv')
-            valence.set_params(self.term.index, fc=0.0)
-            valence.set_params(self.term.index, rv0=0.0)
-            data = np.array([valence.calc_energy(pos) for pos in self.coords]) #- 0.5*fc*(self.values-rv)**2
-            valence.set_params(self.term.index, fc=fc)
-            valence.set_params(self.term.index, rv0=rv)
-            totff += data
-            add_plot(self.values, data-min(data), 'Residual Valence', {'linestyle': '--', 'color': 'r', 'linewidth':2.0})
-        else:
-            fc = self.fc
-            rv = self.rv
-        #plot contribution of current term
-        data = 0.5*fc*(self.values-rv)**2
-        totff += data
-        add_plot(self.values, data-min(data), 'PT Term', {'linestyle': '-', 'color': 'r', 'linewidth':2.0})
-        add_plot(self.values, totff-min(totff), 'Total FF', {'linestyle': '-', 'color': [0.4,0.4,0.4], 'linewidth':3.0})
-        #decorate plot
-        ax.set_xlim([(min(self.values)-self.step)/parse_unit(self.qunit), (max(self.values)+self.step)/parse_unit(self.qunit)])
-        ax.set_title('%s-%i' %(self.term.basename, self.term.index))
-        ax.set_xlabel('%s [%s]' % (self.term.basename.split('/')[0], self.qunit), fontsize=16)
-        ax.set_ylabel('Energy [%s]' %eunit, fontsize=16)
-        ax.set_ylim([-0.2, e_max])
-        ax.grid()
-        ax.legend(loc='upper center', fontsize=16)
-        fig.set_size_inches([8, 8])
-        if fn is 'show':
-            pp.show()
-        else:
-            if fn is 'default':
-                fn = 'trajectory-%s-%i%s.png' %(self.term.basename.replace('/', '-'),self.term.index,suffix)
-            fig.savefig(fn)
-        pp.close()
+        data = self.get_plot_data(ai, ffrefs=ffrefs, valence=valence, delta_tol=delta_tol)
+        plot_trajectory_data(data, fn=fn, eunit=eunit, suffix=suffix)
 
     def to_xyz(self, fn=None):
         '''
@@ -204,6 +327,118 @@ class Trajectory(object):
         f.close()
 
 
+def plot_trajectory_data(data, fn='default', eunit='kjmol', suffix='', pdf=None):
+    '''
+        Render the energy contributions along a perturbation trajectory, as
+        computed by Trajectory.get_plot_data. Figures are rendered with the
+        non-interactive Agg backend, except if fn is 'show', such that this
+        routine can run in parallel worker processes.
+
+        **Arguments**
+
+        data
+            a dictionary returned by Trajectory.get_plot_data, nothing is done
+            if it is None
+
+        **Optional Arguments**
+
+        fn, eunit, suffix
+            see Trajectory.plot
+
+        pdf
+            an instance of matplotlib.backends.backend_pdf.PdfPages, if given
+            the figure is added as a new page to this pdf instead of being
+            written to fn
+    '''
+    if data is None: return
+    if fn=='show':
+        import matplotlib.pyplot as pp
+        fig = pp.figure()
+    else:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure()
+        FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    qunit = parse_unit(data['qunit'])
+    kunit = parse_unit(data['kunit'])
+    xs = data['values']
+    e_max = None
+    for prefix, ys, kwargs in data['curves']:
+        ys = ys - min(ys)
+        if e_max is None:
+            #energy axis is determined by the ai reference
+            e_max = max(np.ceil(max(ys)/parse_unit(eunit)), 1.0)
+        pars = fitpar(xs, ys, rcond=1e-6)
+        k = 2*pars[0]
+        if k==0: q0 = np.nan
+        else: q0 = -pars[1]/k
+        kwargs = dict(kwargs)
+        kwargs['label'] = '%s (K=%.0f q0=%.3f)' %(prefix, k/kunit, q0/qunit)
+        ax.plot(xs/qunit, ys/parse_unit(eunit), **kwargs)
+    #decorate plot
+    ax.set_xlim([(min(xs)-data['step'])/qunit, (max(xs)+data['step'])/qunit])
+    ax.set_title('%s-%i' %(data['basename'], data['index']))
+    ax.set_xlabel('%s [%s]' % (data['basename'].split('/')[0], data['qunit']), fontsize=16)
+    ax.set_ylabel('Energy [%s]' %eunit, fontsize=16)
+    ax.set_ylim([-0.2, e_max])
+    ax.grid()
+    ax.legend(loc='upper center', fontsize=16)
+    fig.set_size_inches([8, 8])
+    if fn=='show':
+        import matplotlib.pyplot as pp
+        pp.show()
+        pp.close(fig)
+    elif pdf is not None:
+        pdf.savefig(fig)
+    else:
+        if fn=='default':
+            fn = 'trajectory-%s-%i%s.png' %(data['basename'].replace('/', '-'), data['index'], suffix)
+        fig.savefig(fn)
+
+
+def render_trajectory_plots(data, nproc=1, **kwargs):
+    '''
+        Render the energy contributions along several perturbation
+        trajectories with plot_trajectory_data in a pool of worker processes.
+        Each figure is written to its own file. The figures are rendered
+        serially if nproc is 1 or if forking processes is not supported by
+        the platform.
+
+        **Arguments**
+
+        data
+            a list of dictionaries returned by Trajectory.get_plot_data
+
+        **Optional Arguments**
+
+        nproc
+            the number of worker processes
+
+        All other keyword arguments (except pdf) are passed to
+        plot_trajectory_data.
+    '''
+    assert kwargs.get('pdf') is None, 'Rendering to a pdf is not possible in parallel'
+    data = [d for d in data if d is not None]
+    render = functools.partial(plot_trajectory_data, **kwargs)
+    ctx = None
+    if nproc>1 and len(data)>1:
+        try:
+            ctx = multiprocessing.get_context('fork')
+        except ValueError:
+            log.dump('Forking processes not supported, rendering trajectory plots serially')
+    if ctx is None:
+        for d in data:
+            render(d)
+        return
+    pool = ctx.Pool(min(int(nproc), len(data)))
+    try:
+        pool.map(render, data)
+    finally:
+        pool.close()
+        pool.join()
+
+
 class RelaxedStrain(object):
     def __init__(self, system, valence, settings):
         '''
@@ -268,7 +503,7 @@ class RelaxedStrain(object):
                 if start<0.0: start=0.0
             else:
                 raise NotImplementedError
-            trajectories.append(Trajectory(term, start, end, self.system0.numbers.copy(), nsteps=7))
+            trajectories.append(Trajectory(term, start, end, self.system0.numbers, nsteps=7))
         return trajectories
 
     def generate(self, trajectory, remove_com=True):
@@ -352,9 +587,65 @@ class RelaxedStrain(object):
             trajectory.targets = np.array(targets)
             trajectory.values = np.array(values)
             trajectory.coords = np.array(coords)
+            #store only the displacements with respect to the equilibrium
+            self._compress(trajectory, remove_com=remove_com)
         return trajectory
 
-    def estimate(self, trajectory, ai, ffrefs=[], do_valence=False, energy_noise=None, Nerrorsteps=100):
+    def get_reference_pos(self, remove_com=True):
+        '''
+            Return the equilibrium geometry from which the trajectories are
+            generated, optionally with its center of mass removed.
+        '''
+        pos0 = self.system0.pos.copy()
+        if remove_com:
+            pos0 -= (pos0.T*self.system0.masses).sum(axis=1)/self.system0.masses.sum()
+        return pos0
+
+    def _compress(self, trajectory, remove_com=True):
+        'Compress the trajectory if the setting pert_traj_compress_tol is set'
+        tol = self.settings.pert_traj_compress_tol
+        if tol is not None:
+            trajectory.compress(
+                self.get_reference_pos(remove_com=remove_com), tol=tol,
+                single_precision=self.settings.pert_traj_single_precision
+            )
+
+    def map_trajectory(self, trajectory, reference, perm, rot, remove_com=True):
+        '''
+            Construct the perturbation trajectory of a term that is
+            equivalent by symmetry to the term of an already generated
+            reference trajectory. The displacement of atom i with respect to
+            the equilibrium geometry in the reference trajectory is rotated
+            and assigned to atom perm[i].
+
+            **Arguments**
+
+            trajectory
+                instance of Trajectory class for the equivalent term, as
+                returned by prepare
+
+            reference
+                the generated Trajectory instance of the representative term
+
+            perm
+                integer array, atom i is mapped onto atom perm[i]
+
+            rot
+                (3,3) array with the orthogonal matrix that maps the geometry
+                of the representative term onto that of the equivalent term
+        '''
+        pos0 = self.get_reference_pos(remove_com=remove_com)
+        disps = reference.coords - pos0
+        coords = np.zeros(disps.shape, float)
+        coords[:] = pos0
+        coords[:,perm,:] += np.einsum('ab,fib->fia', rot, disps)
+        trajectory.targets = reference.targets.copy()
+        trajectory.values = reference.values.copy()
+        trajectory.coords = coords
+        self._compress(trajectory, remove_com=remove_com)
+        return trajectory
+
+    def estimate(self, trajectory, ai, ffrefs=[], do_valence=False, energy_noise=None, Nerrorsteps=100, ffref_energies=None):
         '''
             Method to estimate the FF parameters for the relevant ic from the
             given perturbation trajectory by fitting a harmonic potential to the
@@ -388,6 +679,20 @@ class RelaxedStrain(object):
                 single value, the std is used to identify bad estimates, the
                 mean is used for the actual FF parametrs. If set to nan, the
                 parabolic fit is performed only once without any noise.
+
+            ffref_energies
+                a numpy array [nref,nsteps] with the energies of the ffrefs
+                along the trajectory as computed by
+                Trajectory.get_ffref_energies. If given, ffrefs is not used.
+                The force fields in ffrefs can typically not be pickled, hence
+                their energies should be computed in advance when estimating
+                in worker processes.
+
+            The estimated force constant and rest value are stored in the fc
+            and rv attributes of the trajectory and are also returned as a
+            tuple (fc, rv). This method never modifies the parameters of
+            self.valence, which allows running it in parallel (e.g. through
+            paracontext.map) after which the results are applied centrally.
         '''
         with log.section('PTEST', 3, timer='PT Estimate'):
             term = trajectory.term
@@ -395,24 +700,25 @@ class RelaxedStrain(object):
             basename = term.basename
             if 'active' in list(trajectory.__dict__.keys()) and not trajectory.active:
                 log.dump('Trajectory of %s was deactivated: skipping' %(basename))
-                return
+                return trajectory.fc, trajectory.rv
             qs = trajectory.values.copy()
-            AIs = np.zeros(len(trajectory.coords))
-            FFs = np.zeros(len(trajectory.coords))
-            RESs = np.zeros(len(trajectory.coords))
-            for istep, pos in enumerate(trajectory.coords):
-                AIs[istep] = ai.energy(pos)
-                for ref in ffrefs:
-                    FFs[istep] += ref.energy(pos)
+            coords = trajectory.coords
+            RESs = np.zeros(len(coords))
+            tol = self.settings.pert_traj_delta_tol
+            AIs = ai.energy_many(coords)
+            if ffref_energies is None:
+                ffref_energies = trajectory.get_ffref_energies(ffrefs, delta_tol=tol)
+            FFs = np.asarray(ffref_energies, float).reshape([-1, len(coords)]).sum(axis=0)
             if do_valence:
-                fc = self.valence.get_params(index, only='fc')
-                rv = self.valence.get_params(index, only='rv')
-                self.valence.set_params(index, fc=0.0)
-                self.valence.set_params(index, rv0=0.0)
-                for istep, pos in enumerate(trajectory.coords):
-                    RESs[istep] += self.valence.calc_energy(pos) #- 0.5*fc*(qs[istep]-rv)**2
-                self.valence.set_params(index, fc=fc)
-                self.valence.set_params(index, rv0=rv)
+                #switch off the current term in a private copy of the
+                #parameter table, the shared parameters remain untouched
+                vtab = self.valence.get_vtab()
+                self.valence.set_params(index, fc=0.0, rv0=0.0, vtab=vtab)
+                if tol is None:
+                    RESs += self.valence.calc_energies(coords, vtab=vtab)
+                else:
+                    for istep, pos in enumerate(coords):
+                        RESs[istep] += self.valence.calc_delta_energy(pos, coords[0], tol=tol, vtab=vtab)
             pars = fitpar(qs, AIs-FFs-RESs-min(AIs-FFs-RESs), rcond=-1)
             if energy_noise is None:
                 if pars[0]!=0.0:
@@ -466,8 +772,190 @@ class RelaxedStrain(object):
                 if trajectory.rv<0:
                     trajectory.rv = 0.0
                     log.dump('rest value of %s was negative: set to zero' %basename)
+        return trajectory.fc, trajectory.rv
+
+    def estimate_with_energies(self, args, **kwargs):
+        '''
+            Call estimate for a tuple (trajectory, ffref_energies), such
+            that the ffref energies of every trajectory can be passed through
+            paracontext.map. All other keyword arguments are passed to
+            estimate.
+        '''
+        trajectory, ffref_energies = args
+        return self.estimate(trajectory, ffref_energies=ffref_energies, **kwargs)
+
+
+
+
+class HessianProjection(object):
+    '''
+        Estimate the force constant and rest value of diagonal bond and bend
+        terms directly from the covalent ab initio hessian, i.e. the ab
+        initio hessian minus the hessian of the force field references,
+        without constructing a perturbation trajectory. The interatomic
+        3x3 blocks of the hessian are projected on the direction of the
+        internal coordinate as in the Seminario method (including the
+        modification of Allen et al. for bends sharing a bond). The rest
+        value follows from the equilibrium value of the internal coordinate
+        and the covalent gradient projected on the internal coordinate.
+
+        The projection is considered ambiguous, in which case the term should
+        still get a perturbation trajectory, if the term is not a bond or
+        bend angle, if the interatomic block strongly couples the direction
+        of the internal coordinate with the perpendicular directions, if the
+        bend is nearly linear, if the projected force constant is not
+        positive or if the force constants of the terms of a master are
+        strongly spread.
+    '''
+    def __init__(self, system, coupling_tol=0.5, linear_tol=175*deg, spread_tol=0.25):
+        '''
+            **Arguments**
+
+            system
+                a Yaff `System` instance in the ab initio equilibrium geometry
+
+            **Optional Arguments**
+
+            coupling_tol
+                maximum norm of the component of the projected interatomic
+                block perpendicular to the internal coordinate, relative to
+                the parallel component
+
+            linear_tol
+                bends with an equilibrium angle above this value are
+                considered nearly linear
 
+            spread_tol
+                maximum relative standard deviation of the projected force
+                constants of the terms of a master
+        '''
+        self.system = system
+        self.coupling_tol = coupling_tol
+        self.linear_tol = linear_tol
+        self.spread_tol = spread_tol
+
+    def _get_vector(self, i, j):
+        'Vector from atom i to atom j (minimum image), its length and direction'
+        delta = self.system.pos[j] - self.system.pos[i]
+        self.system.cell.mic(delta)
+        r = np.linalg.norm(delta)
+        return delta, r, delta/r
+
+    def _project(self, block, u):
+        '''
+            Project the interatomic block on the unit vector u. Returns the
+            sum of the eigenvalues weighted with the overlap of the
+            eigenvectors with u, and the coupling of u with the perpendicular
+            directions.
+        '''
+        block = 0.5*(block+block.T)
+        evals, evecs = np.linalg.eigh(block)
+        k = (evals*abs(np.dot(u, evecs))).sum()
+        ku = np.dot(block, u)
+        kpar = np.dot(u, ku)
+        coupling = np.linalg.norm(ku-kpar*u)/max(abs(kpar), 1e-12)
+        return k, coupling
+
+    def _get_perpendicular(self, a, b, c):
+        'Unit vector in the plane a-b-c perpendicular to bond b-a pointing away from c'
+        uab = self._get_vector(b, a)[2]
+        ucb = self._get_vector(b, c)[2]
+        un = np.cross(ucb, uab)
+        un /= np.linalg.norm(un)
+        return np.cross(un, uab)
+
+    def _bend_scaling(self, a, b, c):
+        '''
+            Scaling factor of Allen et al. accounting for the other bends
+            around central atom b that contain the bond a-b.
+        '''
+        upa = self._get_perpendicular(a, b, c)
+        scale = 1.0
+        for x in self.system.neighs1[b]:
+            if x in [a, c]: continue
+            cos = np.dot(self._get_vector(b, a)[2], self._get_vector(b, x)[2])
+            if abs(cos)>-np.cos(self.linear_tol): continue
+            scale += np.dot(upa, self._get_perpendicular(a, b, x))**2
+        return scale
+
+    def estimate_bond(self, term, hess, grad):
+        'Estimate (fc, rv, reason) of the bond term'
+        a, b = term.get_atoms()
+        delta, r, u = self._get_vector(a, b)
+        k, coupling = self._project(-hess[a,:,b,:], u)
+        if coupling>self.coupling_tol:
+            return k, r, 'coupled'
+        if k<=0.0:
+            return k, r, 'non-positive'
+        dedq = 0.5*(np.dot(grad[b], u) - np.dot(grad[a], u))
+        return k, r - dedq/k, None
 
+    def estimate_bend(self, term, hess, grad):
+        'Estimate (fc, rv, reason) of the bend angle term'
+        a, b, c = term.get_atoms()
+        dab, rab, uab = self._get_vector(b, a)
+        dcb, rcb, ucb = self._get_vector(b, c)
+        cos = np.clip(np.dot(uab, ucb), -1.0, 1.0)
+        theta = np.arccos(cos)
+        if theta>self.linear_tol:
+            return np.nan, theta, 'near-linear'
+        upa = self._get_perpendicular(a, b, c)
+        upc = self._get_perpendicular(c, b, a)
+        ka, couplinga = self._project(-hess[a,:,b,:], upa)
+        kc, couplingc = self._project(-hess[c,:,b,:], upc)
+        if max(couplinga, couplingc)>self.coupling_tol:
+            return np.nan, theta, 'coupled'
+        if ka<=0.0 or kc<=0.0:
+            return np.nan, theta, 'non-positive'
+        k = 1.0/(self._bend_scaling(a, b, c)/(rab**2*ka) + self._bend_scaling(c, b, a)/(rcb**2*kc))
+        #Wilson B vector of the angle
+        sin = np.sin(theta)
+        ba = (cos*uab-ucb)/(rab*sin)
+        bc = (cos*ucb-uab)/(rcb*sin)
+        bvec = np.array([ba, -ba-bc, bc])
+        dedq = (bvec*grad[[a,b,c]]).sum()/(bvec**2).sum()
+        return k, theta - dedq/k, None
+
+    def estimate(self, terms, hess, grad):
+        '''
+            Estimate the force constant and rest value of the given terms.
+            Returns a dictionary mapping the term index on a tuple
+            (fc, rv, reason) in which reason is None if the projection is
+            reliable and otherwise a string describing why it is ambiguous.
+
+            **Arguments**
+
+            terms
+                list of Term instances
+
+            hess
+                the covalent hessian as a (N,3,N,3) numpy array
+
+            grad
+                the covalent gradient as a (N,3) numpy array
+        '''
+        results = {}
+        groups = {}
+        for term in terms:
+            ickinds = [ic.kind for ic in term.ics]
+            if term.kind not in [0,2,11,12] or len(ickinds)!=1:
+                results[term.index] = (np.nan, np.nan, 'unsupported')
+            elif ickinds[0]==0:#Bond
+                results[term.index] = self.estimate_bond(term, hess, grad)
+            elif ickinds[0]==2:#BendAngle
+                results[term.index] = self.estimate_bend(term, hess, grad)
+            else:
+                results[term.index] = (np.nan, np.nan, 'unsupported')
+            if results[term.index][2] is None:
+                groups.setdefault(term.master, []).append(term.index)
+        #check the spread of the force constants of every master
+        for master, indexes in groups.items():
+            fcs = np.array([results[index][0] for index in indexes])
+            if len(fcs)>1 and fcs.std()>self.spread_tol*fcs.mean():
+                for index in indexes:
+                    fc, rv, reason = results[index]
+                    results[index] = (fc, rv, 'slave spread')
+        return results
 
 
 class Strain(ForceField):
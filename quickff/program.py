@@ -29,10 +29,14 @@ from __future__ import print_function, absolute_import
 from molmod.units import *
 
 from quickff.valence import ValenceFF
-from quickff.perturbation import RelaxedStrain
+from quickff.perturbation import RelaxedStrain, HessianProjection, \
+    plot_trajectory_data, render_trajectory_plots
 from quickff.cost import HessianFCCost
+from quickff.reference import CachedReference
+from quickff.symmetry import Symmetry
 from quickff.paracontext import paracontext
-from quickff.io import dump_charmm22_prm, dump_charmm22_psf, dump_yaff
+from quickff.io import dump_charmm22_prm, dump_charmm22_psf, dump_yaff, \
+    TrajectoryStore, dump_trajectories_extxyz
 from quickff.log import log
 from quickff.tools import chebychev
 
@@ -40,7 +44,7 @@ from yaff.system import System
 from yaff.pes.vlist import Cosine, Harmonic, Chebychev1, Chebychev4
 from yaff.pes.iclist import BendAngle, BendCos, OopDist
 
-import os, pickle, numpy as np, datetime
+import os, pickle, numpy as np, datetime, multiprocessing
 
 __all__ = [
     'BaseProgram', 'MakeTrajectories', 'PlotTrajectories', 'DeriveFF',
@@ -69,17 +73,29 @@ class BaseProgram(object):
 
             ffrefs
                 a list of `Reference` instances defining the a-priori force
-                field contributions.
+                field contributions. Their energies, gradients and hessians
+                are cached with a `CachedReference`, optionally on disk in
+                the directory given by the dn_ref_cache setting.
         '''
         with log.section('INIT', 1, timer='Initializing'):
             log.dump('Initializing program')
             self.settings = settings
             self.system = system
             self.ai = ai
-            self.ffrefs = ffrefs
+            self.ffrefs = [
+                ffref if isinstance(ffref, CachedReference) else CachedReference(ffref, dn_cache=settings.dn_ref_cache)
+                for ffref in ffrefs
+            ]
             self.valence = ValenceFF(system, settings)
             self.perturbation = RelaxedStrain(system, self.valence, settings)
             self.trajectories = None
+            self.trajectory_index = {}
+            self.trajectory_store = None
+            self.projections = {}
+            self.symmetry = None
+            if settings.do_symmetry:
+                self.symmetry = Symmetry(system, pos=ai.coords0, tol=settings.symmetry_tol)
+                self.valence.symmetry = self.symmetry
             self.print_system()
 
     def print_system(self):
@@ -129,74 +145,79 @@ class BaseProgram(object):
         with log.section('PTUPD', 3):
             #update the terms in the trajectories to match the terms in
             #self.valence
+            counts = {}
             for traj in self.trajectories:
-                found = False
-                for term in self.valence.iter_terms():
-                    if traj.term.get_atoms()==term.get_atoms():
-                        if found: raise ValueError('Found two terms for trajectory %s with atom indices %s' %(traj.term.basename, str(traj.term.get_atoms())))
-                        traj.term = term
-                        if 'PT_ALL' not in term.tasks:
-                            log.dump('PT_ALL not in tasks of %s-%i, deactivated PT' %(term.basename, term.index))
-                            traj.active = False
-                        found = True
-                if not found:
+                key = tuple(traj.term.get_atoms())
+                indexes = self.valence.terms_by_atoms.get(key, [])
+                if len(indexes)>1: raise ValueError('Found two terms for trajectory %s with atom indices %s' %(traj.term.basename, str(traj.term.get_atoms())))
+                if len(indexes)==1:
+                    term = self.valence.terms[indexes[0]]
+                    traj.term = term
+                    if 'PT_ALL' not in term.tasks:
+                        log.dump('PT_ALL not in tasks of %s-%i, deactivated PT' %(term.basename, term.index))
+                        traj.active = False
+                else:
                     log.warning('No term found for trajectory %s with atom indices %s, deactivating trajectory' %(traj.term.basename, str(traj.term.get_atoms())))
                     traj.active = False
+                counts[key] = counts.get(key, 0) + 1
             #check if every term with task PT_ALL has a trajectory associated
-            #with it. It a trajectory is missing, generate it.
-            for term in self.valence.iter_terms():
-                if 'PT_ALL' not in term.tasks: continue
-                found = False
-                for traj in self.trajectories:
-                    if term.get_atoms()==traj.term.get_atoms():
-                        if found: raise ValueError('Found two trajectories for term %s with atom indices %s' %(term.basename, str(term.get_atoms())))
-                        found =True
-                if not found:
+            #with it. It a trajectory is missing, generate it. If only a
+            #sample of the slaves is used, only the sampled terms are checked.
+            terms = [term for term in self.valence.iter_terms() if 'PT_ALL' in term.tasks]
+            terms = [term for term in terms if term.index not in self.projections]
+            for term in self.select_pt_terms(terms):
+                count = counts.get(tuple(term.get_atoms()), 0)
+                if count>1: raise ValueError('Found two trajectories for term %s with atom indices %s' %(term.basename, str(term.get_atoms())))
+                if count==0:
                     log.warning('No trajectory found for term %s with atom indices %s. Generating it now.' %(term.basename, str(term.get_atoms())))
-                    trajectory = self.perturbation.prepare([term])[term.index]
+                    trajectory = self.perturbation.prepare([term])[0]
                     self.perturbation.generate(trajectory)
+                    if self.trajectory_store is not None:
+                        self.trajectory_store.append(trajectory)
                     self.trajectories.append(trajectory)
+            self.update_trajectory_index()
+
+    def update_trajectory_index(self):
+        '''
+            Rebuild the dictionary ``self.trajectory_index`` mapping the index
+            of a term to its trajectory in ``self.trajectories``.
+        '''
+        self.trajectory_index = {}
+        for traj in self.trajectories:
+            if traj is None: continue
+            self.trajectory_index[traj.term.index] = traj
 
     def average_pars(self):
         '''
             Average force field parameters over master and slaves.
         '''
         log.dump('Averaging force field parameters over master and slaves')
-        for master in self.valence.iter_masters():
-            npars = len(self.valence.get_params(master.index))
-            pars = np.zeros([len(master.slaves)+1, npars], float)
-            pars[0,:] = np.array(self.valence.get_params(master.index))
-            for i, islave in enumerate(master.slaves):
-                pars[1+i,:] = np.array(self.valence.get_params(islave))
-            if master.kind in [0,2,11,12]:#harmonic,fues,MM3Quartic,MM3Bend
-                fc, rv = pars.mean(axis=0)
-                self.valence.set_params(master.index, fc=fc, rv0=rv)
-                for islave in master.slaves:
-                    self.valence.set_params(islave, fc=fc, rv0=rv)
-            elif master.kind==1:
-                a0, a1, a2, a3 = pars.mean(axis=0)
-                self.valence.set_params(master.index, a0=a0, a1=a1, a2=a2, a3=a3)
-                for islave in master.slaves:
-                    self.valence.set_params(islave, a0=a0, a1=a1, a2=a2, a3=a3)
-            elif master.kind==3:#cross
-                fc, rv0, rv1 = pars.mean(axis=0)
-                self.valence.set_params(master.index, fc=fc, rv0=rv0, rv1=rv1)
-                for islave in master.slaves:
-                    self.valence.set_params(islave, fc=fc, rv0=rv0, rv1=rv1)
-            elif master.kind==4:#cosine
-                assert pars[:,0].std()<1e-6, 'dihedral multiplicity not unique'
-                m, fc, rv = pars.mean(axis=0)
-                self.valence.set_params(master.index, fc=fc, rv0=rv, m=m)
-                for islave in master.slaves:
-                    self.valence.set_params(islave, fc=fc, rv0=rv, m=m)
-            elif master.kind in [5, 6, 7, 8, 9]:#chebychev
-                assert pars.shape[1]==2
-                fc = pars[:,0].mean()
-                self.valence.set_params(master.index, fc=fc)
-                for islave in master.slaves:
-                    self.valence.set_params(islave, fc=fc)
-            else:
-                raise NotImplementedError
+        nv = self.valence.vlist.nv
+        vtab = self.valence.vlist.vtab[:nv]
+        masters = self.valence.get_term_table()['master']
+        kinds = vtab['kind'][masters]
+        counts = np.maximum(np.bincount(masters, minlength=nv), 1)
+        #parameters to average per kind of the master
+        averaged = {
+            0: 2, 2: 2, 11: 2, 12: 2, #harmonic,fues,MM3Quartic,MM3Bend
+            1: 4, 3: 3, 4: 3, #polyfour, cross, cosine
+            5: 1, 6: 1, 7: 1, 8: 1, 9: 1, #chebychev: only fc
+        }
+        unsupported = set(np.unique(kinds)) - set(averaged.keys())
+        if len(unsupported)>0:
+            raise NotImplementedError
+        npars = np.array([averaged[kind] for kind in kinds])
+        for i in range(4):
+            select = npars>i
+            if not select.any(): continue
+            pars = vtab['par%i' %i]
+            means = np.bincount(masters, weights=pars, minlength=nv)/counts
+            if i==0:
+                #dihedral multiplicities should be unique over master and slaves
+                iscos = kinds==4
+                deviation = np.bincount(masters[iscos], weights=(pars[iscos]-means[masters[iscos]])**2, minlength=nv)
+                assert (deviation<1e-12*counts).all(), 'dihedral multiplicity not unique'
+            self.valence.vlist.vtab['par%i' %i][np.where(select)[0]] = means[masters[select]]
 
     def make_output(self):
         '''
@@ -219,33 +240,79 @@ class BaseProgram(object):
 
     def plot_trajectories(self, do_valence=False, suffix=''):
         '''
-            Plot energy contributions along perturbation trajectories and
+            Plot energy contributions along perturbation trajectories. The
+            energy contributions are first computed for all trajectories in
+            the current process (the Yaff force fields in self.ffrefs can not
+            be sent to other processes), afterwards the figures are rendered
+            with the non-interactive Agg backend in a pool of
+            plot_traj_nproc processes. If the setting plot_traj_pdf is True,
+            all figures are written as pages of a single pdf file
+            trajectories<suffix>.pdf instead of a separate png per trajectory.
         '''
         only = self.settings.only_traj
         if not isinstance(only, list): only = [only]
         with log.section('PLOT', 3, timer='PT plot energy'):
             valence = None
             if do_valence: valence=self.valence
+            trajectories = []
             for trajectory in self.trajectories:
                 if trajectory is None: continue
                 for pattern in only:
                     if pattern=='PT_ALL' or pattern in trajectory.term.basename:
                         log.dump('Plotting trajectory for %s' %trajectory.term.basename)
-                        trajectory.plot(self.ai, ffrefs=self.ffrefs, valence=valence, suffix=suffix)
+                        trajectories.append(trajectory)
+                        break
+            data = [
+                trajectory.get_plot_data(
+                    self.ai, ffrefs=self.ffrefs, valence=valence,
+                    delta_tol=self.settings.pert_traj_delta_tol
+                ) for trajectory in trajectories
+            ]
+            if self.settings.plot_traj_pdf:
+                from matplotlib.backends.backend_pdf import PdfPages
+                fn = 'trajectories%s.pdf' %suffix
+                with PdfPages(fn) as pdf:
+                    for d in data:
+                        plot_trajectory_data(d, pdf=pdf)
+                log.dump('Trajectory plots written to %s' %fn)
+            else:
+                nproc = self.settings.plot_traj_nproc
+                if nproc is None: nproc = multiprocessing.cpu_count()
+                render_trajectory_plots(data, nproc=nproc, suffix=suffix)
 
     def write_trajectories(self):
         '''
-            Write perturbation trajectories to XYZ files.
+            Write perturbation trajectories to XYZ files. Depending on the
+            setting xyz_traj_archive, a separate XYZ file is written for each
+            trajectory (None), or all trajectories are written to the single
+            extended XYZ file trajectories.xyz (extxyz) or to the single HDF5
+            file trajectories_xyz.h5 (h5).
         '''
         only = self.settings.only_traj
         if not isinstance(only, list): only = [only]
+        archive = self.settings.xyz_traj_archive
         with log.section('XYZ', 3, timer='PT dump XYZ'):
+            trajectories = []
             for trajectory in self.trajectories:
                 if trajectory is None: continue
                 for pattern in only:
                     if pattern=='PT_ALL' or pattern in trajectory.term.basename:
-                        log.dump('Writing XYZ trajectory for %s' %trajectory.term.basename)
-                        trajectory.to_xyz()
+                        trajectories.append(trajectory)
+                        break
+            if archive is None:
+                for trajectory in trajectories:
+                    log.dump('Writing XYZ trajectory for %s' %trajectory.term.basename)
+                    trajectory.to_xyz()
+            elif archive.lower()=='extxyz':
+                log.dump('Writing %i trajectories to trajectories.xyz' %len(trajectories))
+                dump_trajectories_extxyz(trajectories, 'trajectories.xyz')
+            elif archive.lower()=='h5':
+                log.dump('Writing %i trajectories to trajectories_xyz.h5' %len(trajectories))
+                if os.path.isfile('trajectories_xyz.h5'):
+                    os.remove('trajectories_xyz.h5')
+                TrajectoryStore('trajectories_xyz.h5').extend(
+                    [traj for traj in trajectories if traj.active]
+                )
 
     def do_pt_generate(self):
         '''
@@ -254,7 +321,8 @@ class BaseProgram(object):
         with log.section('PTGEN', 2, timer='PT Generate'):
             #read if an existing file was specified through fn_traj
             fn_traj = self.settings.fn_traj
-            if fn_traj is not None and os.path.isfile(fn_traj):
+            use_store = fn_traj is not None and fn_traj.split('.')[-1] in ['h5', 'hdf5']
+            if fn_traj is not None and os.path.isfile(fn_traj) and not use_store:
                 self.trajectories = pickle.load(open(fn_traj, 'rb'))
                 log.dump('Trajectories read from file %s' %fn_traj)
                 self.update_trajectory_terms()
@@ -273,16 +341,284 @@ class BaseProgram(object):
                     for term in self.valence.iter_terms(pattern):
                         if term.kind in [0,2,11,12]:
                             do_terms.append(term)
+            if self.settings.do_pt_projection:
+                do_terms = self.do_pt_projection(do_terms)
+            do_terms = self.select_pt_terms(do_terms)
             trajectories = self.perturbation.prepare(do_terms)
+            if use_store:
+                self.do_pt_generate_store(fn_traj, trajectories)
+                return
             #compute
             log.dump('Constructing trajectories')
-            self.trajectories = paracontext.map(self.perturbation.generate, [traj for traj in trajectories if traj.active])
+            self.trajectories = self.generate_trajectories([traj for traj in trajectories if traj.active])
+            self.update_trajectory_index()
             #write the trajectories to the non-existing file fn_traj
             if fn_traj is not None:
                 assert not os.path.isfile(fn_traj)
                 pickle.dump(self.trajectories, open(fn_traj, 'wb'))
                 log.dump('Trajectories stored to file %s' %fn_traj)
 
+    def do_pt_projection(self, terms, coupling_tol=0.5, linear_tol=175*deg, spread_tol=0.25):
+        '''
+            Estimate the force constants and rest values of the given terms
+            by projecting the covalent ab initio hessian on their internal
+            coordinate (see `HessianProjection`). The estimates of the terms
+            for which the projection is reliable are stored in
+            ``self.projections`` and used instead of a perturbation trajectory
+            in do_pt_estimate. The terms for which the projection is
+            ambiguous are returned, for these a perturbation trajectory is
+            still required. A report of the path taken by each term is
+            logged.
+
+            **Arguments**
+
+            terms
+                list of Term instances
+
+            **Optional Arguments**
+
+            coupling_tol, linear_tol, spread_tol
+                thresholds to detect ambiguous projections, see
+                `HessianProjection`
+        '''
+        with log.section('PTPROJ', 2, timer='PT Projection'):
+            self.reset_system()
+            log.dump('Estimating FF parameters from projection of the covalent hessian')
+            natom = self.system.natom
+            hess = self.ai.hessian(self.system.pos).reshape([natom, 3, natom, 3]).copy()
+            grad = self.ai.gradient(self.system.pos).reshape([natom, 3]).copy()
+            for ffref in self.ffrefs:
+                hess -= ffref.hessian(self.system.pos).reshape([natom, 3, natom, 3])
+                grad -= ffref.gradient(self.system.pos).reshape([natom, 3])
+            projection = HessianProjection(
+                self.system, coupling_tol=coupling_tol, linear_tol=linear_tol,
+                spread_tol=spread_tol
+            )
+            results = projection.estimate(terms, hess, grad)
+            self.projections = {}
+            todo = []
+            with log.section('PTPROJ', 3):
+                for term in terms:
+                    fc, rv, reason = results[term.index]
+                    kunit, qunit = term.units
+                    if reason is None:
+                        self.projections[term.index] = (fc, rv)
+                        path = 'projection'
+                    else:
+                        todo.append(term)
+                        path = 'trajectory (%s)' %reason
+                    log.dump('%s(atoms=%s): fc = %.3f %s  rv = %.4f %s  -> %s' %(
+                        term.basename, str(term.get_atoms()),
+                        fc/parse_unit(kunit), kunit, rv/parse_unit(qunit), qunit, path
+                    ))
+            log.dump('%i terms estimated by projection, %i terms require a perturbation trajectory' %(
+                len(self.projections), len(todo)
+            ))
+        return todo
+
+    def generate_trajectories(self, trajectories):
+        '''
+            Generate the given perturbation trajectories. If symmetry
+            detection is enabled, only the trajectories of one term of each
+            orbit of equivalent terms are generated, the others are obtained
+            by mapping the atoms (and rotating the displacements) of the
+            generated trajectory.
+
+            **Arguments**
+
+            trajectories
+                list of Trajectory instances as returned by prepare
+        '''
+        if self.symmetry is None:
+            return paracontext.map(self.perturbation.generate, trajectories)
+        orbits = self.symmetry.get_orbits([traj.term for traj in trajectories])
+        reps = [traj for traj in trajectories if orbits[traj.term.index][0]==traj.term.index]
+        generated = dict(
+            (traj.term.index, traj) for traj in
+            paracontext.map(self.perturbation.generate, reps)
+        )
+        result = []
+        for traj in trajectories:
+            rep, perm, rot = orbits[traj.term.index]
+            if perm is None:
+                result.append(generated[rep])
+            else:
+                result.append(self.perturbation.map_trajectory(traj, generated[rep], perm, rot))
+        return result
+
+    def select_pt_terms(self, terms):
+        '''
+            Select the terms for which a perturbation trajectory will be
+            constructed. If the setting pert_traj_slaves is None, all given
+            terms are selected. Otherwise, only a sample of the terms of each
+            master is selected. If pert_traj_slaves is smaller than 1, it is
+            interpreted as the fraction of terms to sample, else as the number
+            of terms. The master is always selected, the other terms are
+            spread over the distinct local environments (atom types of the
+            atoms and of their neighbors) and, within an environment, over the
+            equilibrium values of the internal coordinate. The selection is
+            deterministic.
+
+            **Arguments**
+
+            terms
+                list of Term instances
+        '''
+        nsample = self.settings.pert_traj_slaves
+        if nsample is None: return terms
+        groups = {}
+        for term in terms:
+            groups.setdefault(term.master, []).append(term)
+        selected = set()
+        for master, group in groups.items():
+            if nsample<1:
+                nkeep = int(np.ceil(nsample*len(group)))
+            else:
+                nkeep = int(nsample)
+            nkeep = max(1, min(len(group), nkeep))
+            first = group[0]
+            for term in group:
+                if term.index==master:
+                    first = term
+                    break
+            #collect the remaining terms per local environment, the
+            #environment of the master is visited last
+            envs = {}
+            for term in group:
+                if term is first: continue
+                envs.setdefault(self._get_term_environment(term), []).append(term)
+            env0 = self._get_term_environment(first)
+            keys = [key for key in envs.keys() if key!=env0]
+            if env0 in envs: keys.append(env0)
+            queues = [self._spread_terms(envs[key], nkeep) for key in keys]
+            chosen = [first]
+            while len(chosen)<nkeep:
+                for queue in queues:
+                    if len(queue)>0 and len(chosen)<nkeep:
+                        chosen.append(queue.pop(0))
+            for term in chosen:
+                selected.add(term.index)
+            log.dump('Sampled %i out of %i terms for perturbation trajectories of %s' %(
+                len(chosen), len(group), self.valence.terms[master].basename
+            ))
+        return [term for term in terms if term.index in selected]
+
+    def _get_term_environment(self, term):
+        '''
+            Signature of the local environment of a term, i.e. the atom types
+            of its atoms and of their direct neighbors.
+        '''
+        ffatypes = self.system.ffatypes
+        ffatype_ids = self.system.ffatype_ids
+        env = []
+        for atom in term.get_atoms():
+            neighs = sorted([ffatypes[ffatype_ids[i]] for i in self.system.neighs1[atom]])
+            env.append((ffatypes[ffatype_ids[atom]], tuple(neighs)))
+        return min(tuple(env), tuple(env[::-1]))
+
+    def _get_term_value(self, term):
+        'Current value of the (first) internal coordinate of a term'
+        return self.valence.iclist.ictab[self.valence.vlist.vtab[term.index]['ic0']]['value']
+
+    def _spread_terms(self, terms, nmax):
+        '''
+            Order (at most nmax of) the given terms such that the values of
+            their internal coordinate are spread as much as possible: start
+            from the term closest to the median and repeatedly add the term
+            furthest from the terms already added.
+        '''
+        values = np.array([self._get_term_value(term) for term in terms])
+        order = [int(np.argmin(abs(values-np.median(values))))]
+        dists = abs(values-values[order[0]])
+        while len(order)<min(nmax, len(terms)):
+            i = int(np.argmax(dists))
+            order.append(i)
+            dists = np.minimum(dists, abs(values-values[i]))
+        return [terms[i] for i in order]
+
+    def fill_unsampled_pars(self, rtol=0.05):
+        '''
+            If only a sample of the slaves of a master has a perturbation
+            trajectory (see select_pt_terms), assign the mean force constant
+            and rest value of the sampled terms to the other terms of that
+            master. The standard error on these means is logged, together
+            with a flag indicating if the sample is converged, i.e. if both
+            standard errors are below rtol times the mean.
+        '''
+        if self.settings.pert_traj_slaves is None: return
+        with log.section('PTSMPL', 3):
+            for master in self.valence.iter_masters():
+                if master.kind not in [0,2,11,12] or 'PT_ALL' not in master.tasks: continue
+                indexes = [master.index] + master.slaves
+                trajs = [self.trajectory_index.get(index) for index in indexes]
+                missing = [
+                    index for index, traj in zip(indexes, trajs)
+                    if traj is None and index not in self.projections
+                ]
+                sampled = [traj for traj in trajs if traj is not None and traj.active and traj.fc is not None]
+                if len(missing)==0 or len(sampled)==0: continue
+                fcs = np.array([traj.fc for traj in sampled])
+                rvs = np.array([traj.rv for traj in sampled])
+                fc, rv = fcs.mean(), rvs.mean()
+                for index in missing:
+                    self.valence.set_params(index, fc=fc, rv0=rv)
+                n = len(sampled)
+                if n>1:
+                    dfc = fcs.std(ddof=1)/np.sqrt(n)
+                    drv = rvs.std(ddof=1)/np.sqrt(n)
+                    converged = dfc<=rtol*abs(fc) and drv<=rtol*abs(rv)
+                else:
+                    dfc, drv = np.nan, np.nan
+                    converged = False
+                kunit, qunit = master.units
+                log.dump('%s sampled %i/%i: fc = %.3f +- %.3f %s  rv = %.4f +- %.4f %s  %s' %(
+                    master.basename, n, len(indexes),
+                    fc/parse_unit(kunit), dfc/parse_unit(kunit), kunit,
+                    rv/parse_unit(qunit), drv/parse_unit(qunit), qunit,
+                    'converged' if converged else 'NOT converged, consider sampling more slaves'
+                ))
+
+    def do_pt_generate_store(self, fn_traj, trajectories):
+        '''
+            Generate the given perturbation trajectories and append each of
+            them to the HDF5 trajectory store fn_traj as soon as it is
+            finished. Trajectories already present in the store are not
+            generated again, which allows to resume an interrupted run. If
+            symmetry detection is enabled, only the representative of each
+            orbit of equivalent terms is generated and, as soon as it is
+            finished, it is appended together with the mapped trajectories of
+            the equivalent terms. Afterwards, all trajectories are loaded from
+            the store with coordinates that are only read when needed.
+        '''
+        store = TrajectoryStore(fn_traj)
+        self.trajectory_store = store
+        done = store.keys()
+        todo = [traj for traj in trajectories if traj.active and store.get_key(traj.term) not in done]
+        log.dump('Found %i trajectories in %s, constructing %i remaining trajectories' %(len(done), fn_traj, len(todo)))
+        reps, images = todo, {}
+        if self.symmetry is not None:
+            orbits = self.symmetry.get_orbits([traj.term for traj in todo])
+            reps = []
+            for traj in todo:
+                rep, perm, rot = orbits[traj.term.index]
+                if perm is None:
+                    reps.append(traj)
+                else:
+                    images.setdefault(rep, []).append((traj, perm, rot))
+        futures = [paracontext.submit(self.perturbation.generate, traj) for traj in reps]
+        while len(futures)>0:
+            finished, futures = paracontext.wait_first(futures)
+            futures = list(futures)
+            for future in finished:
+                traj = future.result()
+                store.extend([traj]+[
+                    self.perturbation.map_trajectory(image, traj, perm, rot)
+                    for image, perm, rot in images.get(traj.term.index, [])
+                ])
+        self.trajectories = store.load_all()
+        log.dump('Trajectories stored to file %s' %fn_traj)
+        self.update_trajectory_terms()
+
     def do_pt_estimate(self, do_valence=False, energy_noise=None, logger_level=3):
         '''
             Estimate force constants and rest values from the perturbation
@@ -299,23 +635,42 @@ class BaseProgram(object):
             message = 'Estimating FF parameters from perturbation trajectories'
             if do_valence: message += ' with valence reference'
             log.dump(message)
-            #compute fc and rv from trajectory
+            #select the trajectories from which fc and rv will be computed
             only = self.settings.only_traj
+            trajectories = []
             for traj in self.trajectories:
                 if traj is None: continue
                 if not (only is None or only=='PT_ALL' or only=='pt_all'):
                     if isinstance(only, str): only = [only]
                     basename = self.valence.terms[traj.term.master].basename
                     if basename not in only: continue
-                self.perturbation.estimate(traj, self.ai, ffrefs=self.ffrefs, do_valence=do_valence, energy_noise=energy_noise)
+                trajectories.append(traj)
+            #the energies of the a priori contributions are computed here, as
+            #the Yaff force fields in self.ffrefs can not be pickled to be
+            #sent to workers
+            ffref_energies = [
+                traj.get_ffref_energies(self.ffrefs, delta_tol=self.settings.pert_traj_delta_tol)
+                for traj in trajectories
+            ]
+            #compute fc and rv from trajectory, each worker gets its own
+            #snapshot of the valence parameters and only returns (fc, rv)
+            if do_valence and self.settings.pert_traj_delta_tol is None:
+                self.valence.get_engine()
+            results = paracontext.map(
+                self.perturbation.estimate_with_energies,
+                list(zip(trajectories, ffref_energies)), ai=self.ai,
+                do_valence=do_valence, energy_noise=energy_noise
+            )
             #set force field parameters to computed fc and rv
-            for traj in self.trajectories:
-                if traj is None: continue
-                if not (only is None or only=='PT_ALL' or only=='pt_all'):
-                    if isinstance(only, str): only = [only]
-                    basename = self.valence.terms[traj.term.master].basename
-                    if basename not in only: continue
+            for traj, (fc, rv) in zip(trajectories, results):
+                traj.fc = fc
+                traj.rv = rv
                 self.valence.set_params(traj.term.index, fc=traj.fc, rv0=traj.rv)
+            #terms estimated by projection of the hessian
+            for index, (fc, rv) in self.projections.items():
+                self.valence.set_params(index, fc=fc, rv0=rv)
+            #terms without trajectory get the mean of the sampled terms
+            self.fill_unsampled_pars()
             #output
             self.valence.dump_logger(print_level=logger_level)
             #do not add average here since the fluctuation on the parameters is
@@ -348,27 +703,33 @@ class BaseProgram(object):
         with log.section('EQSET', 2, timer='Equil Set RV'):
             self.reset_system()
             log.dump('Setting rest values to AI equilibrium values for tasks %s' %' '.join(tasks))
+            crosses, cosines, others = [], [], []
             for term in self.valence.terms:
-                vterm = self.valence.vlist.vtab[term.index]
                 if np.array([task in term.tasks for task in tasks]).any():
                     if term.kind==3:#cross term
-                        ic0 = self.valence.iclist.ictab[vterm['ic0']]
-                        ic1 = self.valence.iclist.ictab[vterm['ic1']]
-                        self.valence.set_params(term.index, rv0=ic0['value'], rv1=ic1['value'])
+                        crosses.append(term.index)
                     elif term.kind==4 and term.ics[0].kind==4:#Cosine of DihedAngle
-                        ic = self.valence.iclist.ictab[vterm['ic0']]
-                        m = self.valence.get_params(term.index, only='m')
-                        rv = ic['value']%(360.0*deg/m)
-                        with log.section('EQSET', 4, timer='Equil Set RV'):
+                        cosines.append(term.index)
+                    else:
+                        others.append(term.index)
+            vtab = self.valence.vlist.vtab
+            values = self.valence.iclist.ictab['value']
+            self.valence.set_params_many(crosses, rv0=values[vtab['ic0'][crosses]], rv1=values[vtab['ic1'][crosses]])
+            if len(cosines)>0:
+                eqs = values[vtab['ic0'][cosines]]
+                ms = self.valence.get_params_many(cosines, only='m')
+                rvs = eqs%(360.0*deg/ms)
+                with log.section('EQSET', 4, timer='Equil Set RV'):
+                    if log.log_level>=4:
+                        for index, eq, rv in zip(cosines, eqs, rvs):
+                            term = self.valence.terms[index]
                             log.dump('Set rest value of %s(%s) (eq=%.3f deg) to %.3f deg' %(
                                 term.basename,
                                 '.'.join([str(at) for at in term.get_atoms()]),
-                                ic['value']/deg, rv/deg
+                                eq/deg, rv/deg
                             ))
-                        self.valence.set_params(term.index, rv0=rv)
-                    else:
-                        rv = self.valence.iclist.ictab[vterm['ic0']]['value']
-                        self.valence.set_params(term.index, rv0=rv)
+                self.valence.set_params_many(cosines, rv0=rvs)
+            self.valence.set_params_many(others, rv0=values[vtab['ic0'][others]])
             self.valence.dump_logger(print_level=logger_level)
             self.average_pars()
 
@@ -431,22 +792,47 @@ class BaseProgram(object):
             if len(term_indices)==0:
                 log.dump('No terms (with task in %s) found to estimate FC from HC' %(str(tasks)))
                 return
+            # Cross terms of which the contribution to the residual hessian,
+            # i.e. after fitting all other terms, is estimated to be
+            # negligible (relative to cross_prune_tol) are screened out before
+            # constructing the cost function.
+            prune_tol = self.settings.cross_prune_tol
+            crosses = [index for index in term_indices if self.valence.terms[index].basename.startswith('Cross')]
+            cost = HessianFCCost(
+                self.system, self.ai, self.valence, term_indices, ffrefs=self.ffrefs,
+                do_mass_weighting=do_mass_weighting, screen_indices=crosses,
+                screen_tol=prune_tol
+            )
+            if len(cost.screened)>0:
+                self.valence.set_params_many(cost.screened, fc=0.0)
+                self.valence.broadcast_master_params(cost.screened, only='fc')
+            term_indices = list(cost.fit_indices)
             # Try to estimate force constants; if the remove_dysfunctional_cross
             # keyword is True, a loop is performed which checks whether there
             # are cross terms for which corresponding diagonal terms have zero
-            # force constants. If this is the case, those cross terms are removed
-            # from the fit and we try again until such cases do no longer occur
+            # force constants. If prune_tol is not None, cross terms of which
+            # the fitted hessian contribution is negligible are removed as
+            # well. If this is the case, those cross terms are removed from the
+            # fit and we try again until such cases do no longer occur
             max_iter = 100
             niter = 0
-            while niter<max_iter:
-                cost = HessianFCCost(self.system, self.ai, self.valence, term_indices, ffrefs=self.ffrefs, do_mass_weighting=do_mass_weighting)
+            while niter<max_iter and len(term_indices)>0:
                 fcs = cost.estimate(do_svd=do_svd, svd_rcond=svd_rcond)
                 # No need to continue, if cross terms with corresponding diagonal
-                # terms with negative force constants are allowed
-                if self.settings.remove_dysfunctional_cross is False: break
+                # terms with negative force constants and negligible cross terms
+                # are allowed
+                if self.settings.remove_dysfunctional_cross is False and prune_tol is None: break
                 to_remove = []
+                if prune_tol is not None:
+                    contribs = cost.get_contributions(fcs)
+                    for index, contrib in zip(term_indices, contribs):
+                        if index in crosses and contrib<prune_tol:
+                            to_remove.append(index)
+                            self.valence.set_params(index, fc=0.0)
+                            log.dump('Negligible cross term %s detected, removing from the hessian fit.' %self.valence.terms[index].basename)
                 for index, fc in zip(term_indices, fcs):
                     term = self.valence.terms[index]
+                    if self.settings.remove_dysfunctional_cross is False or index in to_remove: continue
                     if term.basename.startswith('Cross'):
                         # Find force constants of corresponding diagonal terms
                         diag_fcs = np.zeros((2))
@@ -465,16 +851,19 @@ class BaseProgram(object):
                             log.dump('WARNING! Dysfunctional cross term %s detected, removing from the hessian fit.'%term.basename)
                 if len(to_remove)==0: break
                 else:
-                    for index in to_remove:
-                        term_indices.remove(index)
+                    cost.remove(to_remove)
+                    self.valence.broadcast_master_params(to_remove, only='fc')
+                    term_indices = list(cost.fit_indices)
                 niter += 1
             assert niter<max_iter, "Could not remove all dysfunctional cross terms in %d iterations, something is seriously wrong"%max_iter
-            for index, fc in zip(term_indices, fcs):
-                master = self.valence.terms[index]
-                assert master.is_master()
-                self.valence.set_params(index, fc=fc)
-                for islave in master.slaves:
-                    self.valence.set_params(islave, fc=fc)
+            if len(term_indices)==0:
+                log.dump('All terms were removed from the hessian fit')
+                self.valence.dump_logger(print_level=logger_level)
+                return
+            for index in term_indices:
+                assert self.valence.terms[index].is_master()
+            self.valence.set_params_many(term_indices, fc=fcs)
+            self.valence.broadcast_master_params(term_indices, only='fc')
             self.valence.dump_logger(print_level=logger_level)
 
     def do_cross_init(self):
@@ -483,9 +872,13 @@ class BaseProgram(object):
         '''
         with log.section('VAL', 2, 'Initializing'):
             self.reset_system()
-            self.valence.init_cross_angle_terms()
-            if self.settings.do_cross_DSS or self.settings.do_cross_DSD or self.settings.do_cross_DAD or self.settings.do_cross_DAA:
-                self.valence.init_cross_dihed_terms()
+            key = self.valence.get_cache_key('cross')
+            if not self.valence.load_cache('cross', key):
+                start = len(self.valence.terms)
+                self.valence.init_cross_angle_terms()
+                if self.settings.do_cross_DSS or self.settings.do_cross_DSD or self.settings.do_cross_DAD or self.settings.do_cross_DAA:
+                    self.valence.init_cross_dihed_terms()
+                self.valence.dump_cache('cross', key, start)
             self.update_cross_pars()
 
     def update_cross_pars(self):
@@ -521,6 +914,7 @@ class BaseProgram(object):
                     cases.append(case)
 
             # Loop over all cases
+            masters = []
             for prefix, suffix, ntypes in cases:
                 # Loop over all cross terms belonging to this case
                 for term in self.valence.iter_masters('^%s/.*/%s$'%(prefix,suffix), use_re=True):
@@ -529,7 +923,8 @@ class BaseProgram(object):
                     rv0 = find_rest_value(term.diag_term_indexes[0])
                     rv1 = find_rest_value(term.diag_term_indexes[1])
                     self.valence.set_params(term.index, fc=0.0, rv0=rv0, rv1=rv1)
-                    for index in term.slaves: self.valence.set_params(index, fc=0.0, rv0=rv0, rv1=rv1)
+                    masters.append(term.index)
+            self.valence.broadcast_master_params(masters)
 
     def do_squarebend(self, thresshold=20*deg):
         '''
@@ -581,11 +976,12 @@ class BaseProgram(object):
                         ['HC_FC_DIAG'], ['kjmol', 'au']
                     )
                     self.valence.set_params(index, sign=-1)
-                    for traj in self.trajectories:
-                        if traj.term.index==index:
-                            traj.active = False
-                            traj.fc = None
-                            traj.rv = None
+                    self.projections.pop(index, None)
+                    traj = self.trajectory_index.get(index)
+                    if traj is not None:
+                        traj.active = False
+                        traj.fc = None
+                        traj.rv = None
 
     def do_bendclin(self, thresshold=5*deg):
         '''
@@ -616,11 +1012,12 @@ class BaseProgram(object):
                         ['HC_FC_DIAG'], ['kjmol', 'au']
                     )
                     self.valence.set_params(index, fc=0.0, sign=1.0)
-                    for traj in self.trajectories:
-                        if traj.term.index==index:
-                            traj.rv = None
-                            traj.fc = None
-                            traj.active = False
+                    self.projections.pop(index, None)
+                    traj = self.trajectory_index.get(index)
+                    if traj is not None:
+                        traj.rv = None
+                        traj.fc = None
+                        traj.active = False
 
     def do_sqoopdist_to_oopdist(self, thresshold=1e-4*angstrom):
         '''
@@ -667,7 +1064,10 @@ class MakeTrajectories(BaseProgram):
         with log.section('PROGRAM', 2):
             fn_traj = self.settings.fn_traj
             assert fn_traj is not None, 'It is useless to run the MakeTrajectories program without specifying a trajectory filename fn_traj!'
-            assert not os.path.isfile(fn_traj), 'Given file %s to store trajectories to already exists!' %fn_traj
+            #an existing HDF5 trajectory store is completed with the missing
+            #trajectories
+            if fn_traj.split('.')[-1] not in ['h5', 'hdf5']:
+                assert not os.path.isfile(fn_traj), 'Given file %s to store trajectories to already exists!' %fn_traj
             self.do_pt_generate()
 
 class PlotTrajectories(BaseProgram):
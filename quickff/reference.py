@@ -30,16 +30,119 @@ from yaff.pes.ff import ForceField, ForcePartValence, ForcePartPair
 from yaff.pes.ext import PairPotEI
 from yaff.pes.nlist import NeighborList
 from yaff.pes.scaling import Scalings
-from yaff.sampling.harmonic import estimate_cart_hessian
 
 from quickff.tools import global_translation, global_rotation
 from quickff.log import log
 
 from molmod.units import angstrom
 
-import numpy as np
+from collections import OrderedDict
+
+from scipy.linalg.blas import dspmv
+
+import numpy as np, hashlib, os, h5py as h5, multiprocessing
+
+__all__ = [
+    'SecondOrderTaylor', 'YaffForceField', 'CachedReference', 'get_ei_ff',
+    'estimate_fd_hessian',
+]
+
+
+def _update_hash(sha, value):
+    'Add a (numpy array) value to the given hashlib object'
+    if isinstance(value, np.ndarray):
+        sha.update(str(value.dtype).encode('utf-8'))
+        sha.update(np.ascontiguousarray(value).tobytes())
+    else:
+        sha.update(str(value).encode('utf-8'))
+
+
+#finite difference stencils as a list of (step, weight) tuples
+fd_stencils = {
+    2: [(1, 0.5), (-1, -0.5)],
+    4: [(2, -1.0/12), (1, 8.0/12), (-1, -8.0/12), (-2, 1.0/12)],
+}
+
+#state of the finite difference hessian that is inherited by the (forked)
+#worker processes, such that each worker holds its own copy of the force field
+_fd_state = {}
+
+def _fd_hessian_rows(dofs):
+    'Rows of the finite difference hessian for the given degrees of freedom'
+    ff, pos0, eps, stencil = _fd_state['ff'], _fd_state['pos0'], _fd_state['eps'], _fd_state['stencil']
+    rows = np.zeros([len(dofs), pos0.size], float)
+    gpos = np.zeros(pos0.shape, float)
+    for irow, dof in enumerate(dofs):
+        for step, weight in stencil:
+            pos = pos0.copy()
+            pos.reshape(-1)[dof] += step*eps
+            ff.update_pos(pos)
+            gpos[:] = 0.0
+            ff.compute(gpos=gpos)
+            rows[irow] += weight*gpos.reshape(-1)
+    return rows/eps
+
+def estimate_fd_hessian(ff, pos=None, eps=1e-4, stencil=2, nproc=1):
+    '''
+        Estimate the cartesian hessian of a Yaff force field by finite
+        differences of the gradient. The gradient evaluations of the
+        displaced geometries are independent and are distributed over a
+        pool of nproc worker processes, each holding its own copy of the
+        force field. The result is symmetrized. Returns a numpy array
+        [3N,3N].
+
+        **Arguments**
+
+        ff
+            a Yaff ForceField instance
+
+        **Optional Arguments**
 
-__all__ = ['SecondOrderTaylor', 'YaffForceField', 'get_ei_ff']
+        pos
+            the positions in which the hessian is computed, defaults to the
+            current positions of the force field system
+
+        eps
+            the magnitude of the cartesian displacements
+
+        stencil
+            the number of displaced geometries per degree of freedom, either
+            2 (central differences) or 4 (fourth order central differences)
+
+        nproc
+            the number of worker processes. Worker processes are forked and
+            the hessian is computed serially if forking is not supported by
+            the platform.
+    '''
+    if stencil not in fd_stencils:
+        raise ValueError('Finite difference stencil should be one of %s, got %s' %(str(sorted(fd_stencils.keys())), str(stencil)))
+    if pos is None:
+        pos = ff.system.pos
+    pos0 = np.array(pos, float)
+    ndof = pos0.size
+    ctx = None
+    if nproc>1:
+        try:
+            ctx = multiprocessing.get_context('fork')
+        except ValueError:
+            log.dump('Forking processes not supported, computing finite difference hessian serially')
+    chunks = np.array_split(np.arange(ndof), min(ndof, 4*nproc if ctx is not None else 1))
+    _fd_state.update(ff=ff, pos0=pos0, eps=eps, stencil=fd_stencils[stencil])
+    try:
+        if ctx is not None:
+            pool = ctx.Pool(int(nproc))
+            try:
+                rows = pool.map(_fd_hessian_rows, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            rows = [_fd_hessian_rows(chunk) for chunk in chunks]
+    finally:
+        _fd_state.clear()
+        ff.update_pos(pos0)
+    hess = np.concatenate(rows, axis=0)
+    return 0.5*(hess+hess.T)
 
 
 class Reference(object):
@@ -61,21 +164,88 @@ class Reference(object):
     def hessian(self, coords):
         raise NotImplementedError
 
+    def get_hash(self):
+        '''
+            Return a string identifying the definition of this reference,
+            i.e. two references with the same hash give the same energy,
+            gradient and hessian for the same positions. It is used to
+            store results of the reference on disk (see CachedReference).
+            Returns None if the reference cannot be identified, which is
+            the default.
+        '''
+        return None
+
+    def energy_many(self, coords):
+        '''
+            Compute the energy for a stack of positions given as a numpy
+            array [nframe,natom,3]. Returns a numpy array [nframe]. By
+            default, the energy of every frame is computed separately,
+            subclasses may implement a vectorized evaluation.
+        '''
+        return np.array([self.energy(pos) for pos in coords], float)
+
+    def gradient_many(self, coords):
+        '''
+            Compute the gradient for a stack of positions given as a numpy
+            array [nframe,natom,3]. Returns a numpy array [nframe,natom,3].
+        '''
+        return np.array([self.gradient(pos) for pos in coords], float).reshape(np.shape(coords))
+
+    def delta_energy(self, coords, coords0, tol=0.0):
+        '''
+            Compute the energy for the given positions, using the fact that
+            only atoms displaced more than tol with respect to the reference
+            positions coords0 need to be accounted for. By default, the full
+            energy is computed, subclasses may implement an incremental
+            evaluation.
+        '''
+        return self.energy(coords)
+
 
 class SecondOrderTaylor(Reference):
     '''
         Second-order Taylor expansion model, can be used for the ab initio input.
     '''
 
-    def __init__(self, name, coords=None, energy=0.0, grad=None, hess=None, pbc=[0,0,0]):
+    def __init__(self, name, coords=None, energy=0.0, grad=None, hess=None, pbc=[0,0,0], storage='full'):
+        '''
+            **Arguments**
+
+            name
+                a string identifying the reference
+
+            **Optional Arguments**
+
+            coords, energy, grad, hess
+                the positions in which the expansion is constructed and the
+                energy, gradient and hessian in those positions
+
+            pbc
+                the periodic boundary conditions, should be either all 0 or
+                all 1
+
+            storage
+                defines how the hessian is stored. If set to full, both the
+                original hessian (hess0) and the hessian from which the
+                translations and rotations have been projected out (phess0)
+                are stored. If set to symmetric, the original hessian is not
+                stored and phess0 is symmetrized. If set to packed, only the
+                upper triangle of the symmetrized phess0 is stored, which
+                halves the memory. Energies and gradients are then computed
+                with packed matrix-vector products and phess0 is only
+                unpacked (and cached) when it is explicitly requested, e.g.
+                by the hessian method.
+        '''
         log.dump('Initializing Second order taylor reference for %s' %name)
+        assert storage in ['full', 'symmetric', 'packed'], 'Invalid hessian storage %s' %storage
         self.coords0 = coords.copy()
         self.energy0 = energy
         self.grad0 = grad.copy()
-        self.hess0 = hess.copy()
         assert np.all(np.array(pbc)==pbc[0]) and pbc[0] in [0,1], "PBC should be either all 0 or all 1"
         self.pbc = pbc
-        self.phess0 = self._get_phess()
+        self.storage = storage
+        self.hess0 = None
+        self._set_hess(hess)
         super(SecondOrderTaylor, self).__init__(name)
 
     def update(self, coords=None, grad=None, hess=None, pbc=None):
@@ -95,36 +265,107 @@ class SecondOrderTaylor(Reference):
                 assert self.grad0.shape == grad.shape
             self.grad0 = grad
         if hess is not None:
+            ndof = np.prod(self.coords0.shape)
+            assert np.prod(hess.shape)==ndof**2
             if self.hess0 is not None:
                 assert self.hess0.shape == hess.shape
-            self.hess0 = hess
-            self.phess0 = self._get_phess()
+            self._set_hess(hess)
+
+    def _set_hess(self, hess):
+        'Store the hessian and its projection according to self.storage'
+        ndof = np.prod(self.coords0.shape)
+        phess = self._get_phess(np.asarray(hess, float).reshape([ndof, ndof]))
+        self._phess_unpacked = None
+        if self.storage=='full':
+            self.hess0 = hess.copy()
+            self._phess = phess
+            return
+        self.hess0 = None
+        phess += phess.T
+        phess *= 0.5
+        if self.storage=='packed':
+            self._phess = phess[np.triu_indices(ndof)]
+        else:
+            self._phess = phess
+
+    def _get_phess0(self):
+        natom = self.coords0.shape[0]
+        if self.storage=='packed':
+            if self._phess_unpacked is None:
+                ndof = 3*natom
+                iu = np.triu_indices(ndof)
+                phess = np.zeros([ndof, ndof], float)
+                phess[iu] = self._phess
+                phess.T[iu] = self._phess
+                self._phess_unpacked = phess
+            phess = self._phess_unpacked
+        else:
+            phess = self._phess
+        return phess.reshape([natom, 3, natom, 3])
 
-    def _get_phess(self):
+    phess0 = property(_get_phess0)
+
+    def __getstate__(self):
+        #the unpacked hessian is not transferred (e.g. to worker processes)
+        state = self.__dict__.copy()
+        state['_phess_unpacked'] = None
+        return state
+
+    def _dot_phess(self, dxs):
+        '''
+            Product of the projected hessian with a displacement vector [ndof]
+            or with each row of a stack of displacements [nframe,ndof]. For
+            packed storage, the packed BLAS routine dspmv is used such that
+            the hessian is never unpacked. The upper triangle in row-major
+            order, as stored in self._phess, equals the lower triangle in the
+            column-major packed format of BLAS.
+        '''
+        ndof = np.prod(self.coords0.shape)
+        if self.storage=='packed':
+            if dxs.ndim==1:
+                return dspmv(ndof, 1.0, self._phess, dxs, lower=1)
+            return np.array([dspmv(ndof, 1.0, self._phess, dx, lower=1) for dx in dxs]).reshape(dxs.shape)
+        if dxs.ndim==1:
+            return np.dot(self._phess.reshape([ndof,ndof]), dxs)
+        return np.dot(dxs, self._phess.reshape([ndof,ndof]))
+
+    def _get_phess(self, hess):
         '''
             Constuct a hessian from which the translational and rotational
-            degrees of freedom have been projected out.
+            degrees of freedom have been projected out. With V an orthonormal
+            basis of the (at most 6) trans-rot vectors and P=1-VV^T, the
+            projection PHP is computed as the low-rank update
+            H - V(V^T H) - (HV - V(V^T H V))V^T, which avoids constructing
+            the dense projector.
+
+            **Arguments**
+
+            hess
+                the hessian as a numpy array [3N,3N]
         '''
-        hess = self.hess0.copy().reshape([np.prod(self.coords0.shape), np.prod(self.coords0.shape)])
         VTx, VTy, VTz = global_translation(self.coords0)
         VRx, VRy, VRz = global_rotation(self.coords0)
         if np.all(np.array(self.pbc)==0):
             U, S, Vt = np.linalg.svd(
-                np.array([VTx, VTy, VTz, VRx, VRy, VRz]).transpose()
+                np.array([VTx, VTy, VTz, VRx, VRy, VRz]).transpose(),
+                full_matrices=False
             )
             nproj = len([s for s in S if s>1e-6])
             if nproj==5:
                 log.dump('Only 5 out of the 6 trans-rot vectors were linearly independent. If the molecule is not linear, something went wrong!')
             elif not nproj==6:
-                raise RuntimeError('Only %i of the 6 trans-rot vectors were linearly independent. Something went wrong!')
+                raise RuntimeError('Only %i of the 6 trans-rot vectors were linearly independent. Something went wrong!' %nproj)
         elif np.all(np.array(self.pbc)==1):
             U = np.linalg.svd(
-                np.array([VTx, VTy, VTz]).transpose()
+                np.array([VTx, VTy, VTz]).transpose(),
+                full_matrices=False
             )[0]
             nproj = 3
-        proj = np.dot(U[:, nproj:], U[:, nproj:].T)
-        PHP = np.dot(proj, np.dot(hess, proj))
-        return PHP.reshape([self.coords0.shape[0], 3, self.coords0.shape[0], 3])
+        V = U[:, :nproj]
+        HV = np.dot(hess, V)
+        VtH = np.dot(V.T, hess)
+        A = HV - np.dot(V, np.dot(V.T, HV))
+        return hess - np.dot(np.hstack([V, A]), np.vstack([VtH, V.T]))
 
     @classmethod
     def from_other_model(cls, model, coords0):
@@ -146,7 +387,7 @@ class SecondOrderTaylor(Reference):
         ndof = np.prod(self.coords0.shape)
         dx = (coords - self.coords0).reshape([ndof])
         energy = self.energy0 + np.dot(self.grad0.reshape([ndof]), dx)
-        energy += 0.5*np.dot(dx, np.dot(self.phess0.reshape([ndof,ndof]), dx))
+        energy += 0.5*np.dot(dx, self._dot_phess(dx))
         return energy
 
     def gradient(self, coords):
@@ -156,7 +397,7 @@ class SecondOrderTaylor(Reference):
         assert np.all(coords.shape==self.coords0.shape)
         ndof = np.prod(self.coords0.shape)
         dx = (coords - self.coords0).reshape([ndof])
-        grad = self.grad0.reshape([ndof]) + np.dot(self.phess0.reshape([ndof,ndof]), dx)
+        grad = self.grad0.reshape([ndof]) + self._dot_phess(dx)
         return grad.reshape(self.coords0.shape)
 
     def hessian(self, coords):
@@ -166,6 +407,43 @@ class SecondOrderTaylor(Reference):
         assert np.all(coords.shape==self.coords0.shape)
         return self.phess0.copy()
 
+    def get_hash(self):
+        sha = hashlib.sha1()
+        for value in [self.__class__.__name__, self.name, self.energy0, self.coords0, self.grad0, self._phess]:
+            _update_hash(sha, np.asarray(value) if not isinstance(value, str) else value)
+        return sha.hexdigest()
+
+    def _get_dxs(self, coords):
+        'Displacements of a stack of positions as a numpy array [nframe,ndof]'
+        coords = np.asarray(coords)
+        assert coords.shape[1:]==self.coords0.shape
+        ndof = np.prod(self.coords0.shape)
+        return (coords - self.coords0).reshape([len(coords), ndof])
+
+    def energy_many(self, coords):
+        '''
+            Compute the energy for a stack of positions given as a numpy
+            array [nframe,natom,3], using a single matrix product with the
+            hessian for all frames (or a packed product per frame for packed
+            storage).
+        '''
+        ndof = np.prod(self.coords0.shape)
+        dxs = self._get_dxs(coords)
+        hdxs = self._dot_phess(dxs)
+        return self.energy0 + np.dot(dxs, self.grad0.reshape([ndof])) + 0.5*(hdxs*dxs).sum(axis=1)
+
+    def gradient_many(self, coords):
+        '''
+            Compute the gradient for a stack of positions given as a numpy
+            array [nframe,natom,3], using a single matrix product with the
+            (symmetric) hessian for all frames (or a packed product per frame
+            for packed storage).
+        '''
+        ndof = np.prod(self.coords0.shape)
+        dxs = self._get_dxs(coords)
+        grads = self.grad0.reshape([ndof]) + self._dot_phess(dxs)
+        return grads.reshape((len(dxs),)+self.coords0.shape)
+
 
 class YaffForceField(Reference):
     '''
@@ -173,9 +451,28 @@ class YaffForceField(Reference):
         to account for non-covalent interactions or residual covalent
         interactions.
     '''
-    def __init__(self, name, ff):
+    def __init__(self, name, ff, fd_eps=1e-4, fd_stencil=2, fd_nproc=1):
+        '''
+            **Arguments**
+
+            name
+                a string identifying the reference
+
+            ff
+                a Yaff ForceField instance
+
+            **Optional Arguments**
+
+            fd_eps, fd_stencil, fd_nproc
+                the displacement, stencil and number of processes of the
+                finite difference hessian, see estimate_fd_hessian
+        '''
         log.dump('Initializing Yaff force field reference for %s' %name)
         self.ff = ff
+        self.fd_eps = fd_eps
+        self.fd_stencil = fd_stencil
+        self.fd_nproc = fd_nproc
+        self._delta_cache = None
         Reference.__init__(self, name)
 
     def energy(self, coords):
@@ -188,12 +485,280 @@ class YaffForceField(Reference):
         energy = self.ff.compute(gpos=gpos)
         return gpos.reshape(coords.shape)
 
+    def energy_many(self, coords):
+        energies = np.zeros(len(coords), float)
+        for i, pos in enumerate(coords):
+            self.ff.update_pos(pos.copy())
+            energies[i] = self.ff.compute()
+        return energies
+
+    def gradient_many(self, coords):
+        gposs = np.zeros(np.shape(coords), float)
+        for i, pos in enumerate(coords):
+            self.ff.update_pos(pos.copy())
+            self.ff.compute(gpos=gposs[i])
+        return gposs
+
     def hessian(self, coords):
-        self.ff.update_pos(coords.copy())
-        hess = estimate_cart_hessian(self.ff)
+        hess = estimate_fd_hessian(self.ff, pos=coords, eps=self.fd_eps, stencil=self.fd_stencil, nproc=self.fd_nproc)
         natoms = len(coords)
         return hess.reshape([natoms, 3, natoms, 3])
 
+    #attributes of the force parts, pair potentials and scalings that define
+    #the force field
+    hash_attributes = [
+        'rcut', 'alpha', 'gcut', 'dielectric', 'charges', 'radii', 'sigmas',
+        'epsilons', 'onlypaulis', 'r0', 'c6', 'amp_cross', 'b_cross',
+        'eps_cross', 'sig_cross', 'cn_cross', 'c6_cross', 'c8_cross',
+        'R_cross', 'c6_scale', 'c8_scale', 'bj_a', 'bj_b', 'scale1', 'scale2',
+        'scale3', 'scale4',
+    ]
+
+    def get_hash(self):
+        '''
+            The hash is computed from the atom numbers, atom types, charges,
+            radii, bonds and cell of the system and from the parameters of
+            every part of the force field, including the scaled pairs. For
+            valence parts, the full valence, internal coordinate and delta
+            tables are included.
+        '''
+        sha = hashlib.sha1()
+        _update_hash(sha, self.__class__.__name__)
+        _update_hash(sha, self.name)
+        _update_hash(sha, (self.fd_eps, self.fd_stencil))
+        system = self.ff.system
+        for attr in ['numbers', 'ffatype_ids', 'charges', 'radii', 'bonds']:
+            value = getattr(system, attr, None)
+            if value is not None:
+                _update_hash(sha, attr)
+                _update_hash(sha, np.asarray(value))
+        if system.cell.nvec>0:
+            _update_hash(sha, system.cell.rvecs)
+        for part in self.ff.parts:
+            _update_hash(sha, part.name)
+            for obj in [part, getattr(part, 'pair_pot', None), getattr(part, 'scalings', None)]:
+                if obj is None: continue
+                _update_hash(sha, getattr(obj, 'name', obj.__class__.__name__))
+                for attr in self.hash_attributes:
+                    value = getattr(obj, attr, None)
+                    if isinstance(value, (bool, int, float, str, np.ndarray)):
+                        _update_hash(sha, attr)
+                        _update_hash(sha, value)
+            #the scaled pairs depend on the bonds of the system
+            scalings = getattr(part, 'scalings', None)
+            if scalings is not None:
+                for field in ['a', 'b', 'scale', 'nbond']:
+                    _update_hash(sha, np.ascontiguousarray(scalings.stab[field]))
+            if isinstance(part, ForcePartValence):
+                tables = [
+                    (part.vlist.vtab[:part.vlist.nv], ['kind', 'par0', 'par1', 'par2', 'par3', 'par4', 'par5', 'ic0', 'ic1']),
+                    (part.iclist.ictab[:part.iclist.nic], ['kind', 'i0', 'sign0', 'i1', 'sign1', 'i2', 'sign2']),
+                    (part.dlist.deltas[:part.dlist.ndelta], ['i', 'j']),
+                ]
+                for table, fields in tables:
+                    for field in fields:
+                        _update_hash(sha, np.ascontiguousarray(table[field]))
+        return sha.hexdigest()
+
+    def delta_energy(self, coords, coords0, tol=0.0):
+        '''
+            Compute the energy for the given positions by only updating the
+            pair interactions of atoms displaced more than tol with respect to
+            the reference positions coords0. The energy of the reference
+            positions and its neighbor lists are cached. The cell images of
+            the pairs are kept fixed at those of the reference positions and
+            pairs outside the cutoff in the reference positions are not
+            considered. If the force field contains parts other than
+            ForcePartPair, the full energy is computed.
+
+            **Arguments**
+
+            coords
+                numpy array [natom,3] with the positions in which the energy
+                is computed
+
+            coords0
+                numpy array [natom,3] with the reference positions
+
+            **Optional Arguments**
+
+            tol
+                atoms displaced less than tol with respect to coords0 are
+                considered fixed.
+        '''
+        cache = self._get_delta_cache(coords0)
+        if cache is None:
+            return self.energy(coords)
+        energy = cache['energy']
+        moved = np.where(np.sqrt(((coords-coords0)**2).sum(axis=1))>tol)[0]
+        if len(moved)==0: return energy
+        for part, neighs0, shifts, rows in cache['pairs']:
+            irows = np.unique(np.concatenate([rows[i] for i in moved]))
+            if len(irows)==0: continue
+            old = neighs0[irows]
+            new = old.copy()
+            deltas = coords[new['b']] - coords[new['a']] + shifts[irows]
+            new['dx'] = deltas[:,0]
+            new['dy'] = deltas[:,1]
+            new['dz'] = deltas[:,2]
+            new['d'] = np.sqrt((deltas**2).sum(axis=1))
+            stab = part.scalings.stab
+            energy += part.pair_pot.compute(new, stab, None, None, len(new))
+            energy -= part.pair_pot.compute(old, stab, None, None, len(old))
+        return energy
+
+    def _get_delta_cache(self, coords0):
+        '''
+            Return the cache for delta_energy with reference positions
+            coords0, or None if the force field does not support an
+            incremental evaluation.
+        '''
+        if not all([isinstance(part, ForcePartPair) for part in self.ff.parts]):
+            return None
+        cache = self._delta_cache
+        if cache is not None and np.array_equal(cache['coords0'], coords0):
+            return cache
+        energy = self.energy(coords0)
+        natom = len(coords0)
+        pairs = []
+        for part in self.ff.parts:
+            nneigh = part.nlist.nneigh
+            neighs0 = part.nlist.neighs[:nneigh].copy()
+            #the cell image of each pair is fixed to that of the reference
+            deltas0 = np.array([neighs0['dx'], neighs0['dy'], neighs0['dz']]).T
+            shifts = deltas0 - (coords0[neighs0['b']] - coords0[neighs0['a']])
+            #for each atom, the (ordered) rows of the pairs it is involved in
+            atoms = np.concatenate([neighs0['a'], neighs0['b']])
+            irows = np.concatenate([np.arange(nneigh), np.arange(nneigh)])
+            order = np.argsort(atoms, kind='mergesort')
+            bounds = np.searchsorted(atoms[order], np.arange(natom+1))
+            rows = [irows[order[bounds[i]:bounds[i+1]]] for i in range(natom)]
+            pairs.append((part, neighs0, shifts, rows))
+        self._delta_cache = {'coords0': coords0.copy(), 'energy': energy, 'pairs': pairs}
+        return self._delta_cache
+
+
+class CachedReference(Reference):
+    '''
+        A wrapper around a Reference instance that memoizes its energies,
+        gradients and hessians. Results are keyed on a hash of the positions
+        and of the definition of the reference (see Reference.get_hash) and
+        kept in memory in a least recently used (LRU) cache. Optionally, the
+        results are also stored in HDF5 files in a cache directory, such
+        that identical results are computed only once per project. All
+        other attributes are taken from the wrapped reference.
+    '''
+    def __init__(self, ref, maxsize=8, dn_cache=None):
+        '''
+            **Arguments**
+
+            ref
+                the Reference instance of which the results are cached
+
+            **Optional Arguments**
+
+            maxsize
+                the maximum number of results kept in memory
+
+            dn_cache
+                a directory in which the results are stored in an HDF5 file
+                per reference definition. If None, the results are only
+                cached in memory. Results are not stored on disk if the
+                reference does not define a hash. Only this instance writes
+                to the disk cache, copies transferred to other processes
+                (e.g. scoop workers) only read from it. A cache file that
+                can not be read (e.g. because it is locked by another
+                process) is treated as a cache miss.
+        '''
+        self.ref = ref
+        self.maxsize = maxsize
+        self.dn_cache = dn_cache
+        self.readonly = False
+        self.definition = ref.get_hash()
+        self._cache = OrderedDict()
+        Reference.__init__(self, ref.name)
+
+    def __getattr__(self, attr):
+        #only called for attributes that are not found on the wrapper itself
+        ref = self.__dict__.get('ref')
+        if ref is None:
+            raise AttributeError(attr)
+        return getattr(ref, attr)
+
+    def __getstate__(self):
+        #the in-memory results are not transferred (e.g. to worker processes)
+        #and the transferred copies do not write to the disk cache, as
+        #concurrent writes to the same HDF5 file would fail or corrupt it
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        state['readonly'] = True
+        return state
+
+    def get_hash(self):
+        return self.definition
+
+    def _get_fn(self):
+        if self.dn_cache is None or self.definition is None: return None
+        return os.path.join(self.dn_cache, '%s.h5' %self.definition)
+
+    def _get_key(self, kind, coords):
+        sha = hashlib.sha1()
+        _update_hash(sha, kind)
+        _update_hash(sha, np.asarray(coords, float))
+        return sha.hexdigest()
+
+    def _get(self, kind, coords, compute):
+        '''
+            Return the result of the given kind for the given positions from
+            the memory cache, the disk cache or by computing it.
+        '''
+        key = self._get_key(kind, coords)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key].copy()
+        fn = self._get_fn()
+        value = None
+        if fn is not None and os.path.isfile(fn):
+            try:
+                with h5.File(fn, 'r') as f:
+                    if '%s/%s' %(kind, key) in f:
+                        value = np.array(f[kind][key])
+            except (IOError, OSError, KeyError):
+                value = None
+        if value is None:
+            value = np.asarray(compute(coords), float)
+            if fn is not None and not self.readonly:
+                try:
+                    if not os.path.isdir(self.dn_cache):
+                        os.makedirs(self.dn_cache)
+                    with h5.File(fn, 'a') as f:
+                        if '%s/%s' %(kind, key) not in f:
+                            f.require_group(kind).create_dataset(key, data=value)
+                except (IOError, OSError):
+                    log.dump('Could not write %s to the reference cache %s' %(kind, fn))
+        self._cache[key] = value
+        while len(self._cache)>self.maxsize:
+            self._cache.popitem(last=False)
+        return value.copy()
+
+    def energy(self, coords):
+        return float(self._get('energy', coords, self.ref.energy))
+
+    def gradient(self, coords):
+        return self._get('gradient', coords, self.ref.gradient)
+
+    def hessian(self, coords):
+        return self._get('hessian', coords, self.ref.hessian)
+
+    def energy_many(self, coords):
+        return self._get('energy_many', coords, self.ref.energy_many)
+
+    def gradient_many(self, coords):
+        return self._get('gradient_many', coords, self.ref.gradient_many)
+
+    def delta_energy(self, coords, coords0, tol=0.0):
+        return self.ref.delta_energy(coords, coords0, tol=tol)
+
 
 def get_ei_ff(name, system, charges, scales, radii=None, average=True, pbc=[0,0,0]):
     '''
@@ -233,7 +233,10 @@ def qff_parse_args(args=None):
         '--fn-traj', default=None,
         help='Read/write the perturbation trajectories from/to FN_TRAJ. If the '
              'given file exists, the trajectories are read from the file. '
-             'Otherwise, the trajectories are written to the given file.'
+             'Otherwise, the trajectories are written to the given file. '
+             'If FN_TRAJ has the .h5 extension, every trajectory is written as '
+             'soon as it is constructed and an existing file is completed with '
+             'the missing trajectories.'
     )
     settings.add_argument(
         '--only-traj', default=None,
@@ -405,11 +408,15 @@ def qff(args=None):
         if settings.do_hess_negfreq_proj:
             log.dump('Projecting negative frequencies out of the mass-weighted hessian.')
             with log.section('SYS', 3, 'Initializing'):
-                hess = project_negative_freqs(hess, system.masses)
+                hess = project_negative_freqs(hess, system.masses, partial=True)
         #construct ab initio reference
-        ai = SecondOrderTaylor('ai', coords=system.pos.copy(), energy=energy, grad=grad, hess=hess, pbc=pbc)
+        ai = SecondOrderTaylor('ai', coords=system.pos.copy(), energy=energy, grad=grad, hess=hess, pbc=pbc, storage=settings.hess_storage.lower())
         #detect a priori defined contributions to the force field
         refs = []
+        fd_kwargs = {
+            'fd_eps': settings.fd_hess_eps, 'fd_stencil': settings.fd_hess_stencil,
+            'fd_nproc': settings.fd_hess_nproc,
+        }
         if settings.ei is not None:
             if rvecs is None:
                 if settings.ei_rcut is None:
@@ -423,13 +430,13 @@ def qff(args=None):
                 else:
                     rcut = settings.ei_rcut
                 ff = ForceField.generate(system, settings.ei, rcut=rcut, alpha_scale=3.2, gcut_scale=1.5, smooth_ei=True)
-            refs.append(YaffForceField('EI', ff))
+            refs.append(YaffForceField('EI', ff, **fd_kwargs))
         if settings.vdw is not None:
             ff = ForceField.generate(system, settings.vdw, rcut=settings.vdw_rcut)
-            refs.append(YaffForceField('vdW', ff))
+            refs.append(YaffForceField('vdW', ff, **fd_kwargs))
         if settings.covres is not None:
             ff = ForceField.generate(system, settings.covres)
-            refs.append(YaffForceField('Cov res', ff))
+            refs.append(YaffForceField('Cov res', ff, **fd_kwargs))
     #define quickff program
     assert settings.program_mode in allowed_programs, \
         'Given program mode %s not allowed. Choose one of %s' %(
@@ -28,7 +28,7 @@ from __future__ import print_function, absolute_import
 from io import IOBase
 from quickff.log import log
 from molmod.units import parse_unit
-import os
+import os, numbers
 
 __all__  = ['Settings']
 
@@ -54,6 +54,26 @@ def is_float(key, value):
         raise IOError('Setting for key %s should be of type float. Got %s.' %(key, str(value)))
 
 
+def is_int(key, value):
+    if value is None: return
+    if isinstance(value, bool) or not isinstance(value, numbers.Integral):
+        raise IOError('Setting for key %s should be of type int. Got %s.' %(key, str(value)))
+
+
+def has_int_value(values):
+    def check(key, value):
+        if value is None: return
+        if value not in values:
+            raise IOError('Setting for key %s should be one of %s. Got %s' %(key, str(values), str(value)))
+    return check
+
+
+def is_positive(key, value):
+    if value is None: return
+    if not value>0:
+        raise IOError('Setting for key %s should be positive. Got %s.' %(key, str(value)))
+
+
 def is_bool(key, value):
     if not isinstance(value, bool):
         raise IOError('Setting for key %s should be of type bool. Got %s.' %(key, str(value)))
@@ -95,8 +115,13 @@ key_checks = {
     'fn_charmm22_psf'       : [is_string, is_nonexisting_file_name],
     'fn_sys'                : [is_string, is_nonexisting_file_name],
     'plot_traj'             : [is_string, has_value(['None', 'Final', 'All'])],
+    'plot_traj_pdf'         : [is_bool],
+    'plot_traj_nproc'       : [is_int, is_positive],
     'xyz_traj'              : [is_bool],
+    'xyz_traj_archive'      : [is_string, has_value(['extxyz', 'h5'])],
     'fn_traj'               : [is_string],
+    'fn_valence_cache'      : [is_string],
+    'dn_ref_cache'          : [is_string],
     'log_level'             : [is_not_none, is_string, has_value(['silent','low','medium','high','highest'])],
     'log_file'              : [is_string, is_nonexisting_file_name],
     'program_mode'          : [is_not_none, has_value(['DeriveFF','MakeTrajectories','PlotTrajectories'])],
@@ -107,16 +132,28 @@ key_checks = {
     'vdw'                   : [is_string, is_existing_file_name],
     'vdw_rcut'              : [is_float],
     'covres'                : [is_string, is_existing_file_name],
+    'fd_hess_eps'           : [is_not_none, is_float],
+    'fd_hess_stencil'       : [is_not_none, is_int, has_int_value([2, 4])],
+    'fd_hess_nproc'         : [is_not_none, is_int, is_positive],
     'excl_bonds'            : [is_list_strings],
     'excl_bends'            : [is_list_strings],
     'excl_dihs'             : [is_list_strings],
     'excl_oopds'            : [is_list_strings],
     'do_hess_mass_weighting': [is_bool],
     'do_hess_negfreq_proj'  : [is_bool],
+    'hess_storage'          : [is_not_none, is_string, has_value(['full', 'symmetric', 'packed'])],
     'do_cross_svd'          : [is_bool],
     'cross_svd_rcond'       : [is_float],
+    'cross_prune_tol'       : [is_float],
     'pert_traj_tol'         : [is_float],
     'pert_traj_energy_noise': [is_float],
+    'pert_traj_delta_tol'   : [is_float],
+    'pert_traj_compress_tol': [is_float],
+    'pert_traj_single_precision': [is_bool],
+    'pert_traj_slaves'      : [is_float],
+    'do_pt_projection'      : [is_bool],
+    'do_symmetry'           : [is_bool],
+    'symmetry_tol'          : [is_float],
     'do_bonds'              : [is_bool],
     'do_bends'              : [is_bool],
     'do_dihedrals'          : [is_bool],
@@ -220,7 +257,7 @@ class Settings(object):
 
     def _set_suffix(self, suffix):
         for key, fn in self.__dict__.items():
-            if fn is None or not key.startswith('fn_') or key=='fn_traj': continue
+            if fn is None or not key.startswith('fn_') or key in ['fn_traj', 'fn_valence_cache']: continue
             prefix, extension = fn.split('.')
             self.__dict__[key] = '%s%s.%s' %(prefix, suffix, extension)
 
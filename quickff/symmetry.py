@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+# QuickFF is a code to quickly derive accurate force fields from ab initio input.
+# Copyright (C) 2012 - 2018 Louis Vanduyfhuys <Louis.Vanduyfhuys@UGent.be>
+# Steven Vandenbrande <Steven.Vandenbrande@UGent.be>,
+# Jelle Wieme <Jelle.Wieme@UGent.be>,
+# Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center for Molecular Modeling
+# (CMM), Ghent University, Ghent, Belgium; all rights reserved unless otherwise
+# stated.
+#
+# This file is part of QuickFF.
+#
+# QuickFF is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# QuickFF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+from __future__ import absolute_import
+
+from molmod.units import angstrom
+
+from quickff.log import log
+
+import numpy as np
+
+__all__ = ['Symmetry']
+
+
+class Symmetry(object):
+    '''
+        Class to detect which valence terms are equivalent by symmetry. Two
+        terms are equivalent if there is a permutation of the atoms that
+        is an automorphism of the bond graph (respecting atom numbers and
+        atom types), that preserves all interatomic distances and that
+        maps the internal coordinates of the first term onto those of the
+        second term. Such a permutation corresponds to an isometry of the
+        geometry, of which the rotational part is stored together with
+        the permutation. Quantities computed for one term of an orbit of
+        equivalent terms can then be transferred to all others.
+    '''
+    #internal coordinates that change sign under an improper rotation
+    signed_ic_kinds = [4, 8, 10]
+
+    def __init__(self, system, pos=None, tol=0.01*angstrom):
+        '''
+            **Arguments**
+
+            system
+                a Yaff `System` instance defining the bond graph, atom types
+                and cell
+
+            **Optional Arguments**
+
+            pos
+                a (N,3) numpy array with the geometry for which the symmetry
+                is detected, defaults to the positions of the system
+
+            tol
+                tolerance on the interatomic distances and on the mapped
+                bond vectors
+        '''
+        self.system = system
+        if pos is None: pos = system.pos
+        self.pos = pos.copy()
+        self.tol = tol
+        self.natom = system.natom
+        self.neighs = [sorted(system.neighs1[i]) for i in range(self.natom)]
+        self.classes = self._get_atom_classes()
+        self.permutations = []
+        self.rotations = []
+
+    def _get_atom_classes(self):
+        '''
+            Partition the atoms in classes by iteratively refining the
+            atom number and atom type with the classes of the bonded
+            neighbors (Weisfeiler-Lehman refinement). Atoms in different
+            classes can never be mapped onto each other.
+        '''
+        if self.system.ffatype_ids is not None:
+            labels = list(zip(self.system.numbers, self.system.ffatype_ids))
+        else:
+            labels = list(self.system.numbers)
+        classes = self._relabel(labels)
+        for iteration in range(self.natom):
+            labels = [
+                (classes[i], tuple(sorted(classes[j] for j in self.neighs[i])))
+                for i in range(self.natom)
+            ]
+            new = self._relabel(labels)
+            if new.max()==classes.max():
+                break
+            classes = new
+        return classes
+
+    @staticmethod
+    def _relabel(labels):
+        'Replace the given hashable labels by consecutive integers'
+        keys = dict((label, i) for i, label in enumerate(sorted(set(labels))))
+        return np.array([keys[label] for label in labels], int)
+
+    def _mic(self, deltas):
+        'Apply the minimum image convention to a (M,3) array of vectors'
+        cell = self.system.cell
+        if cell.nvec==0: return deltas
+        frac = np.dot(deltas, cell.gvecs.T)
+        return deltas - np.dot(np.round(frac), cell.rvecs)
+
+    def _dists(self, i, atoms):
+        'Distances between atom i and the given atoms'
+        return np.linalg.norm(self._mic(self.pos[atoms]-self.pos[i]), axis=1)
+
+    def _get_order(self, seeds):
+        '''
+            Order in which the atoms are assigned: breadth-first over the
+            bond graph starting from the seeds, so that each atom (except
+            the first of every disconnected fragment) has an assigned
+            neighbor when it is visited.
+        '''
+        visited = np.zeros(self.natom, bool)
+        visited[seeds] = True
+        order = []
+        queue = list(seeds)
+        start = 0
+        while True:
+            while len(queue)>0:
+                i = queue.pop(0)
+                for j in self.neighs[i]:
+                    if not visited[j]:
+                        visited[j] = True
+                        order.append(j)
+                        queue.append(j)
+            while start<self.natom and visited[start]:
+                start += 1
+            if start==self.natom:
+                break
+            visited[start] = True
+            order.append(start)
+            queue.append(start)
+        return order
+
+    def _get_candidates(self, i, perm, inv):
+        'Images allowed for atom i given the current partial permutation'
+        mapped = [perm[j] for j in self.neighs[i] if perm[j]>=0]
+        if len(mapped)>0:
+            cands = set(self.neighs[mapped[0]])
+            for j in mapped[1:]:
+                cands.intersection_update(self.neighs[j])
+        else:
+            cands = np.where(self.classes==self.classes[i])[0]
+        cands = [
+            j for j in sorted(cands) if inv[j]<0
+            and self.classes[j]==self.classes[i]
+            and len(self.neighs[j])==len(self.neighs[i])
+        ]
+        assigned = np.where(perm>=0)[0]
+        if len(cands)==0 or len(assigned)==0:
+            return cands
+        d0 = self._dists(i, assigned)
+        return [
+            j for j in cands
+            if (abs(self._dists(j, perm[assigned])-d0)<self.tol).all()
+        ]
+
+    def find_permutation(self, atoms0, atoms1):
+        '''
+            Find a distance preserving automorphism of the bond graph that
+            maps the atoms in atoms0 onto those in atoms1 (in the given
+            order). Returns the permutation as an integer array p such that
+            atom i is mapped on atom p[i], or None if no such permutation
+            exists.
+
+            **Arguments**
+
+            atoms0, atoms1
+                lists of atom indexes of equal length
+        '''
+        if len(atoms0)!=len(atoms1): return None
+        perm = -np.ones(self.natom, int)
+        inv = -np.ones(self.natom, int)
+        for a, b in zip(atoms0, atoms1):
+            if self.classes[a]!=self.classes[b]: return None
+            if (perm[a]>=0 and perm[a]!=b) or (inv[b]>=0 and inv[b]!=a):
+                return None
+            perm[a] = b
+            inv[b] = a
+        seeds = sorted(set(atoms0))
+        for a in seeds:
+            if not (abs(self._dists(a, seeds)-self._dists(perm[a], perm[seeds]))<self.tol).all():
+                return None
+        #depth-first search over the remaining atoms, the candidate lists
+        #of each level are kept to allow backtracking
+        order = self._get_order(seeds)
+        cands = [None]*len(order)
+        level = 0
+        while 0<=level<len(order):
+            i = order[level]
+            if cands[level] is None:
+                cands[level] = self._get_candidates(i, perm, inv)
+            else:
+                inv[perm[i]] = -1
+                perm[i] = -1
+            if len(cands[level])>0:
+                j = cands[level].pop(0)
+                perm[i] = j
+                inv[j] = i
+                level += 1
+            else:
+                cands[level] = None
+                level -= 1
+        if level<0: return None
+        return perm
+
+    def get_rotation(self, perm):
+        '''
+            Compute the orthogonal matrix R that maps the bond vectors
+            onto the bond vectors of the permuted atoms. Returns None if the
+            mapped vectors deviate more than the tolerance. The matrix can
+            be an improper rotation.
+
+            **Arguments**
+
+            perm
+                an integer array representing an atom permutation
+        '''
+        bonds = self.system.bonds
+        if bonds is not None and len(bonds)>0:
+            v0 = self._mic(self.pos[bonds[:,1]]-self.pos[bonds[:,0]])
+            v1 = self._mic(self.pos[perm[bonds[:,1]]]-self.pos[perm[bonds[:,0]]])
+        else:
+            v0 = self.pos - self.pos.mean(axis=0)
+            v1 = self.pos[perm] - self.pos[perm].mean(axis=0)
+        U, S, Vt = np.linalg.svd(np.dot(v0.T, v1))
+        rot = np.dot(Vt.T, U.T)
+        if not (np.linalg.norm(np.dot(v0, rot.T)-v1, axis=1)<self.tol).all():
+            return None
+        return rot
+
+    def _maps_term(self, term0, term1, perm, rot):
+        '''
+            Check if the permutation maps every internal coordinate of
+            term0 on the corresponding internal coordinate of term1.
+        '''
+        if len(term0.ics)!=len(term1.ics): return False
+        for ic0, ic1 in zip(term0.ics, term1.ics):
+            if ic0.kind!=ic1.kind: return False
+            atoms0 = set(perm[a] for pair in ic0.index_pairs for a in pair)
+            atoms1 = set(a for pair in ic1.index_pairs for a in pair)
+            if atoms0!=atoms1: return False
+            if ic0.kind in self.signed_ic_kinds and np.linalg.det(rot)<0:
+                return False
+        return True
+
+    def map_term(self, term0, term1):
+        '''
+            Find an atom permutation and corresponding rotation that map
+            term0 onto term1. Permutations found earlier are tried first.
+            Returns a tuple (perm, rot) or None if the terms are not
+            equivalent.
+
+            **Arguments**
+
+            term0, term1
+                instances of the Term class
+        '''
+        if term0.kind!=term1.kind: return None
+        atoms0 = term0.get_atoms()
+        atoms1 = term1.get_atoms()
+        if len(self.permutations)>0:
+            perms = np.array(self.permutations)
+            for k in np.where((perms[:,atoms0]==atoms1).all(axis=1))[0]:
+                if self._maps_term(term0, term1, perms[k], self.rotations[k]):
+                    return perms[k], self.rotations[k]
+        for seeds in [atoms1, atoms1[::-1]]:
+            perm = self.find_permutation(atoms0, seeds)
+            if perm is None: continue
+            rot = self.get_rotation(perm)
+            if rot is None: continue
+            self.permutations.append(perm)
+            self.rotations.append(rot)
+            if self._maps_term(term0, term1, perm, rot):
+                return perm, rot
+        return None
+
+    def get_orbits(self, terms):
+        '''
+            Partition the given terms in orbits of equivalent terms. Only
+            terms with the same master can be equivalent. Returns a
+            dictionary mapping each term index on a tuple (rep, perm, rot)
+            with rep the index of the representative term of its orbit and
+            (perm, rot) the mapping of the representative onto the term.
+            For representatives, perm and rot are None.
+
+            **Arguments**
+
+            terms
+                list of Term instances
+        '''
+        orbits = {}
+        reps = {}
+        for term in terms:
+            mapping = None
+            for rep in reps.get(term.master, []):
+                mapping = self.map_term(rep, term)
+                if mapping is not None:
+                    orbits[term.index] = (rep.index,)+tuple(mapping)
+                    break
+            if mapping is None:
+                reps.setdefault(term.master, []).append(term)
+                orbits[term.index] = (term.index, None, None)
+        nrep = sum(len(group) for group in reps.values())
+        log.dump('Found %i symmetry unique terms out of %i terms' %(nrep, len(terms)))
+        return orbits
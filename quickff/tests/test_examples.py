@@ -25,6 +25,7 @@
 #--
 import numpy as np
 import os
+import pickle
 
 from molmod.units import *
 from molmod.constants import lightspeed
@@ -34,9 +35,12 @@ from yaff import System
 
 from quickff.tools import set_ffatypes
 from quickff.program import DeriveFF
+from quickff.perturbation import Trajectory, plot_trajectory_data, render_trajectory_plots
 from quickff.settings import Settings
 from quickff.context import context
-from quickff.reference import SecondOrderTaylor
+from quickff.reference import SecondOrderTaylor, get_ei_ff
+from quickff.paracontext import paracontext
+from quickff.io import TrajectoryStore, dump_trajectories_extxyz, read_trajectory
 
 from common import log, read_system, tmpdir
 
@@ -72,6 +76,259 @@ def test_h2():
     assert abs(rv_hc/rv_pt-1.0) < 1e-6
 
 
+def test_h2_projection():
+    #for H2, the projection of the hessian on the bond is exact and no
+    #perturbation trajectory should be required
+    r0 = 0.7442380*angstrom
+    freq = (2*np.pi)*4416.65640485*lightspeed/centimeter
+    mass = pt['H'].mass/2 #reduced mass for the H2 stretch mode
+    with log.section('NOSETST', 2):
+        system, ai = read_system('H2/gaussian.fchk')
+        set_ffatypes(system, 'low')
+        program = DeriveFF(system, ai, Settings(do_pt_projection=True))
+        program.do_pt_generate()
+        assert len(program.trajectories)==0
+        assert list(program.projections.keys())==[0]
+        program.do_pt_estimate()
+        K_hp, rv_hp = program.valence.get_params(0, only='all')
+    assert abs(K_hp/(mass*freq**2)-1.0) < 1e-3
+    assert abs(rv_hp/r0-1.0) < 1e-3
+
+
+def test_trajectory_store():
+    #trajectories stored in (and lazily read from) an HDF5 trajectory store
+    #should give the same estimates as the ones in memory
+    with log.section('NOSETST', 2):
+        system, ai = read_system('water/gaussian.fchk')
+        set_ffatypes(system, 'low')
+        with tmpdir('test_trajectory_store') as dn:
+            fn_traj = os.path.join(dn, 'trajectories.h5')
+            program = DeriveFF(system, ai, Settings(fn_traj=fn_traj, pert_traj_compress_tol=1e-6*angstrom))
+            program.do_pt_generate()
+            program.do_pt_estimate()
+            pars = [program.valence.get_params(i) for i in range(len(program.valence.terms))]
+            ntraj = len(program.trajectories)
+            #second run only reads the trajectories from the store
+            program = DeriveFF(system, ai, Settings(fn_traj=fn_traj, pert_traj_compress_tol=1e-6*angstrom))
+            program.do_pt_generate()
+            assert len(program.trajectories)==ntraj
+            program.do_pt_estimate()
+            for i in range(len(program.valence.terms)):
+                assert np.allclose(program.valence.get_params(i), pars[i])
+
+
+def test_trajectory_store_symmetry():
+    #with symmetry detection, each representative trajectory is written to
+    #the store together with its equivalent trajectories as soon as it is
+    #generated, the results should match the trajectories in memory
+    with log.section('NOSETST', 2):
+        system, ai = read_system('water/gaussian.fchk')
+        set_ffatypes(system, 'low')
+        program = DeriveFF(system, ai, Settings(do_symmetry=True))
+        program.do_pt_generate()
+        refs = dict(
+            (TrajectoryStore.get_key(traj.term), traj)
+            for traj in program.trajectories if traj is not None
+        )
+        writes = []
+        extend = TrajectoryStore.extend
+        def logged_extend(store, trajectories):
+            trajectories = list(trajectories)
+            writes.append([TrajectoryStore.get_key(traj.term) for traj in trajectories])
+            extend(store, trajectories)
+        with tmpdir('test_trajectory_store_symmetry') as dn:
+            fn_traj = os.path.join(dn, 'trajectories.h5')
+            TrajectoryStore.extend = logged_extend
+            try:
+                program = DeriveFF(system, ai, Settings(do_symmetry=True, fn_traj=fn_traj))
+                program.do_pt_generate()
+            finally:
+                TrajectoryStore.extend = extend
+            #one write per orbit, the two OH bonds of water are equivalent
+            assert sorted(sum(writes, []))==sorted(refs.keys())
+            assert len(writes)<len(refs) and max(len(keys) for keys in writes)>1
+            for traj in program.trajectories:
+                ref = refs[TrajectoryStore.get_key(traj.term)]
+                assert np.allclose(traj.values, ref.values)
+                assert abs(traj.coords-ref.coords).max()<1e-8*angstrom
+
+
+def test_trajectory_archive():
+    #frames of a single trajectory read from the extended XYZ and HDF5
+    #archives should match the generated trajectory
+    with log.section('NOSETST', 2):
+        system, ai = read_system('water/gaussian.fchk')
+        set_ffatypes(system, 'low')
+        program = DeriveFF(system, ai, Settings())
+        program.do_pt_generate()
+        with tmpdir('test_trajectory_archive') as dn:
+            fn_xyz = os.path.join(dn, 'trajectories.xyz')
+            fn_h5 = os.path.join(dn, 'trajectories.h5')
+            dump_trajectories_extxyz(program.trajectories, fn_xyz)
+            TrajectoryStore(fn_h5).extend(program.trajectories)
+            for traj in program.trajectories:
+                key = TrajectoryStore.get_key(traj.term)
+                for fn in [fn_xyz, fn_h5]:
+                    values, coords = read_trajectory(fn, key)
+                    assert np.allclose(values, traj.values)
+                    assert abs(coords-traj.coords).max()<1e-8*angstrom
+
+
+def test_pt_estimate_parallel():
+    #in parallel runs, the function and arguments of paracontext.map are
+    #pickled and sent to the workers, which is emulated here with a map that
+    #pickles all its arguments. The results should match the serial run.
+    def pickling_map(fn, args, **kwargs):
+        fn, args, kwargs = pickle.loads(pickle.dumps((fn, list(args), kwargs)))
+        return [fn(arg, **kwargs) for arg in args]
+    with log.section('NOSETST', 2):
+        system, ai = read_system('water/gaussian.fchk')
+        set_ffatypes(system, 'low')
+        ffrefs = [get_ei_ff('EI', system, system.charges.copy(), [0.0, 1.0, 1.0, 1.0])]
+        program = DeriveFF(system, ai, Settings(), ffrefs=ffrefs)
+        program.do_pt_generate()
+        for do_valence in [False, True]:
+            vtab = program.valence.vlist.vtab.copy()
+            program.do_pt_estimate(do_valence=do_valence)
+            serial = [(traj.fc, traj.rv) for traj in program.trajectories]
+            program.valence.vlist.vtab[:] = vtab
+            paracontext.map = pickling_map
+            try:
+                program.do_pt_estimate(do_valence=do_valence)
+            finally:
+                paracontext.use_stub()
+            for traj, (fc, rv) in zip(program.trajectories, serial):
+                assert abs(traj.fc-fc)<=1e-9*abs(fc)
+                assert abs(traj.rv-rv)<=1e-9*abs(rv)
+
+
+def test_plot_trajectories():
+    #the plot data is computed in the current process, the figures are
+    #rendered as separate png files (possibly in parallel) or as pdf pages
+    with log.section('NOSETST', 2):
+        system, ai = read_system('water/gaussian.fchk')
+        set_ffatypes(system, 'low')
+        ffrefs = [get_ei_ff('EI', system, system.charges.copy(), [0.0, 1.0, 1.0, 1.0])]
+        program = DeriveFF(system, ai, Settings(), ffrefs=ffrefs)
+        program.do_pt_generate()
+        program.do_pt_estimate()
+    traj = program.trajectories[0]
+    vtab = program.valence.vlist.vtab.copy()
+    data = traj.get_plot_data(ai, ffrefs=program.ffrefs, valence=program.valence)
+    assert (program.valence.vlist.vtab==vtab).all()
+    assert [name for name, ys, kwargs in data['curves']]==['AI ref', 'EI', 'Residual Valence', 'PT Term', 'Total FF']
+    curves = dict((name, ys) for name, ys, kwargs in data['curves'])
+    assert np.allclose(curves['AI ref'], ai.energy_many(traj.coords))
+    assert np.allclose(curves['EI'], program.ffrefs[0].energy_many(traj.coords))
+    assert np.allclose(curves['Total FF'], curves['EI']+curves['Residual Valence']+curves['PT Term'])
+    with tmpdir('test_plot_trajectories') as dn:
+        fn = os.path.join(dn, 'trajectory.png')
+        plot_trajectory_data(data, fn=fn)
+        assert os.path.isfile(fn)
+        cwd = os.getcwd()
+        os.chdir(dn)
+        try:
+            datas = [traj.get_plot_data(ai) for traj in program.trajectories]
+            render_trajectory_plots(datas, nproc=2, suffix='_test')
+            for d in datas:
+                assert os.path.isfile('trajectory-%s-%i_test.png' %(d['basename'].replace('/', '-'), d['index']))
+            program.settings.set('plot_traj_pdf', True)
+            program.plot_trajectories(suffix='_test')
+            assert os.path.getsize('trajectories_test.pdf')>0
+        finally:
+            os.chdir(cwd)
+
+
+def test_select_pt_terms():
+    #selection of the terms with a perturbation trajectory by number or
+    #fraction, the master is always selected
+    with log.section('NOSETST', 2):
+        system, ai = read_system('ethanol/gaussian.fchk')
+        set_ffatypes(system, 'low')
+        program = DeriveFF(system, ai, Settings())
+    terms = [term for term in program.valence.terms if term.kind in [0,2,11,12]]
+    groups = {}
+    for term in terms:
+        groups.setdefault(term.master, []).append(term)
+    assert max(len(group) for group in groups.values())>2
+    assert any(len(set(program._get_term_environment(term) for term in group))>1 for group in groups.values())
+    assert program.select_pt_terms(terms)==terms
+    for nsample, get_nkeep in [
+            (2, lambda n: min(n, 2)),
+            (0.5, lambda n: int(np.ceil(0.5*n))),
+            (1e-3, lambda n: 1)]:
+        program.settings.set('pert_traj_slaves', nsample)
+        selected = program.select_pt_terms(terms)
+        assert selected==program.select_pt_terms(terms)
+        for master, group in groups.items():
+            chosen = [term for term in selected if term.master==master]
+            nkeep = get_nkeep(len(group))
+            assert master in [term.index for term in chosen]
+            assert len(chosen)==nkeep
+            #the selected terms are spread over distinct environments, e.g.
+            #the CH bonds of the CH3 and the CH2 group
+            envs = set(program._get_term_environment(term) for term in group)
+            chosen_envs = set(program._get_term_environment(term) for term in chosen)
+            assert len(chosen_envs)==min(nkeep, len(envs))
+
+
+def test_fill_unsampled_pars():
+    #terms without perturbation trajectory get the mean parameters of the
+    #sampled terms of the same master
+    with log.section('NOSETST', 2):
+        system, ai = read_system('ethanol/gaussian.fchk')
+        set_ffatypes(system, 'low')
+        program = DeriveFF(system, ai, Settings(pert_traj_slaves=2))
+        program.do_pt_generate()
+        program.do_pt_estimate()
+    nfilled = 0
+    for master in program.valence.iter_masters():
+        if master.kind not in [0,2,11,12]: continue
+        indexes = [master.index] + master.slaves
+        trajs = [program.trajectory_index.get(index) for index in indexes]
+        sampled = [traj for traj in trajs if traj is not None and traj.active]
+        assert 0<len(sampled)<=2
+        fc = np.mean([traj.fc for traj in sampled])
+        rv = np.mean([traj.rv for traj in sampled])
+        for index, traj in zip(indexes, trajs):
+            if traj is not None: continue
+            assert abs(program.valence.get_params(index, only='fc')-fc)<=1e-9*abs(fc)
+            assert abs(program.valence.get_params(index, only='rv')-rv)<=1e-9*abs(rv)
+            nfilled += 1
+    assert nfilled>0
+
+
+def test_trajectory_compress():
+    #the coordinates rebuilt from compressed trajectories should match the
+    #uncompressed coordinates within the tolerance
+    with log.section('NOSETST', 2):
+        system, ai = read_system('water/gaussian.fchk')
+        set_ffatypes(system, 'low')
+        program = DeriveFF(system, ai, Settings())
+        program.do_pt_generate()
+    pos0 = program.perturbation.get_reference_pos()
+    tol = 1e-3*angstrom
+    for traj in program.trajectories:
+        coords = traj.coords.copy()
+        for single_precision in [False, True]:
+            traj.coords = coords.copy()
+            traj.compress(pos0, tol=tol, single_precision=single_precision)
+            assert traj._coords is None
+            if single_precision:
+                assert traj._disps.dtype==np.float32
+            assert traj.coords.shape==coords.shape
+            assert abs(traj.coords-coords).max()<tol+1e-6*angstrom
+            #in-place changes to the rebuilt coordinates are not allowed
+            assert not traj.coords.flags.writeable
+        #trajectories pickled before the compact storage was introduced
+        state = dict((key, value) for key, value in traj.__dict__.items() if key not in ['_coords', '_pos0', '_atoms', '_disps', '_store'])
+        state['coords'] = coords
+        old = Trajectory.__new__(Trajectory)
+        old.__setstate__(state)
+        assert old._store is None and old._disps is None
+        assert (old.coords==coords).all()
+
+
 def test_output_charmm22():
     with log.section('NOSETST', 2):
         system, ai = read_system('ethanol/gaussian.fchk')
@@ -25,11 +25,17 @@
 #--
 from molmod.units import angstrom, kjmol
 
-from common import log, read_system
+from common import log, read_system, tmpdir
+
+from quickff.reference import get_ei_ff, SecondOrderTaylor, CachedReference
+from quickff.tools import set_ffatypes, project_negative_freqs
+
+from yaff import System
+from yaff.sampling.harmonic import estimate_cart_hessian
 
 from nose import SkipTest
 
-import numpy as np
+import numpy as np, os, copy
 
 def do_taylor(name, ntests=10, eps=1e-4, gtol=1e-3*kjmol/angstrom, htol=1e-3*kjmol/angstrom**2):
     with log.section('NOSETST', 2):
@@ -84,3 +90,178 @@ def test_taylor_amoniak():
 
 def test_taylor_benzene():
     do_taylor('benzene/gaussian.fchk')
+
+
+def do_ei_delta_energy(name, ntests=10):
+    with log.section('NOSETST', 2):
+        system, ai = read_system(name)
+        set_ffatypes(system, 'high')
+        ff = get_ei_ff('EI', system, system.charges.copy(), [1.0, 1.0, 1.0, 1.0])
+    coords0 = system.pos.copy()
+    for i in range(ntests):
+        coords = coords0.copy()
+        iatom = np.random.randint(len(coords0))
+        coords[iatom] += np.random.normal(0.0, 0.1, [3])*angstrom
+        assert abs(ff.delta_energy(coords, coords0, tol=0.0)-ff.energy(coords))<1e-9*kjmol
+        coords += np.random.normal(0.0, 1e-6, coords.shape)*angstrom
+        assert abs(ff.delta_energy(coords, coords0, tol=1e-4*angstrom)-ff.energy(coords))<1e-3*kjmol
+
+def test_ei_delta_energy_water():
+    do_ei_delta_energy('water/gaussian.fchk')
+
+def test_ei_delta_energy_ethanol():
+    do_ei_delta_energy('ethanol/gaussian.fchk')
+
+
+def do_many(name, nframes=5):
+    with log.section('NOSETST', 2):
+        system, ai = read_system(name)
+        set_ffatypes(system, 'high')
+        ff = get_ei_ff('EI', system, system.charges.copy(), [1.0, 1.0, 1.0, 1.0])
+    coords = system.pos + np.random.normal(0.0, 0.1, (nframes,)+system.pos.shape)*angstrom
+    for ref in [ai, ff]:
+        energies = ref.energy_many(coords)
+        grads = ref.gradient_many(coords)
+        assert energies.shape==(nframes,) and grads.shape==coords.shape
+        for pos, energy, grad in zip(coords, energies, grads):
+            assert abs(energy-ref.energy(pos))<1e-9*kjmol
+            assert abs(grad-ref.gradient(pos)).max()<1e-9*kjmol/angstrom
+
+def test_many_water():
+    do_many('water/gaussian.fchk')
+
+def test_many_ethanol():
+    do_many('ethanol/gaussian.fchk')
+
+
+def do_hess_storage(name, nframes=5):
+    with log.section('NOSETST', 2):
+        system, ai = read_system(name)
+    hess = ai.hess0.reshape([3*system.natom, 3*system.natom])
+    hess = 0.5*(hess+hess.T)
+    coords = system.pos + np.random.normal(0.0, 0.1, (nframes,)+system.pos.shape)*angstrom
+    refs = [
+        SecondOrderTaylor('ai', coords=ai.coords0, energy=ai.energy0, grad=ai.grad0, hess=hess, pbc=ai.pbc, storage=storage)
+        for storage in ['full', 'symmetric', 'packed']
+    ]
+    assert refs[0].hess0 is not None
+    assert refs[1].hess0 is None and refs[2].hess0 is None
+    #energies and gradients do not unpack the packed hessian
+    for ref in refs[1:]:
+        assert np.allclose(ref.energy_many(coords), refs[0].energy_many(coords))
+        assert np.allclose(ref.gradient_many(coords), refs[0].gradient_many(coords))
+        assert np.allclose(ref.energy(coords[0]), refs[0].energy(coords[0]))
+        assert np.allclose(ref.gradient(coords[0]), refs[0].gradient(coords[0]))
+    assert refs[2]._phess_unpacked is None
+    #the projected hessian has no translational components
+    phess = refs[0].phess0.reshape(hess.shape)
+    trans = np.zeros([system.natom, 3])
+    trans[:,0] = 1.0
+    assert abs(np.dot(phess, trans.ravel())).max()<1e-6*abs(phess).max()
+    for ref in refs[1:]:
+        assert abs(ref.phess0-refs[0].phess0).max()<1e-9*abs(phess).max()
+    #the unpacked hessian is cached
+    assert refs[2]._phess_unpacked is not None
+    assert np.shares_memory(refs[2].phess0, refs[2]._phess_unpacked)
+
+def test_hess_storage_water():
+    do_hess_storage('water/gaussian.fchk')
+
+def test_hess_storage_ethanol():
+    do_hess_storage('ethanol/gaussian.fchk')
+
+
+def do_negfreq_proj(name):
+    with log.section('NOSETST', 2):
+        system, ai = read_system(name)
+        #shift the spectrum to make sure there are negative frequencies
+        hess = ai.hess0.copy().reshape([3*system.natom, 3*system.natom])
+        hess -= 0.1*np.diag(np.repeat(system.masses, 3))*abs(hess).max()/system.masses.max()
+        full = project_negative_freqs(hess, system.masses)
+        partial = project_negative_freqs(hess, system.masses, partial=True)
+    assert abs(full-partial).max()<1e-9*abs(full).max()
+    sqrt_masses = np.sqrt(np.repeat(system.masses, 3))
+    matrix = full.reshape(hess.shape)/sqrt_masses[:,None]/sqrt_masses[None,:]
+    assert np.linalg.eigvalsh(matrix).min()>-1e-9*abs(matrix).max()
+
+def test_negfreq_proj_water():
+    do_negfreq_proj('water/gaussian.fchk')
+
+def test_negfreq_proj_ethanol():
+    do_negfreq_proj('ethanol/gaussian.fchk')
+
+
+def do_cached_reference(name):
+    with log.section('NOSETST', 2):
+        system, ai = read_system(name)
+        set_ffatypes(system, 'high')
+        ff = get_ei_ff('EI', system, system.charges.copy(), [1.0, 1.0, 1.0, 1.0])
+    coords0 = system.pos.copy()
+    assert ff.get_hash()==ff.get_hash()
+    assert ai.get_hash()!=ff.get_hash()
+    #force fields that only differ in the bonds of the system (and hence in
+    #the scaled pairs) have a different hash
+    other_system = System(
+        system.numbers, system.pos, ffatypes=system.ffatypes,
+        ffatype_ids=system.ffatype_ids, bonds=system.bonds[1:],
+        charges=system.charges, radii=system.radii
+    )
+    other_ff = get_ei_ff('EI', other_system, system.charges.copy(), [1.0, 1.0, 1.0, 1.0])
+    assert other_ff.get_hash()!=ff.get_hash()
+    with tmpdir('test_cached_reference') as dn:
+        cached = CachedReference(ff, maxsize=2, dn_cache=dn)
+        hess = cached.hessian(coords0)
+        assert abs(hess-ff.hessian(coords0)).max()<1e-9*abs(hess).max()
+        assert os.path.isfile(os.path.join(dn, '%s.h5' %ff.get_hash()))
+        #a new cache with the same directory reads the hessian from disk
+        other = CachedReference(ff, dn_cache=dn)
+        assert (other.hessian(coords0)==hess).all()
+        #only the most recently used results are kept in memory
+        for i in range(3):
+            coords = coords0 + np.random.normal(0.0, 0.1, coords0.shape)*angstrom
+            assert abs(cached.energy(coords)-ff.energy(coords))<1e-9*kjmol
+        assert len(cached._cache)==2
+        #other attributes are taken from the wrapped reference
+        assert cached.ff is ff and cached.name==ff.name
+    with tmpdir('test_cached_reference') as dn:
+        #copies transferred to worker processes (which uses the same state
+        #as a shallow copy) do not write to disk
+        cached = CachedReference(ff, dn_cache=dn)
+        worker = copy.copy(cached)
+        assert worker.readonly and not cached.readonly
+        worker.hessian(coords0)
+        assert not os.path.isfile(os.path.join(dn, '%s.h5' %ff.get_hash()))
+        #an unreadable cache file is treated as a cache miss
+        with open(os.path.join(dn, '%s.h5' %ff.get_hash()), 'w') as f:
+            f.write('corrupt')
+        assert abs(cached.hessian(coords0)-hess).max()<1e-9*abs(hess).max()
+
+def test_cached_reference_water():
+    do_cached_reference('water/gaussian.fchk')
+
+def test_cached_reference_ethanol():
+    do_cached_reference('ethanol/gaussian.fchk')
+
+
+def do_fd_hessian(name):
+    with log.section('NOSETST', 2):
+        system, ai = read_system(name)
+        set_ffatypes(system, 'high')
+        ff = get_ei_ff('EI', system, system.charges.copy(), [1.0, 1.0, 1.0, 1.0])
+    coords = system.pos.copy()
+    ff.ff.update_pos(coords)
+    natom = len(coords)
+    ref = estimate_cart_hessian(ff.ff).reshape([natom, 3, natom, 3])
+    htol = 1e-6*abs(ref).max()
+    assert abs(ff.hessian(coords)-ref).max()<htol
+    ff.fd_nproc = 2
+    assert abs(ff.hessian(coords)-ref).max()<htol
+    ff.fd_stencil = 4
+    assert abs(ff.hessian(coords)-ref).max()<1e-3*abs(ref).max()
+    assert (ff.ff.system.pos==coords).all()
+
+def test_fd_hessian_water():
+    do_fd_hessian('water/gaussian.fchk')
+
+def test_fd_hessian_ethanol():
+    do_fd_hessian('ethanol/gaussian.fchk')
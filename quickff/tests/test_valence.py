@@ -24,15 +24,19 @@
 #
 #--
 from molmod.units import angstrom, kjmol, rad, deg
-from molmod.ic import _dihed_angle_low, dihed_angle
+from molmod.ic import _dihed_angle_low, dihed_angle, bend_angle
 
 from quickff.valence import ValenceFF
 from quickff.settings import Settings
 from quickff.tools import set_ffatypes
+from quickff.symmetry import Symmetry
+from quickff.topology import Topology
+from quickff.cost import HessianFCCost
+from quickff.tools import term_sort_atypes
 
 from itertools import permutations
 
-from common import log, read_system
+from common import log, read_system, tmpdir
 
 import numpy as np
 
@@ -355,3 +359,391 @@ def test_hessian_dihedrals_benzene():
 
 def test_hessian_oops_benzene():
     check_hessian_oops('benzene/gaussian.fchk')
+
+
+def check_delta_energy(name):
+    with log.section('NOSETST', 2):
+        system, ref = read_system(name)
+        set_ffatypes(system, 'highest')
+        valence = ValenceFF(system, Settings())
+    for term in valence.iter_terms():
+        valence.set_params(term.index, fc=np.random.uniform(low=100, high=1000)*kjmol)
+    pos0 = system.pos.copy()
+    for iatom in range(len(system.numbers)):
+        pos = pos0.copy()
+        pos[iatom] += np.random.normal(0.0, 0.05, [3])*angstrom
+        #with all other atoms fixed, the delta energy is exact
+        assert abs(valence.calc_delta_energy(pos, pos0, tol=0.0)-valence.calc_energy(pos))<1e-9*kjmol
+        #small displacements of all other atoms are neglected within tol
+        pos += np.random.normal(0.0, 1e-6, pos.shape)*angstrom
+        assert abs(valence.calc_delta_energy(pos, pos0, tol=1e-4*angstrom)-valence.calc_energy(pos))<1e-3*kjmol
+        assert abs(valence.calc_delta_energy(pos, pos0, tol=0.0)-valence.calc_energy(pos))<1e-9*kjmol
+    #in the reference positions, the cached reference energy is returned
+    assert abs(valence.calc_energy(pos0)-valence.calc_delta_energy(pos0, pos0))<1e-9*kjmol
+    del system, valence
+
+def test_delta_energy_water():
+    check_delta_energy('water/gaussian.fchk')
+
+def test_delta_energy_ethanol():
+    check_delta_energy('ethanol/gaussian.fchk')
+
+
+def check_calc_energy_pure(name):
+    with log.section('NOSETST', 2):
+        system, ref = read_system(name)
+        set_ffatypes(system, 'highest')
+        valence = ValenceFF(system, Settings())
+    for term in valence.iter_terms():
+        valence.set_params(term.index, fc=np.random.uniform(low=100, high=1000)*kjmol)
+    pos0 = system.pos.copy()
+    ictab = valence.iclist.ictab.copy()
+    vtab0 = valence.vlist.vtab.copy()
+    pos = pos0 + np.random.normal(0.0, 0.05, pos0.shape)*angstrom
+    energy = valence.calc_energy(pos)
+    #switching off a term in a private copy of the parameters
+    vtab = valence.get_vtab()
+    valence.set_params(0, fc=0.0, vtab=vtab)
+    energy0 = valence.calc_energy(pos, vtab=vtab)
+    assert abs(valence.calc_delta_energy(pos, pos0, vtab=vtab)-energy0)<1e-9*kjmol
+    #neither the system nor the tables of the force field are altered
+    assert (system.pos==pos0).all()
+    assert (valence.iclist.ictab['value']==ictab['value']).all()
+    for key in ['par0', 'par1', 'energy']:
+        assert (valence.vlist.vtab[key]==vtab0[key]).all()
+    #the difference is the energy of the switched off term
+    valence.set_params(0, fc=0.0)
+    assert abs(valence.calc_energy(pos)-energy0)<1e-9*kjmol
+    assert energy!=energy0
+    del system, valence
+
+def test_calc_energy_pure_water():
+    check_calc_energy_pure('water/gaussian.fchk')
+
+def test_calc_energy_pure_ethanol():
+    check_calc_energy_pure('ethanol/gaussian.fchk')
+
+
+def check_engine(name, do_cross=False, **kwargs):
+    with log.section('NOSETST', 2):
+        system, ref = read_system(name)
+        set_ffatypes(system, 'highest')
+        valence = ValenceFF(system, Settings(**kwargs))
+        if do_cross:
+            valence.init_cross_angle_terms()
+            valence.init_cross_dihed_terms()
+    pos0 = system.pos.copy()
+    if do_cross:
+        #rest values of the cross terms in the reference geometry
+        valence.dlist.forward()
+        valence.iclist.forward()
+        values = valence.iclist.ictab['value']
+        vtab = valence.vlist.vtab
+        crosses = [term.index for term in valence.iter_terms() if term.kind==3]
+        valence.set_params_many(crosses, rv0=values[vtab['ic0'][crosses]], rv1=values[vtab['ic1'][crosses]])
+    for term in valence.iter_terms():
+        valence.set_params(term.index, fc=np.random.uniform(low=100, high=1000)*kjmol)
+    coords = pos0 + np.random.normal(0.0, 0.05, (7,)+pos0.shape)*angstrom
+    energies, term_energies, gpos = valence.get_engine().compute(coords, do_gradient=True)
+    for pos, energy, eterms, g in zip(coords, energies, term_energies, gpos):
+        #compare with the Yaff valence lists
+        system.pos[:] = pos
+        valence.dlist.forward()
+        valence.iclist.forward()
+        gref = np.zeros(pos.shape, float)
+        eref = valence.compute(gpos=gref)
+        assert abs(energy-eref)<1e-9*kjmol
+        assert np.allclose(eterms, valence.vlist.vtab['energy'][:valence.vlist.nv], atol=1e-9*kjmol)
+        assert abs(g-gref).max()<1e-6*kjmol/angstrom
+    system.pos[:] = pos0
+    del system, valence
+
+def test_engine_water():
+    check_engine('water/gaussian.fchk')
+
+def test_engine_ethanol():
+    check_engine('ethanol/gaussian.fchk')
+
+def test_engine_benzene():
+    check_engine('benzene/gaussian.fchk')
+
+def test_engine_cross_ethanol():
+    check_engine('ethanol/gaussian.fchk', do_cross=True, do_cross_DSD=True, do_cross_DAD=True)
+
+def test_engine_cross_benzene():
+    check_engine('benzene/gaussian.fchk', do_cross=True, do_cross_DSD=True, do_cross_DAD=True)
+
+
+def check_symmetric_hessian(name):
+    with log.section('NOSETST', 2):
+        system, ref = read_system(name)
+        set_ffatypes(system, 'high')
+        valence = ValenceFF(system, Settings())
+    for term in valence.iter_masters():
+        valence.set_params(term.index, fc=np.random.uniform(low=100, high=1000)*kjmol)
+    symmetry = Symmetry(system)
+    for master in valence.iter_masters():
+        valence.symmetry = None
+        hfull = valence.get_hessian_contrib(master.index)
+        valence.symmetry = symmetry
+        hsym = valence.get_hessian_contrib(master.index)
+        assert np.abs(hsym-hfull).max()<1e-3*np.abs(hfull).max()
+    #all bonds of benzene-like molecules are equivalent per master
+    terms = [term for term in valence.iter_terms('BONDHARM')]
+    orbits = symmetry.get_orbits(terms)
+    nrep = len(set(rep for rep, perm, rot in orbits.values()))
+    assert nrep==len(set(term.master for term in terms))
+    del system, valence
+
+def test_symmetric_hessian_methane():
+    check_symmetric_hessian('methane/gaussian.fchk')
+
+def test_symmetric_hessian_benzene():
+    check_symmetric_hessian('benzene/gaussian.fchk')
+
+
+def check_add_terms(name):
+    with log.section('NOSETST', 2):
+        system, ref = read_system(name)
+        set_ffatypes(system, 'high')
+        valence = ValenceFF(system, Settings())
+    #every basename has a single master, registered in valence.masters
+    for term in valence.iter_terms():
+        master = valence.terms[term.master]
+        assert master.is_master()
+        assert master.basename==term.basename
+        assert valence.masters[term.basename]==master.index
+        if not term.is_master():
+            assert term.index in master.slaves
+    #bulk registration gives the same vtab rows as adding term by term
+    from yaff.pes.vlist import Harmonic
+    from yaff.pes.iclist import Bond
+    bonds = [[Bond(*bond)] for bond in system.iter_bonds()]
+    nv = valence.vlist.nv
+    for ics in bonds:
+        valence.add_term(Harmonic, ics, 'TEST/bond', ['PT_ALL'], ['kjmol/A**2', 'A'])
+    terms = valence.add_terms(Harmonic, bonds, 'TEST/bond', ['PT_ALL'], ['kjmol/A**2', 'A'])
+    n = len(bonds)
+    vtab = valence.vlist.vtab
+    for key in ['kind', 'ic0', 'ic1', 'par2', 'par3', 'par4', 'par5']:
+        assert (vtab[key][nv:nv+n]==vtab[key][nv+n:nv+2*n]).all()
+    assert np.isnan(vtab['par0'][nv+n:nv+2*n]).all()
+    master = valence.terms[valence.masters['TEST/bond']]
+    assert master.index==nv
+    assert master.slaves==list(range(nv+1, nv+2*n))
+    assert [term.index for term in terms]==list(range(nv+n, nv+2*n))
+    del system, valence
+
+def test_add_terms_water():
+    check_add_terms('water/gaussian.fchk')
+
+def test_add_terms_ethanol():
+    check_add_terms('ethanol/gaussian.fchk')
+
+
+def check_label_matching(name):
+    with log.section('NOSETST', 2):
+        system, ref = read_system(name)
+        set_ffatypes(system, 'high')
+        valence = ValenceFF(system, Settings())
+    #lookup of masters by atom types equals the regular expression scan
+    for master in valence.iter_masters():
+        types = master.basename.split('/')[-1].split('.')
+        label = '^.*/'+'\.'.join(types)+'$'
+        ref = [term.index for term in valence.iter_masters(label, use_re=True)]
+        assert [term.index for term in valence.iter_masters_by_types(types)]==ref
+        assert master.index in ref
+    #exclusion matching, the second pass uses the cached results
+    excl = valence.get_exclusion_matcher('H.*,^O')
+    assert valence.get_exclusion_matcher('H.*,^O') is excl
+    for master in valence.iter_masters():
+        types = master.basename.split('/')[-1]
+        for i in range(2):
+            assert excl.match(types)==(types.upper().startswith('H') or types.upper().startswith('O'))
+    assert valence.get_exclusion_matcher(None) is None
+    del system, valence
+
+def test_label_matching_water():
+    check_label_matching('water/gaussian.fchk')
+
+def test_label_matching_ethanol():
+    check_label_matching('ethanol/gaussian.fchk')
+
+
+def check_topology(name):
+    with log.section('NOSETST', 2):
+        system, ref = read_system(name)
+        set_ffatypes(system, 'high')
+    topology = Topology(system)
+    ffatypes = [system.ffatypes[fid] for fid in system.ffatype_ids]
+    for kind, iterator, indexes in [
+            ('angle', system.iter_angles, topology.angles),
+            ('dihedral', system.iter_dihedrals, topology.dihedrals),
+            ('opdist', system.iter_oops, topology.oops)]:
+        #same patterns in the same order as the System iterators
+        patterns = [tuple(pattern) for pattern in iterator()]
+        assert patterns==[tuple(row) for row in indexes.tolist()]
+        #same sorting and grouping as term_sort_atypes
+        sorted_indexes = topology.sort_atypes(indexes, kind)
+        groups = {}
+        for pattern in patterns:
+            pattern, types = term_sort_atypes(ffatypes, pattern, kind)
+            groups.setdefault(types, []).append(pattern)
+        result = topology.group_by_types(sorted_indexes)
+        assert [types for types, rows in result]==list(groups.keys())
+        for types, rows in result:
+            assert [tuple(row) for row in sorted_indexes[rows].tolist()]==groups[types]
+    #vectorized geometry
+    angles = topology.angles
+    for angle, value in zip(angles, topology.bend_angles(angles)):
+        assert abs(value-bend_angle(system.pos[angle])[0])<1e-8
+    diheds = topology.dihedrals
+    for dihed, value in zip(diheds, topology.dihed_angles(diheds)):
+        #signed angles, compared modulo 2pi for (near) trans dihedrals
+        delta = value-dihed_angle(system.pos[dihed])[0]
+        assert abs((delta+np.pi)%(2*np.pi)-np.pi)<1e-8
+
+def test_topology_ethanol():
+    check_topology('ethanol/gaussian.fchk')
+
+def test_topology_benzene():
+    check_topology('benzene/gaussian.fchk')
+
+
+def check_term_table(name):
+    with log.section('NOSETST', 2):
+        system, ref = read_system(name)
+        set_ffatypes(system, 'high')
+        valence = ValenceFF(system, Settings())
+    table = valence.get_term_table()
+    assert len(table)==len(valence.terms)
+    for term, row in zip(valence.iter_terms(), table):
+        assert row['kind']==term.kind
+        assert row['master']==term.master
+        assert valence.basenames[row['basename']]==term.basename
+        atoms = term.get_atoms()
+        assert (row['atoms'][:len(atoms)]==atoms).all()
+        assert (row['atoms'][len(atoms):]==-1).all()
+        #basenames are shared between master and slaves
+        assert term.basename is valence.terms[term.master].basename
+    assert table['nslave'].sum()+(table['master']==table['index']).sum()==len(table)
+    #terms can be pickled and keep their cached atoms consistent
+    import pickle
+    for term in valence.iter_terms():
+        other = pickle.loads(pickle.dumps(term))
+        assert other.get_atoms()==term.get_atoms()
+        assert other.basename==term.basename and other.slaves==term.slaves
+    del system, valence
+
+def test_term_table_water():
+    check_term_table('water/gaussian.fchk')
+
+def test_term_table_ethanol():
+    check_term_table('ethanol/gaussian.fchk')
+
+
+def check_params_many(name):
+    with log.section('NOSETST', 2):
+        system, ref = read_system(name)
+        set_ffatypes(system, 'high')
+        valence = ValenceFF(system, Settings())
+    indexes = np.array([term.index for term in valence.iter_terms()])
+    fcs = np.random.uniform(low=100, high=1000, size=len(indexes))*kjmol
+    rvs = np.random.uniform(low=0.5, high=2.0, size=len(indexes))
+    vtab = valence.get_vtab()
+    valence.set_params_many(indexes, fc=fcs, rv0=rvs, vtab=vtab)
+    for index, fc, rv in zip(indexes, fcs, rvs):
+        valence.set_params(index, fc=fc, rv0=rv)
+    for i in range(6):
+        key = 'par%i' %i
+        assert np.allclose(vtab[key], valence.vlist.vtab[key][:len(vtab)], equal_nan=True)
+    assert np.allclose(
+        valence.get_params_many(indexes, only='fc'),
+        [valence.get_params(index, only='fc') for index in indexes]
+    )
+    #broadcast the force constants of the masters to their slaves
+    valence.broadcast_master_params(only='fc')
+    for term in valence.iter_terms():
+        assert valence.get_params(term.index, only='fc')==valence.get_params(term.master, only='fc')
+    del system, valence
+
+def test_params_many_water():
+    check_params_many('water/gaussian.fchk')
+
+def test_params_many_ethanol():
+    check_params_many('ethanol/gaussian.fchk')
+
+
+def check_valence_cache(name):
+    with log.section('NOSETST', 2):
+        system, ref = read_system(name)
+        set_ffatypes(system, 'high')
+        with tmpdir('test_valence_cache') as dn:
+            settings = Settings(fn_valence_cache='%s/valence.pkl' %dn)
+            valence = ValenceFF(system, settings)
+            key = valence.get_cache_key('init')
+            cached = ValenceFF(system, settings)
+            #a different geometry invalidates the cache
+            system.pos[0] += 0.1*angstrom
+            assert valence.get_cache_key('init')!=key
+            system.pos[0] -= 0.1*angstrom
+    assert len(cached.terms)==len(valence.terms)
+    for term, other in zip(valence.iter_terms(), cached.iter_terms()):
+        assert term.basename==other.basename and term.kind==other.kind
+        assert term.get_atoms()==other.get_atoms()
+        assert term.master==other.master and term.slaves==other.slaves
+    nv = valence.vlist.nv
+    assert cached.vlist.nv==nv
+    for key in ['kind', 'par0', 'par1', 'par2', 'par3', 'par4', 'par5']:
+        assert np.allclose(cached.vlist.vtab[key][:nv], valence.vlist.vtab[key][:nv], equal_nan=True)
+    assert (cached.vlist.vtab['ic0'][:nv]==valence.vlist.vtab['ic0'][:nv]).all()
+    assert (cached.vlist.vtab['ic1'][:nv]==valence.vlist.vtab['ic1'][:nv]).all()
+    del system, valence, cached
+
+def test_valence_cache_water():
+    check_valence_cache('water/gaussian.fchk')
+
+def test_valence_cache_ethanol():
+    check_valence_cache('ethanol/gaussian.fchk')
+
+
+def check_cost_screening(name):
+    with log.section('NOSETST', 2):
+        system, ai = read_system(name)
+        set_ffatypes(system, 'high')
+        valence = ValenceFF(system, Settings(do_dihedrals=False, do_oops=False))
+        valence.init_cross_angle_terms()
+    valence.dlist.forward()
+    valence.iclist.forward()
+    vtab = valence.vlist.vtab
+    values = valence.iclist.ictab['value']
+    crosses = [term.index for term in valence.iter_terms() if term.kind==3]
+    others = [term.index for term in valence.iter_terms() if term.kind!=3]
+    valence.set_params_many(crosses, rv0=values[vtab['ic0'][crosses]], rv1=values[vtab['ic1'][crosses]])
+    valence.set_params_many(others, rv0=values[vtab['ic0'][others]])
+    masters = [term.index for term in valence.iter_masters()]
+    crosses = [index for index in masters if index in crosses]
+    full = HessianFCCost(system, ai, valence, masters)
+    assert full.screened==[] and full.fit_indices==masters
+    #screen with the median of the contributions of the cross terms to the
+    #residual hessian after fitting all other terms
+    icrosses = [masters.index(index) for index in crosses]
+    iothers = [i for i, index in enumerate(masters) if index not in crosses]
+    diagonal = HessianFCCost(system, ai, valence, [masters[i] for i in iothers])
+    Bres = full.B[icrosses] - np.dot(full.A[np.ix_(icrosses, iothers)], diagonal.estimate())
+    diag = np.diag(full.A)[icrosses]
+    contribs = full._contributions(abs(Bres)/diag, diag)
+    tol = np.median(contribs)
+    screened = HessianFCCost(system, ai, valence, masters, screen_indices=crosses, screen_tol=tol)
+    expected = [index for index, contrib in zip(crosses, contribs) if contrib<tol]
+    assert len(expected)>0 and screened.screened==expected
+    #removing terms from a cost function is equivalent to not including them
+    full.remove(expected)
+    assert full.fit_indices==screened.fit_indices
+    assert np.allclose(full.A, screened.A)
+    assert np.allclose(full.B, screened.B)
+    assert np.allclose(full.estimate(), screened.estimate())
+    del system, valence
+
+def test_cost_screening_ethanol():
+    check_cost_screening('ethanol/gaussian.fchk')
@@ -34,7 +34,7 @@ from yaff import Chebychev1, Chebychev2, Chebychev3, Chebychev4, Chebychev6
 
 from quickff.log import log
 
-import numpy as np, math
+import numpy as np, math, scipy.linalg
 
 __all__ = [
     'global_translation', 'global_rotation', 'fitpar',
@@ -648,32 +648,53 @@ def chebychev(m, x):
     else:
         return 2.0*x*chebychev(m-1,x)-chebychev(m-2,x)
 
-def project_negative_freqs(hessian, masses, thresshold=0.0):
+def _dump_lowest_evals(evals, title):
+    'Dump (at most) the 20 lowest eigenvalues in rows of 4'
+    log.dump('20 lowest frequencies [1/cm] %s:' %title)
+    for i in range(0, min(len(evals), 20), 4):
+        log.dump(str(evals[i:i+4]/(lightspeed/centimeter)))
+
+def project_negative_freqs(hessian, masses, thresshold=0.0, partial=False):
+    '''
+        Project the negative eigenvalues out of the mass-weighted hessian.
+        The mass-weighted hessian is symmetrized and every eigenvalue below
+        the thresshold is set to zero by means of a low-rank correction with
+        the corresponding eigenvectors.
+
+        **Arguments**
+
+        hessian
+            the cartesian hessian as a numpy array [N,3,N,3] or [3N,3N]
+
+        masses
+            numpy array [N] with the atomic masses
+
+        **Optional Arguments**
+
+        thresshold
+            eigenvalues below this thresshold are set to zero
+
+        partial
+            if True, only the eigenpairs with eigenvalues below the
+            thresshold are computed using a partial eigensolver, which is
+            much cheaper for large systems. In this case, only these
+            eigenvalues are dumped to the logger.
+    '''
     N = len(masses)
-    sqrt_mass_matrix = np.diag(np.sqrt((np.array([masses, masses, masses]).T).ravel()))
-    isqrt_mass_matrix = np.linalg.inv(sqrt_mass_matrix)
-    matrix = np.dot(isqrt_mass_matrix, np.dot(hessian.reshape([3*N,3*N]), isqrt_mass_matrix))
-    #diagonalize
-    if ((matrix-matrix.T)<1e-6*lightspeed/centimeter).all():
-        evals, evecs = np.linalg.eigh(matrix)
+    sqrt_masses = np.sqrt(np.repeat(np.asarray(masses, float), 3))
+    matrix = hessian.reshape([3*N,3*N])/sqrt_masses[:,None]/sqrt_masses[None,:]
+    matrix = 0.5*(matrix+matrix.T)
+    if partial:
+        evals, evecs = scipy.linalg.eigh(matrix, subset_by_value=[-np.inf, thresshold])
+        log.dump('Found %i eigenvalues below the thresshold' %len(evals))
+        _dump_lowest_evals(evals, 'that are projected out')
     else:
-        evals, evecs = np.linalg.eig(matrix)
-    log.dump('20 lowest frequencies [1/cm] before projection:')
-    log.dump(str(evals[:4]/(lightspeed/centimeter)))
-    log.dump(str(evals[4:8]/(lightspeed/centimeter)))
-    log.dump(str(evals[8:12]/(lightspeed/centimeter)))
-    log.dump(str(evals[12:16]/(lightspeed/centimeter)))
-    log.dump(str(evals[16:20]/(lightspeed/centimeter)))
+        evals, evecs = np.linalg.eigh(matrix)
+        _dump_lowest_evals(evals, 'before projection')
+        mask = evals<thresshold
+        _dump_lowest_evals(np.sort(np.where(mask, 0.0, evals)), 'after projection')
+        evals, evecs = evals[mask], evecs[:,mask]
     #set negative eigenvalues to zero
-    evals[evals<thresshold] = 0.0
-    projected_matrix = np.dot(evecs, np.dot(np.diag(evals), evecs.T))
-    projected_hessian = np.dot(sqrt_mass_matrix, np.dot(projected_matrix, sqrt_mass_matrix))
-    #dump freqs after projection as check
-    evals, evecs = np.linalg.eigh(projected_matrix)
-    log.dump('20 lowest frequencies [1/cm] after projection:')
-    log.dump(str(evals[:4]/(lightspeed/centimeter)))
-    log.dump(str(evals[4:8]/(lightspeed/centimeter)))
-    log.dump(str(evals[8:12]/(lightspeed/centimeter)))
-    log.dump(str(evals[12:16]/(lightspeed/centimeter)))
-    log.dump(str(evals[16:20]/(lightspeed/centimeter)))
+    matrix -= np.dot(evecs*evals, evecs.T)
+    projected_hessian = matrix*sqrt_masses[:,None]*sqrt_masses[None,:]
     return projected_hessian.reshape([N, 3, N, 3])
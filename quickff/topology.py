@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# QuickFF is a code to quickly derive accurate force fields from ab initio input.
+# Copyright (C) 2012 - 2018 Louis Vanduyfhuys <Louis.Vanduyfhuys@UGent.be>
+# Steven Vandenbrande <Steven.Vandenbrande@UGent.be>,
+# Jelle Wieme <Jelle.Wieme@UGent.be>,
+# Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center for Molecular Modeling
+# (CMM), Ghent University, Ghent, Belgium; all rights reserved unless otherwise
+# stated.
+#
+# This file is part of QuickFF.
+#
+# QuickFF is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# QuickFF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+from __future__ import absolute_import
+
+from quickff.tools import term_sort_atypes
+
+import numpy as np
+
+__all__ = ['Topology']
+
+
+class Topology(object):
+    '''
+        Array representation of the bonded topology of a system. All bonds,
+        bends, dihedrals and out-of-plane patterns are enumerated at once from
+        the bond graph and stored as integer arrays, in the same order as the
+        corresponding iterators of the Yaff System class. The atom types of
+        these patterns can be canonicalized and grouped, and the geometric
+        values of all patterns are computed with vectorized minimum image
+        geometry.
+    '''
+    def __init__(self, system):
+        '''
+            **Arguments**
+
+            system
+                a Yaff `System` instance with bonds and atom types
+        '''
+        self.system = system
+        self.natom = system.natom
+        if system.bonds is None:
+            self.bonds = np.zeros([0, 2], int)
+        else:
+            self.bonds = np.array(system.bonds, int).reshape(-1, 2)
+        #flattened neighbor lists, in the iteration order of system.neighs1
+        #to enumerate the patterns in the same order as the System iterators
+        if system.bonds is None:
+            neighs = [[] for i in range(self.natom)]
+        else:
+            neighs = [list(system.neighs1[i]) for i in range(self.natom)]
+        self.degree = np.array([len(neigh) for neigh in neighs], int)
+        self.offsets = np.concatenate([[0], np.cumsum(self.degree)[:-1]]).astype(int)
+        self.neighbors = np.array([j for neigh in neighs for j in neigh], int)
+        #atom type ranks, comparing ranks is equivalent to comparing names
+        ffatypes = np.array([str(ffatype) for ffatype in system.ffatypes])
+        self.ffatypes = [str(ffatype) for ffatype in ffatypes[system.ffatype_ids]]
+        names, ranks = np.unique(ffatypes, return_inverse=True)
+        self.type_ranks = ranks.ravel()[system.ffatype_ids]
+        self.angles = self._get_angles()
+        self.dihedrals = self._get_dihedrals()
+        self.oops = self._get_oops()
+
+    def _neighbor_pairs(self, atoms0, atoms1):
+        '''
+            For every pair (atoms0[k], atoms1[k]), enumerate all pairs of a
+            neighbor of atoms0[k] and a neighbor of atoms1[k]. Returns the
+            index k and the two neighbors of every combination.
+        '''
+        n0 = self.degree[atoms0]
+        n1 = self.degree[atoms1]
+        counts = n0*n1
+        k = np.repeat(np.arange(len(atoms0)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts, counts)
+        nb0 = self.neighbors[self.offsets[atoms0[k]] + local//n1[k]]
+        nb1 = self.neighbors[self.offsets[atoms1[k]] + local%n1[k]]
+        return k, nb0, nb1
+
+    def _get_angles(self):
+        'Enumerate all bends (i0, i1, i2) with i0>i2'
+        atoms = np.arange(self.natom)
+        k, i0, i2 = self._neighbor_pairs(atoms, atoms)
+        mask = i0>i2
+        return np.array([i0[mask], atoms[k[mask]], i2[mask]], int).T.reshape(-1, 3)
+
+    def _get_dihedrals(self):
+        'Enumerate all dihedrals (i0, i1, i2, i3) around every bond (i1, i2)'
+        k, i0, i3 = self._neighbor_pairs(self.bonds[:,0], self.bonds[:,1])
+        i1 = self.bonds[k,0]
+        i2 = self.bonds[k,1]
+        mask = (i0!=i2) & (i3!=i1) & (i0!=i3)
+        return np.array([i0[mask], i1[mask], i2[mask], i3[mask]], int).T.reshape(-1, 4)
+
+    def _get_oops(self):
+        'Enumerate all out-of-plane patterns (i0, i1, i2, i3) of 3-fold atoms'
+        i3 = np.where(self.degree==3)[0]
+        i0 = self.neighbors[self.offsets[i3]]
+        i1 = self.neighbors[self.offsets[i3]+1]
+        i2 = self.neighbors[self.offsets[i3]+2]
+        return np.array([i0, i1, i2, i3], int).T.reshape(-1, 4)
+
+    def sort_atypes(self, indexes, kind):
+        '''
+            Vectorized version of :meth:`quickff.tools.term_sort_atypes`,
+            returns the sorted atom indexes as an integer array.
+
+            **Arguments**
+
+            indexes
+                a (M,k) integer array with atom indexes
+
+            kind
+                the kind of pattern, see term_sort_atypes
+        '''
+        indexes = np.array(indexes, int)
+        if kind in ['opdist', 'oopdist']:
+            #sorting on atom type name concatenated with the atom index is
+            #not a pure array operation, but there is only one oop per atom
+            return np.array([
+                term_sort_atypes(self.ffatypes, oop, kind)[0] for oop in indexes
+            ], int).reshape(-1, 4)
+        ranks = self.type_ranks[indexes]
+        reverse = ranks[:,-1]<ranks[:,0]
+        if kind in ['dihed', 'dihedral', 'torsion']:
+            reverse |= (ranks[:,-1]==ranks[:,0]) & (ranks[:,-2]<ranks[:,1])
+        elif kind not in ['bond', 'dist', 'bend', 'angle']:
+            raise ValueError('Invalid pattern kind %s' %kind)
+        reverse |= (ranks==ranks[:,::-1]).all(axis=1) & (indexes[:,-1]<indexes[:,0])
+        indexes[reverse] = indexes[reverse,::-1]
+        return indexes
+
+    def group_by_types(self, indexes):
+        '''
+            Group the given (sorted) patterns by their atom types. Returns a
+            list of (types, rows) tuples, with types a tuple of atom type
+            names and rows the integer array of the rows in indexes of the
+            patterns with those types. The groups are ordered according to
+            their first occurrence and the original order is kept within
+            each group.
+
+            **Arguments**
+
+            indexes
+                a (M,k) integer array with atom indexes
+        '''
+        if len(indexes)==0: return []
+        ranks = self.type_ranks[indexes]
+        keys, first, inverse = np.unique(ranks, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(inverse))])
+        groups = []
+        for key in np.argsort(first):
+            rows = order[bounds[key]:bounds[key+1]]
+            types = tuple(self.ffatypes[i] for i in indexes[rows[0]])
+            groups.append((types, rows))
+        return groups
+
+    def _deltas(self, atoms0, atoms1, pos=None):
+        'Minimum image vectors pos[atoms1]-pos[atoms0]'
+        if pos is None: pos = self.system.pos
+        deltas = pos[atoms1] - pos[atoms0]
+        cell = self.system.cell
+        if cell.nvec>0:
+            frac = np.dot(deltas, cell.gvecs.T)
+            deltas -= np.dot(np.round(frac), cell.rvecs)
+        return deltas
+
+    def bend_angles(self, angles, pos=None):
+        '''
+            Compute the bend angles (in radians) of the given (M,3) array of
+            bend patterns.
+        '''
+        d10 = self._deltas(angles[:,1], angles[:,0], pos=pos)
+        d12 = self._deltas(angles[:,1], angles[:,2], pos=pos)
+        c = (d10*d12).sum(axis=1)/np.sqrt((d10**2).sum(axis=1)*(d12**2).sum(axis=1))
+        return np.arccos(np.clip(c, -1.0, 1.0))
+
+    def dihed_angles(self, dihedrals, pos=None):
+        '''
+            Compute the signed dihedral angles (in radians) of the given
+            (M,4) array of dihedral patterns.
+        '''
+        d10 = self._deltas(dihedrals[:,1], dihedrals[:,0], pos=pos)
+        d12 = self._deltas(dihedrals[:,1], dihedrals[:,2], pos=pos)
+        d23 = self._deltas(dihedrals[:,2], dihedrals[:,3], pos=pos)
+        n12 = d12/np.sqrt((d12**2).sum(axis=1))[:,None]
+        a = d10 - (d10*n12).sum(axis=1)[:,None]*n12
+        b = d23 - (d23*n12).sum(axis=1)[:,None]*n12
+        x = (a*b).sum(axis=1)
+        y = (np.cross(a, b)*n12).sum(axis=1)
+        return np.arctan2(y, x)
+
+    def oop_distances(self, oops, pos=None):
+        '''
+            Compute the signed distances of atom i3 to the plane through
+            atoms i0, i1 and i2 for the given (M,4) array of out-of-plane
+            patterns.
+        '''
+        d01 = self._deltas(oops[:,0], oops[:,1], pos=pos)
+        d02 = self._deltas(oops[:,0], oops[:,2], pos=pos)
+        d03 = self._deltas(oops[:,0], oops[:,3], pos=pos)
+        normal = np.cross(d01, d02)
+        return (normal*d03).sum(axis=1)/np.sqrt((normal**2).sum(axis=1))
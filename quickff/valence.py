@@ -27,7 +27,6 @@
 from __future__ import unicode_literals, absolute_import
 
 from molmod.units import *
-from molmod.ic import bend_angle, _bend_angle_low, dihed_angle, _dihed_angle_low
 
 from yaff.pes.ff import ForceField, ForcePartValence
 from yaff.pes.vlist import *
@@ -35,22 +34,38 @@ from yaff.pes.iclist import InternalCoordinateList
 from yaff.pes.iclist import Bond, BendAngle, BendCos, DihedCos, DihedAngle, \
     OopDist, SqOopDist
 from yaff.pes.dlist import DeltaList
+from yaff.pes.ext import dlist_forward, iclist_forward, vlist_forward
 from yaff.sampling.harmonic import estimate_cart_hessian
 
 from quickff.tools import term_sort_atypes, get_multiplicity, get_restvalue, \
     digits
+from quickff.topology import Topology
 from quickff.log import log
 
-import numpy as np, re
+import numpy as np, re, os, pickle, hashlib
 
-__all__ = ['ValenceFF']
+__all__ = ['ValenceFF', 'ValenceEngine']
+
+#map of the kind of a Yaff valence term to the corresponding ValenceTerm class
+pot_classes = dict((pot.kind, pot) for pot in [
+    Harmonic, PolyFour, Fues, Cross, Cosine, Chebychev1, Chebychev2,
+    Chebychev3, Chebychev4, Chebychev6, MM3Quartic, MM3Bend, BondDoubleWell,
+    Morse
+])
 
 class Term(object):
     '''
         A class to store easy-accessible information about a term included in
-        the valence force field
+        the valence force field. Terms are stored with __slots__ to limit
+        their memory footprint, the array representation of all terms is
+        available through ValenceFF.get_term_table.
     '''
-    def __init__(self, index, basename, kind, ics, tasks, units,master=None, slaves=None, diag_term_indexes=[]):
+    __slots__ = [
+        'index', 'basename', 'kind', 'ics', 'tasks', 'units', 'master',
+        'slaves', 'diag_term_indexes', '_atoms',
+    ]
+
+    def __init__(self, index, basename, kind, ics, tasks, units,master=None, slaves=None, diag_term_indexes=None):
         self.index = index
         self.basename = basename
         self.kind = kind
@@ -59,13 +74,32 @@ class Term(object):
         self.units = units
         self.master = master
         self.slaves = slaves
+        if diag_term_indexes is None: diag_term_indexes = []
         self.diag_term_indexes=diag_term_indexes
+        self._atoms = None
+
+    def __getstate__(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__ if key!='_atoms')
+
+    def __setstate__(self, state):
+        #also accepts the instance dictionary of terms pickled before the
+        #introduction of __slots__
+        self._atoms = None
+        self.diag_term_indexes = []
+        for key, value in state.items():
+            if key!='_atoms': setattr(self, key, value)
 
     def is_master(self):
         return self.master==self.index
 
     def get_atoms(self):
         'Get the ordered list of indexes of the atoms involved'
+        if self._atoms is None:
+            self._atoms = tuple(self._get_atoms())
+        return list(self._atoms)
+
+    def _get_atoms(self):
+        'Extract the ordered list of atom indexes from the ics'
         atoms = None
         ic = None
         if self.kind==3:#cross
@@ -120,11 +154,7 @@ class Term(object):
         assert self.master is None or self.is_master(), \
             'Current term is not the master'
         #collect parameters
-        npars = len(valence.get_params(self.index))
-        pars = np.zeros([len(self.slaves)+1, npars], float)
-        pars[0,:] = np.array(valence.get_params(self.index))
-        for i, index in enumerate(self.slaves):
-            pars[1+i,:] = np.array(valence.get_params(index))
+        pars = valence.get_params_many([self.index]+self.slaves)
         #set default config (applicable for harmonic terms)
         means = pars.mean(axis=0)
         stds = pars.std(axis=0)
@@ -184,6 +214,54 @@ class Term(object):
         return line
 
 
+class LabelMatcher(object):
+    '''
+        Match term basenames or atom type strings against a list of labels.
+        The labels are compiled once and the outcome is cached per matched
+        string, hence repeated matching of the same basenames or atom type
+        patterns (as is done during the initialization of the valence terms)
+        only costs a dictionary lookup.
+    '''
+    def __init__(self, labels, use_re=True):
+        '''
+            **Arguments**
+
+            labels
+                a string or a list of strings, each of them a regular
+                expression (if use_re is True) or a substring that should
+                appear in the name to be matched, case insensitive
+
+            **Optional Arguments**
+
+            use_re
+                interpret the labels as regular expressions
+        '''
+        if isinstance(labels, str): labels = [labels]
+        self.use_re = use_re
+        if use_re:
+            self.patterns = [re.compile(label, re.IGNORECASE) for label in labels]
+        else:
+            self.patterns = [label.lower() for label in labels]
+        self._cache = {}
+
+    def match(self, *names):
+        '''
+            Returns True if at least one of the given names matches at least
+            one of the labels.
+        '''
+        for name in names:
+            result = self._cache.get(name)
+            if result is None:
+                if self.use_re:
+                    result = any(pattern.match(name) is not None for pattern in self.patterns)
+                else:
+                    result = any(pattern in name.lower() for pattern in self.patterns)
+                self._cache[name] = result
+            if result:
+                return True
+        return False
+
+
 class ValenceFF(ForcePartValence):
     '''
         Class to collect all valence terms in the force field for which
@@ -205,7 +283,21 @@ class ValenceFF(ForcePartValence):
             self.system = system
             self.settings = settings
             self.terms = []
+            self.masters = {}
+            self.masters_by_types = {}
+            self.basenames = []
+            self._basename_ids = {}
+            self._term_table = None
+            self._matchers = {}
+            self.atom_terms = {}
+            self.terms_by_atoms = {}
+            self._delta_cache = None
+            self._engine = None
+            self.symmetry = None
+            self.topology = Topology(system)
             ForcePartValence.__init__(self, system)
+            key = self.get_cache_key('init')
+            if self.load_cache('init', key): return
             if self.settings.do_bonds:
                 self.init_bond_terms()
             if self.settings.do_bends:
@@ -214,6 +306,7 @@ class ValenceFF(ForcePartValence):
                 self.init_dihedral_terms()
             if self.settings.do_oops:
                 self.init_oop_terms()
+            self.dump_cache('init', key, 0)
 
     def add_term(self, pot, ics, basename, tasks, units, diag_term_indexes=[]):
         '''
@@ -248,35 +341,216 @@ class ValenceFF(ForcePartValence):
                 Indexes of the diagonal terms that correspond to the ics
                 composing an off-diagonal term. Empty if the term is diagonal.
         '''
+        term = self._register_term(pot.kind, ics, basename, tasks, units, diag_term_indexes)
+        ForcePartValence.add_term(self, pot(*self._get_pot_args(pot.kind, units, ics)))
+        return term
+
+    def add_terms(self, pot, ics_list, basenames, tasks, units, diag_term_indexes=None):
+        '''
+            Add a family of terms with the same potential in a single call.
+            The terms are registered in self.terms as with add_term, but the
+            rows of the Yaff valence table are filled for all terms at once.
+
+            **Arguments**
+
+            pot
+                a ValenceTerm class from `yaff.pes.vlist.py`, identical for all
+                terms
+
+            ics_list
+                list with for every term a list of InternalCoordinate instances
+
+            basenames
+                a single base name for all terms or a list with a base name
+                for every term
+
+            tasks, units
+                see add_term, identical for all terms
+
+            **Optional arguments**
+
+            diag_term_indexes
+                list with for every term the indexes of the diagonal terms
+                corresponding to its ics (see add_term)
+
+            Returns the list of new Term instances.
+        '''
+        n = len(ics_list)
+        if not isinstance(basenames, list): basenames = [basenames]*n
+        if diag_term_indexes is None: diag_term_indexes = [[]]*n
+        assert len(basenames)==n and len(diag_term_indexes)==n
+        terms = []
+        ic_indexes = -np.ones([n, 2], int)
+        for k, ics in enumerate(ics_list):
+            terms.append(self._register_term(
+                pot.kind, ics, basenames[k], tasks, units, diag_term_indexes[k]
+            ))
+            for i, ic in enumerate(ics):
+                ic_indexes[k,i] = self.iclist.add_ic(ic)
+        if n==0: return terms
+        #parameters of an uninitialized term of this kind (e.g. default sign)
+        pars = pot(*self._get_pot_args(pot.kind, units, ics_list[0])).pars
+        values = -np.ones(6, float)
+        for i, par in enumerate(pars):
+            values[i] = np.nan if par is None else par
+        self._append_vtab_rows(pot.kind, np.tile(values, (n, 1)), ic_indexes)
+        return terms
+
+    def _append_vtab_rows(self, kinds, pars, ic_indexes):
+        '''
+            Append rows to the Yaff valence table in a single slice.
+
+            **Arguments**
+
+            kinds
+                the kind of every new term (or a single kind for all terms)
+
+            pars
+                numpy array [n,6] with the parameters of the new terms, unused
+                parameters should be -1
+
+            ic_indexes
+                numpy array [n,2] with the indexes of the ics of the new
+                terms in self.iclist, -1 for unused ics
+        '''
+        n = len(pars)
+        vlist = self.vlist
+        if vlist.nv+n>len(vlist.vtab):
+            vlist.vtab = np.resize(vlist.vtab, max(vlist.nv+n, int(len(vlist.vtab)*1.5)))
+        rows = vlist.vtab[vlist.nv:vlist.nv+n]
+        rows['kind'] = kinds
+        for i in range(6):
+            rows['par%i' %i] = pars[:,i]
+        rows['ic0'] = ic_indexes[:,0]
+        rows['ic1'] = ic_indexes[:,1]
+        rows['energy'] = np.nan
+        vlist.nv += n
+
+    def _register_term(self, kind, ics, basename, tasks, units, diag_term_indexes):
+        '''
+            Create a new Term and register it in self.terms, self.masters,
+            self.atom_terms and self.terms_by_atoms. The master is looked up
+            by basename in self.masters.
+        '''
         index = len(self.terms)
-        #search for possible master and update slaves
-        master = None
+        basename = self._intern_basename(basename)
+        master = self.masters.get(basename)
         slaves = None
-        for i, term in enumerate(self.terms):
-            if term.basename==basename:
-                if term.is_master():
-                    master = term.index
-                    term.slaves.append(index)
-                else:
-                    assert master==term.master
         if master is None:
             master = index
             slaves = []
-        #add term to self.terms and self.vlist.vtab
+            self._add_master(basename, index)
+        else:
+            self.terms[master].slaves.append(index)
         term = Term(
-            index, basename, pot.kind, ics, tasks,
+            index, basename, kind, ics, tasks,
             units, master=master, slaves=slaves, diag_term_indexes=diag_term_indexes
         )
         self.terms.append(term)
-        if pot.kind==1:#all 4 parameters of PolyFour are given as 1 tuple
-            args = [(None,)*len(units)] + ics
-        elif pot.kind in [5,6,7,8,9]: #Chebychev
-            args = [None] + ics #sign will first be defaulted as -1, but is set to the correct value in init_dihedral_terms
-        else:
-            args = [None,]*len(units) + ics
-        ForcePartValence.add_term(self, pot(*args))
+        for atom in self._get_ic_atoms(ics):
+            self.atom_terms.setdefault(atom, []).append(index)
+        self._add_terms_by_atoms(term)
+        self._term_table = None
         return term
 
+    def _intern_basename(self, basename):
+        'Return the unique copy of basename kept in self.basenames'
+        bid = self._basename_ids.get(basename)
+        if bid is None:
+            bid = len(self.basenames)
+            self._basename_ids[basename] = bid
+            self.basenames.append(basename)
+        return self.basenames[bid]
+
+    def get_term_table(self):
+        '''
+            Return a compact array representation of all terms as a numpy
+            structured array with for every term the fields index, kind,
+            master, nslave, basename (index in self.basenames), atoms (padded
+            with -1) and ic0/ic1 (indexes in self.iclist, -1 if not used).
+            The table is cached and rebuilt after terms are added or
+            modified by the methods of this class. It should not be
+            modified.
+        '''
+        if self._term_table is None:
+            n = len(self.terms)
+            table = np.zeros(n, dtype=[
+                ('index', int), ('kind', int), ('master', int), ('nslave', int),
+                ('basename', int), ('atoms', int, (4,)), ('ic0', int), ('ic1', int),
+            ])
+            table['index'] = np.arange(n)
+            table['atoms'] = -1
+            for i, term in enumerate(self.terms):
+                table['kind'][i] = term.kind
+                table['master'][i] = term.master
+                if term.is_master():
+                    table['nslave'][i] = len(term.slaves)
+                table['basename'][i] = self._basename_ids[self._intern_basename(term.basename)]
+                try:
+                    atoms = term.get_atoms()
+                except ValueError:
+                    atoms = []
+                table['atoms'][i,:len(atoms)] = atoms
+            table['ic0'] = self.vlist.vtab['ic0'][:n]
+            table['ic1'] = self.vlist.vtab['ic1'][:n]
+            self._term_table = table
+        return self._term_table
+
+    def _add_master(self, basename, index):
+        'Register the term with given index as master for basename'
+        self.masters.setdefault(basename, index)
+        key = basename.split('/')[-1].lower()
+        self.masters_by_types.setdefault(key, []).append(index)
+
+    def _remove_master(self, basename, index):
+        'Unregister the term with given index as master for basename'
+        if self.masters.get(basename)==index:
+            del self.masters[basename]
+        key = basename.split('/')[-1].lower()
+        if index in self.masters_by_types.get(key, []):
+            self.masters_by_types[key].remove(index)
+            if len(self.masters_by_types[key])==0:
+                del self.masters_by_types[key]
+
+    def _get_pot_args(self, kind, units, ics):
+        '''
+            Construct the arguments for the ValenceTerm of the given kind, with
+            all parameters set to None.
+        '''
+        if kind==1:#all 4 parameters of PolyFour are given as 1 tuple
+            args = [(None,)*len(units)] + list(ics)
+        elif kind in [5,6,7,8,9]: #Chebychev
+            args = [None] + list(ics) #sign will first be defaulted as -1, but is set to the correct value in init_dihedral_terms
+        else:
+            args = [None,]*len(units) + list(ics)
+        return args
+
+    def _add_terms_by_atoms(self, term):
+        'Register the given term in the terms_by_atoms dictionary'
+        try:
+            key = tuple(term.get_atoms())
+        except ValueError:
+            return
+        self.terms_by_atoms.setdefault(key, []).append(term.index)
+
+    def _remove_terms_by_atoms(self, term):
+        'Remove the given term from the terms_by_atoms dictionary'
+        try:
+            key = tuple(term.get_atoms())
+        except ValueError:
+            return
+        self.terms_by_atoms[key].remove(term.index)
+        if len(self.terms_by_atoms[key])==0:
+            del self.terms_by_atoms[key]
+
+    def _get_ic_atoms(self, ics):
+        'Get the sorted list of indexes of all atoms involved in the given ics'
+        atoms = set()
+        for ic in ics:
+            for pair in ic.index_pairs:
+                atoms.update(pair)
+        return sorted(atoms)
+
     def modify_term(self, term_index, pot, ics, basename, tasks, units):
         '''
             Modify the term with given index to a new valence term.
@@ -285,20 +559,28 @@ class ValenceFF(ForcePartValence):
         with log.section('VAL', 2):
             #modify in valence.terms
             old_term = self.terms[term_index]
+            basename = self._intern_basename(basename)
             new_term = Term(
                 term_index, basename, pot.kind, ics, tasks,
                 units, master=old_term.master, slaves=old_term.slaves
             )
             self.terms[term_index] = new_term
+            if old_term.is_master():
+                self._remove_master(old_term.basename, term_index)
+                self._add_master(basename, term_index)
+            self._remove_terms_by_atoms(old_term)
+            self._add_terms_by_atoms(new_term)
+            #modify in valence.atom_terms
+            for atom in self._get_ic_atoms(old_term.ics):
+                self.atom_terms[atom].remove(term_index)
+            for atom in self._get_ic_atoms(ics):
+                self.atom_terms.setdefault(atom, []).append(term_index)
+            self._delta_cache = None
+            self._engine = None
+            self._term_table = None
             #modify in valence.vlist.vtab
             vterm = self.vlist.vtab[term_index]
-            if pot.kind==1:#all 4 parameters of PolyFour are given as 1 tuple
-                args = [(None,)*len(units)] + ics
-            elif pot.kind in [5,6,7,8,9]: #chebychev potentials
-                args = [None,]+ics
-            else:
-                args = [None,]*len(units) + ics
-            new = pot(*args)
+            new = pot(*self._get_pot_args(pot.kind, units, ics))
             vterm['kind'] = new.kind
             for i in range(len(new.pars)):
                 vterm['par%i'%i] = new.pars[i]
@@ -306,35 +588,182 @@ class ValenceFF(ForcePartValence):
             for i in range(len(ic_indexes)):
                 vterm['ic%i'%i] = ic_indexes[i]
 
+    def get_cache_key(self, section):
+        '''
+            Compute the key identifying the terms of a section in the cache
+            file. The key is a hash of the geometry, bonds, cell and atom
+            types of the system, of the settings that determine the terms
+            (excl_*, do_*, bond_term and bend_term) and, for sections
+            initialized after other terms (such as the cross terms), of the
+            basenames and kinds of the terms present and of the
+            multiplicities of the cosine terms. The other parameters are
+            not included as they do not affect the construction of terms.
+
+            **Arguments**
+
+            section
+                name of the section in the cache file
+        '''
+        sha = hashlib.sha1()
+        def update(value):
+            sha.update(str(value).encode('utf-8'))
+        system = self.system
+        update(section)
+        sha.update(np.ascontiguousarray(system.pos, float).tobytes())
+        if system.bonds is not None:
+            sha.update(np.ascontiguousarray(system.bonds, int).tobytes())
+        if system.cell.nvec>0:
+            sha.update(np.ascontiguousarray(system.cell.rvecs, float).tobytes())
+        update([str(system.ffatypes[fid]) for fid in system.ffatype_ids])
+        for key in sorted(self.settings.__dict__.keys()):
+            if key.startswith('excl_') or key.startswith('do_') or key in ['bond_term', 'bend_term']:
+                update((key, self.settings.__dict__[key]))
+        update([(term.basename, term.kind) for term in self.terms])
+        vtab = self.vlist.vtab[:self.vlist.nv]
+        sha.update(np.ascontiguousarray(vtab['par0'][vtab['kind']==4]).tobytes())
+        return sha.hexdigest()
+
+    def dump_cache(self, section, key, start):
+        '''
+            Store the terms with index start and higher under the given
+            section name in the cache file defined by the fn_valence_cache
+            setting. Nothing is done if this setting is None.
+
+            **Arguments**
+
+            section
+                name of the section in the cache file
+
+            key
+                the key of the section, computed with get_cache_key before
+                the terms of the section were added
+
+            start
+                index of the first term of the section
+        '''
+        fn = self.settings.fn_valence_cache
+        if fn is None: return
+        cache = {}
+        if os.path.isfile(fn):
+            with open(fn, 'rb') as f:
+                cache = pickle.load(f)
+        terms = [
+            (term.kind, term.ics, term.basename, term.tasks, term.units, term.diag_term_indexes)
+            for term in self.terms[start:]
+        ]
+        vtab = self.vlist.vtab[start:self.vlist.nv]
+        cache[section] = {
+            'key': key, 'terms': terms, 'kinds': vtab['kind'].copy(),
+            'pars': np.array([vtab['par%i' %i] for i in range(6)]).T.reshape([-1, 6]),
+        }
+        with open(fn, 'wb') as f:
+            pickle.dump(cache, f)
+        log.dump('Stored %i %s terms in cache file %s' %(len(terms), section, fn))
+
+    def load_cache(self, section, key):
+        '''
+            Add the terms of the given section from the cache file defined
+            by the fn_valence_cache setting, if the key of the cached section
+            matches the given key. Returns True if the terms were loaded.
+
+            **Arguments**
+
+            section
+                name of the section in the cache file
+
+            key
+                the key computed with get_cache_key for the current state
+        '''
+        fn = self.settings.fn_valence_cache
+        if fn is None or not os.path.isfile(fn): return False
+        with open(fn, 'rb') as f:
+            cache = pickle.load(f)
+        if section not in cache or cache[section]['key']!=key:
+            log.dump('No valid %s terms found in cache file %s' %(section, fn))
+            return False
+        terms = cache[section]['terms']
+        ic_indexes = -np.ones([len(terms), 2], int)
+        for k, (kind, ics, basename, tasks, units, diag_term_indexes) in enumerate(terms):
+            self._register_term(kind, ics, basename, tasks, units, diag_term_indexes)
+            for i, ic in enumerate(ics):
+                ic_indexes[k,i] = self.iclist.add_ic(ic)
+        self._append_vtab_rows(cache[section]['kinds'], cache[section]['pars'], ic_indexes)
+        log.dump('Loaded %i %s terms from cache file %s' %(len(terms), section, fn))
+        return True
+
     def iter_terms(self, label=None, use_re=False):
         '''
             Iterate over all terms in the valence force field. If label is
             given, only iterate over terms that matches label.
         '''
+        if label is None:
+            for term in self.terms:
+                yield term
+            return
+        matcher = self.get_matcher(label, use_re=use_re)
         for term in self.terms:
-            if label is None:
+            if matcher.match(term.basename):
                 yield term
-            elif use_re:
-                pattern = re.compile(label, re.IGNORECASE)
-                if pattern.match(term.basename):
-                    yield term
-                else:
-                    continue
-            else:
-                if label.lower() in term.basename.lower():
-                    yield term
-                else:
-                    continue
 
     def iter_masters(self, label=None, use_re=False):
         '''
             Iterate over all master terms in the valence force field. If label
             is given, only iterate of the terms with the label in its name.
         '''
-        for term in self.iter_terms(label=label, use_re=use_re):
-            if term.is_master():
+        matcher = None
+        if label is not None:
+            matcher = self.get_matcher(label, use_re=use_re)
+        for term in self.terms:
+            if not term.is_master(): continue
+            if matcher is None or matcher.match(term.basename):
                 yield term
 
+    def iter_masters_by_types(self, types):
+        '''
+            Iterate over all master terms of which the basename ends with
+            the given atom types, i.e. all masters that would match the
+            regular expression '^.*/'+'\.'.join(types)+'$'. This lookup
+            does not scan the list of terms.
+
+            **Arguments**
+
+            types
+                a tuple of atom type names
+        '''
+        key = '.'.join(types).lower()
+        for index in sorted(self.masters_by_types.get(key, [])):
+            yield self.terms[index]
+
+    def get_matcher(self, label, use_re=False):
+        '''
+            Return a (cached) LabelMatcher instance for the given label.
+        '''
+        key = (label, use_re)
+        matcher = self._matchers.get(key)
+        if matcher is None:
+            matcher = LabelMatcher(label, use_re=use_re)
+            self._matchers[key] = matcher
+        return matcher
+
+    def get_exclusion_matcher(self, excl):
+        '''
+            Return a (cached) LabelMatcher for a comma separated list of
+            regular expressions as used in the excl_* settings, or None if
+            excl is None.
+        '''
+        if excl is None: return None
+        return self.get_matcher(tuple(excl.split(',')), use_re=True)
+
+    def _group_by_types(self, indexes, *values):
+        '''
+            Group the given (M,k) array of sorted atom patterns by their atom
+            types. For every distinct tuple of atom types, a tuple is yielded
+            containing the atom types, the list of patterns (as lists of atom
+            indexes) and the corresponding entries of each array in values.
+        '''
+        for types, rows in self.topology.group_by_types(indexes):
+            yield (types, indexes[rows].tolist())+tuple(value[rows] for value in values)
+
     def init_bond_terms(self):
         '''
             Initialize all bond terms in the system based on the bonds attribute
@@ -342,41 +771,39 @@ class ValenceFF(ForcePartValence):
             potentials.
         '''
         with log.section('VAL', 3, 'Initializing'):
-            ffatypes = [self.system.ffatypes[fid] for fid in self.system.ffatype_ids]
+            ffatypes = self.topology.ffatypes
             #get the bond terms
             nbonds = 0
 
             #list of bonds which should be excluded
-            if self.settings.excl_bonds is not None:
-                excl_bonds = self.settings.excl_bonds.split(',')
+            excl_bonds = self.get_exclusion_matcher(self.settings.excl_bonds)
 
-            for bond in self.system.iter_bonds():
+            bonds = []
+            basenames = []
+            for bond in self.topology.sort_atypes(self.topology.bonds, 'bond').tolist():
                 skip = False
-                bond, types = term_sort_atypes(ffatypes, bond, 'bond')
+                types = tuple(ffatypes[i] for i in bond)
 
-                if self.settings.excl_bonds is not None:
-                    bond_opt1 = '.'.join(types)
-                    bond_opt2 = '.'.join(types[::-1])
-                    for excl in excl_bonds:
-                        pattern = re.compile(excl, re.IGNORECASE)
-                        if pattern.match(bond_opt1) or pattern.match(bond_opt2):
-                            skip = True
+                if excl_bonds is not None:
+                    skip = excl_bonds.match('.'.join(types), '.'.join(types[::-1]))
 
                 if not skip:
-                    units = ['kjmol/A**2', 'A']
-                    basename = self.settings.bond_term+'/'+'.'.join(types)
-                    if self.settings.bond_term.lower()   == 'bondharm':
-                        pot = Harmonic
-                    elif self.settings.bond_term.lower() == 'bondmm3':
-                        pot = MM3Quartic
-                    elif self.settings.bond_term.lower() == 'bondfues':
-                        pot = Fues
-                    else:
-                        raise ValueError('Bond kind %s not supported' %self.settings.bond_term)
-                    term = self.add_term(pot, [Bond(*bond)], basename, ['PT_ALL', 'HC_FC_DIAG'], units)
-                    nbonds += 1
+                    bonds.append([Bond(*bond)])
+                    basenames.append(self.settings.bond_term+'/'+'.'.join(types))
                 else:
                     log.dump('Excluded %s bond'%'.'.join(types))
+            if len(bonds)>0:
+                units = ['kjmol/A**2', 'A']
+                if self.settings.bond_term.lower()   == 'bondharm':
+                    pot = Harmonic
+                elif self.settings.bond_term.lower() == 'bondmm3':
+                    pot = MM3Quartic
+                elif self.settings.bond_term.lower() == 'bondfues':
+                    pot = Fues
+                else:
+                    raise ValueError('Bond kind %s not supported' %self.settings.bond_term)
+                self.add_terms(pot, bonds, basenames, ['PT_ALL', 'HC_FC_DIAG'], units)
+                nbonds = len(bonds)
         log.dump('Added %i bond terms' %nbonds)
 
     def init_bend_terms(self, thresshold=10*deg):
@@ -387,87 +814,65 @@ class ValenceFF(ForcePartValence):
         '''
         with log.section('VAL', 3, 'Initializing'):
             #list of bends which should be excluded
-            if self.settings.excl_bends is not None:
-                excl_bends = self.settings.excl_bends.split(',')
+            excl_bends = self.get_exclusion_matcher(self.settings.excl_bends)
 
-            #get the angle terms
-            ffatypes = [self.system.ffatypes[fid] for fid in self.system.ffatype_ids]
-            angles = {}
-            for angle in self.system.iter_angles():
-                angle, types = term_sort_atypes(ffatypes, angle, 'dihedral')
-                if types in list(angles.keys()):
-                    angles[types].append(angle)
-                else:
-                    angles[types] = [angle]
+            #get the angle terms, grouped by atom types
+            angles = self.topology.sort_atypes(self.topology.angles, 'dihedral')
+            allrvs = self.topology.bend_angles(angles)
             #loop over all distinct angle types
             nabends = 0
             ncbends = 0
             nsqbends = 0
-            for types, bends in angles.items():
+            for types, bends, rvs in self._group_by_types(angles, allrvs):
                 potkind = None
-                rvs = []
-                for i, bend in enumerate(bends):
-                    if self.system.cell.nvec>0:
-                        d10 = self.system.pos[bend[0]] - self.system.pos[bend[1]]
-                        d12 = self.system.pos[bend[2]] - self.system.pos[bend[1]]
-                        self.system.cell.mic(d10)
-                        self.system.cell.mic(d12)
-                        rvs.append(_bend_angle_low(d10, d12, 0)[0])
-                    else:
-                        rs = np.array([self.system.pos[j] for j in bend])
-                        rvs.append(bend_angle(rs)[0])
                 #sort rvs in rvs in [90-thresshold, 90+thresshold], rvs in
                 #[180-thresshold,180] and others
-                rvs90 = [rv for rv in rvs if 90*deg-thresshold<rv<90*deg+thresshold]
-                rvs180 = [rv for rv in rvs if 180*deg-thresshold<rv<180*deg]
-                rvsother = [rv for rv in rvs if rv not in rvs90 and rv not in rvs180]
+                is90 = (90*deg-thresshold<rvs) & (rvs<90*deg+thresshold)
+                is180 = (180*deg-thresshold<rvs) & (rvs<180*deg)
+                nrvs90, nrvs180 = is90.sum(), is180.sum()
+                nrvsother = (~(is90 | is180)).sum()
                 #detect whether rvs are centered around 90 and 180, then
                 #use 1-cos(4*theta) term
-                if len(rvs90)>0 and len(rvs180)>0 and len(rvsother)==0:
+                if nrvs90>0 and nrvs180>0 and nrvsother==0:
                     log.dump('%s has equilibrium values around 90/180 deg, using 1-cos(4*theta) potential' %('.'.join(types)))
                     potkind='squarebend'
-                elif len(rvs180)>0 and len(rvs90)==0 and len(rvsother)==0:
+                elif nrvs180>0 and nrvs90==0 and nrvsother==0:
                     log.dump('%s has equilibrium values around 180 deg, using 1+cos(theta) potential' %('.'.join(types)))
                     potkind='lincos'
                 else:
                     potkind='angleharm'
-                #add term
-                for bend in bends:
-                    skip = False
-
-                    if self.settings.excl_bends is not None:
-                        bend_opt1 = '.'.join(types)
-                        bend_opt2 = '.'.join(types[::-1])
-                        for excl in excl_bends:
-                            pattern = re.compile(excl, re.IGNORECASE)
-                            if pattern.match(bend_opt1) or pattern.match(bend_opt2):
-                                skip = True
-
-                    if not skip:
-                        if potkind=='lincos':
-                            basename = 'BendCheby1/'+'.'.join(types)
-                            term = self.add_term(Chebychev1, [BendCos(*bend)], basename, ['HC_FC_DIAG'], ['kjmol', 'au'])
-                            self.set_params(term.index, sign=1)
-                            ncbends += 1
-                        elif potkind=='squarebend':
-                            basename = 'BendCheby4/'+'.'.join(types)
-                            term = self.add_term(Chebychev4, [BendCos(*bend)], basename, ['HC_FC_DIAG'], ['kjmol', 'au'])
-                            self.set_params(term.index, sign=-1)
-                            nsqbends += 1
-                        elif potkind=='angleharm':
-                            basename = self.settings.bend_term+'/'+'.'.join(types)
-                            if self.settings.bend_term.lower()   == 'bendaharm':
-                                pot = Harmonic
-                            elif self.settings.bend_term.lower() == 'bendmm3':
-                                pot = MM3Bend
-                            else:
-                                raise ValueError('Bond kind %s not supported' %self.settings.bend_term)
-                            self.add_term(pot, [BendAngle(*bend)], basename, ['PT_ALL', 'HC_FC_DIAG'], ['kjmol/rad**2', 'deg'])
-                            nabends += 1
-                        else:
-                            raise ValueError('')
-                    else:
+                #add all terms of this angle type at once
+                skip = False
+                if excl_bends is not None:
+                    skip = excl_bends.match('.'.join(types), '.'.join(types[::-1]))
+                if skip:
+                    for bend in bends:
                         log.dump('Excluded %s bend'%'.'.join(types))
+                    continue
+                if potkind=='lincos':
+                    basename = 'BendCheby1/'+'.'.join(types)
+                    terms = self.add_terms(Chebychev1, [[BendCos(*bend)] for bend in bends], basename, ['HC_FC_DIAG'], ['kjmol', 'au'])
+                    for term in terms:
+                        self.set_params(term.index, sign=1)
+                    ncbends += len(terms)
+                elif potkind=='squarebend':
+                    basename = 'BendCheby4/'+'.'.join(types)
+                    terms = self.add_terms(Chebychev4, [[BendCos(*bend)] for bend in bends], basename, ['HC_FC_DIAG'], ['kjmol', 'au'])
+                    for term in terms:
+                        self.set_params(term.index, sign=-1)
+                    nsqbends += len(terms)
+                elif potkind=='angleharm':
+                    basename = self.settings.bend_term+'/'+'.'.join(types)
+                    if self.settings.bend_term.lower()   == 'bendaharm':
+                        pot = Harmonic
+                    elif self.settings.bend_term.lower() == 'bendmm3':
+                        pot = MM3Bend
+                    else:
+                        raise ValueError('Bond kind %s not supported' %self.settings.bend_term)
+                    terms = self.add_terms(pot, [[BendAngle(*bend)] for bend in bends], basename, ['PT_ALL', 'HC_FC_DIAG'], ['kjmol/rad**2', 'deg'])
+                    nabends += len(terms)
+                else:
+                    raise ValueError('')
         log.dump('Added %i bend terms (an)harmonic in the angle, %i bend terms with 1+cos(angle) potential and %i bend terms with 1-cos(4*theta) potential.' %(nabends, ncbends, nsqbends))
 
     def init_dihedral_terms(self, thresshold=20*deg):
@@ -486,51 +891,28 @@ class ValenceFF(ForcePartValence):
         '''
         with log.section('VAL', 3, 'Initializing'):
             #list of dihedrals which should be excluded
-            if self.settings.excl_dihs is not None:
-                excl_dihs = self.settings.excl_dihs.split(',')
-
-            #get all dihedrals
-            ffatypes = [self.system.ffatypes[fid] for fid in self.system.ffatype_ids]
-            dihedrals = {}
-            for dihedral in self.system.iter_dihedrals():
-                dihedral, types = term_sort_atypes(ffatypes, dihedral, 'dihedral')
-                if types in list(dihedrals.keys()):
-                    dihedrals[types].append(dihedral)
-                else:
-                    dihedrals[types] = [dihedral]
+            excl_dihs = self.get_exclusion_matcher(self.settings.excl_dihs)
+
+            #get all dihedrals, grouped by atom types, together with their
+            #dihedral angles and the largest of their two bend angles
+            topology = self.topology
+            dihedrals = topology.sort_atypes(topology.dihedrals, 'dihedral')
+            allpsi0s = topology.dihed_angles(dihedrals)
+            allbends = np.maximum(
+                topology.bend_angles(dihedrals[:,:3]),
+                topology.bend_angles(dihedrals[:,1:])
+            )
             #loop over all distinct dihedral types
             ncheb = 0
             ncos = 0
-            for types, diheds in dihedrals.items():
-                psi0s = np.zeros(len(diheds), float)
-                ms = np.zeros(len(diheds), float)
-                bendskip = False
-                for i, dihed in enumerate(diheds):
-                    if self.system.cell.nvec>0:
-                        d10 = self.system.pos[dihed[0]] - self.system.pos[dihed[1]]
-                        d12 = self.system.pos[dihed[2]] - self.system.pos[dihed[1]]
-                        d23 = self.system.pos[dihed[3]] - self.system.pos[dihed[2]]
-                        self.system.cell.mic(d10)
-                        self.system.cell.mic(d12)
-                        self.system.cell.mic(d23)
-                        #check if bending angle is not 180 deg
-                        bend012 = _bend_angle_low(d10, d12, 0)[0]
-                        bend123 = _bend_angle_low(d12, d23, 0)[0]
-                        if bend012>175*deg or bend123>175*deg:
-                            bendskip = True
-                            continue
-                        psi0s[i] = _dihed_angle_low(d10, d12, d23, 0)[0]
-                    else:
-                        rs = np.array([self.system.pos[j] for j in dihed])
-                        bend012 = bend_angle(rs[:3])[0]
-                        bend123 = bend_angle(rs[1:4])[0]
-                        if bend012>175*deg or bend123>175*deg:
-                            bendskip = True
-                            continue
-                        psi0s[i] = dihed_angle(rs)[0]
-                    n1 = len(self.system.neighs1[dihed[1]])
-                    n2 = len(self.system.neighs1[dihed[2]])
-                    ms[i] = get_multiplicity(n1, n2)
+            groups = self._group_by_types(
+                dihedrals, allpsi0s, allbends,
+                topology.degree[dihedrals[:,1]], topology.degree[dihedrals[:,2]]
+            )
+            for types, diheds, psi0s, bends, n1s, n2s in groups:
+                #check if bending angles are not 180 deg
+                bendskip = (bends>175*deg).any()
+                ms = np.array([get_multiplicity(n1, n2) for n1, n2 in zip(n1s, n2s)], float)
                 if bendskip:
                     log.warning('Dihedral for %s contains bend angle close to 180 deg, skipping' %('.'.join(types)))
                     continue
@@ -572,31 +954,25 @@ class ValenceFF(ForcePartValence):
                         else: do_chebychev = False
                     else:
                         do_chebychev = False
-                    for dihed in diheds:
-                        skip = False
-
-                        if self.settings.excl_dihs is not None:
-                            dih_opt1 = '.'.join(types)
-                            dih_opt2 = '.'.join(types[::-1])
-                            for excl in excl_dihs:
-                                pattern = re.compile(excl, re.IGNORECASE)
-                                if pattern.match(dih_opt1) or pattern.match(dih_opt2):
-                                    skip = True
-
-                        if not skip:
-                            if do_chebychev:
-                                assert chebypot is not None
-                                basename = 'TorsCheby%i/' %m+'.'.join(types)
-                                term = self.add_term(chebypot, [DihedCos(*dihed)], basename, ['HC_FC_DIAG'], ['kjmol', 'au'])
-                                self.set_params(term.index, sign=sign)
-                                ncheb += 1
-                            else:
-                                basename = 'Torsion/'+'.'.join(types)
-                                term = self.add_term(Cosine, [DihedAngle(*dihed)], basename, ['HC_FC_DIAG'], ['au', 'kjmol', 'deg'])
-                                self.set_params(term.index, rv0=rv, m=m)
-                                ncos += 1
-                        else:
+                    skip = False
+                    if excl_dihs is not None:
+                        skip = excl_dihs.match('.'.join(types), '.'.join(types[::-1]))
+                    if skip:
+                        for dihed in diheds:
                             log.dump('Excluded %s dihedral'%'.'.join(types))
+                    elif do_chebychev:
+                        assert chebypot is not None
+                        basename = 'TorsCheby%i/' %m+'.'.join(types)
+                        terms = self.add_terms(chebypot, [[DihedCos(*dihed)] for dihed in diheds], basename, ['HC_FC_DIAG'], ['kjmol', 'au'])
+                        for term in terms:
+                            self.set_params(term.index, sign=sign)
+                        ncheb += len(terms)
+                    else:
+                        basename = 'Torsion/'+'.'.join(types)
+                        terms = self.add_terms(Cosine, [[DihedAngle(*dihed)] for dihed in diheds], basename, ['HC_FC_DIAG'], ['au', 'kjmol', 'deg'])
+                        for term in terms:
+                            self.set_params(term.index, rv0=rv, m=m)
+                        ncos += len(terms)
                 else:
                     #no dihedral potential could be determine, hence it is ignored
                     log.warning('missing dihedral for %s (could not determine rest value from %s)' %('.'.join(types), str(psi0s/deg)))
@@ -611,81 +987,47 @@ class ValenceFF(ForcePartValence):
         '''
         with log.section('VAL', 3, 'Initializing'):
             #list of oopds which should be excluded
-            if self.settings.excl_oopds is not None:
-                excl_oopds = self.settings.excl_oopds.split(',')
-
-            #get all out-of-plane distances
-            from molmod.ic import opbend_dist, _opdist_low
-            ffatypes = [self.system.ffatypes[fid] for fid in self.system.ffatype_ids]
-            opdists = {}
-            for opdist in self.system.iter_oops():
-                opdist, types = term_sort_atypes(ffatypes, opdist, 'opdist')
-                if types in list(opdists.keys()):
-                    opdists[types].append(opdist)
-                else:
-                    opdists[types] = [opdist]
+            excl_oopds = self.get_exclusion_matcher(self.settings.excl_oopds)
+
+            #get all out-of-plane distances, grouped by atom types
+            opdists = self.topology.sort_atypes(self.topology.oops, 'opdist')
+            alld0s = abs(self.topology.oop_distances(opdists))
             #loop over all distinct opdist types
             nharm = 0
             nsq = 0
-            for types, oops in opdists.items():
+            for types, oops, d0s in self._group_by_types(opdists, alld0s):
                 skip = False
 
-                if self.settings.excl_oopds is not None:
-                    oopd_opt1 = '.'.join(types)
-                    oopd_opt2 = '.'.join([types[0],types[2],types[1],types[3]])
-                    oopd_opt3 = '.'.join([types[1],types[0],types[2],types[3]])
-                    oopd_opt4 = '.'.join([types[1],types[2],types[0],types[3]])
-                    oopd_opt5 = '.'.join([types[2],types[0],types[1],types[3]])
-                    oopd_opt6 = '.'.join([types[2],types[1],types[0],types[3]])
-                    for excl in excl_oopds:
-                        pattern = re.compile(excl, re.IGNORECASE)
-                        if pattern.match(oopd_opt1) or pattern.match(oopd_opt2) or pattern.match(oopd_opt3) or pattern.match(oopd_opt4) or pattern.match(oopd_opt5) or pattern.match(oopd_opt6):
-                            skip = True
+                if excl_oopds is not None:
+                    skip = excl_oopds.match(
+                        '.'.join(types),
+                        '.'.join([types[0],types[2],types[1],types[3]]),
+                        '.'.join([types[1],types[0],types[2],types[3]]),
+                        '.'.join([types[1],types[2],types[0],types[3]]),
+                        '.'.join([types[2],types[0],types[1],types[3]]),
+                        '.'.join([types[2],types[1],types[0],types[3]]),
+                    )
                 if not skip:
-                    d0s = np.zeros(len(oops), float)
-                    for i, oop in enumerate(oops):
-                        if self.system.cell.nvec>0:
-                            d01 = self.system.pos[oop[1]]-self.system.pos[oop[0]]
-                            d02 = self.system.pos[oop[2]]-self.system.pos[oop[0]]
-                            d03 = self.system.pos[oop[3]]-self.system.pos[oop[0]]
-                            self.system.cell.mic(d01)
-                            self.system.cell.mic(d02)
-                            self.system.cell.mic(d03)
-                            d0s[i] = abs(_opdist_low(d01, d02, d03, 0)[0])
-                        else:
-                            rs = np.array([#mind the order, is(or was) wrongly documented in molmod
-                                self.system.pos[oop[0]],
-                                self.system.pos[oop[1]],
-                                self.system.pos[oop[2]],
-                                self.system.pos[oop[3]],
-                            ])
-                            d0s[i] = abs(opbend_dist(rs)[0])
-
                     if d0s.mean()<thresshold_zero: #TODO: check this thresshold
                         #add regular term harmonic in oopdist
-                        for oop in oops:
-                            basename = 'Oopdist/'+'.'.join(types)
-                            term = self.add_term(Harmonic, [OopDist(*oop)], basename, ['HC_FC_DIAG'], ['kjmol/A**2', 'A'])
+                        basename = 'Oopdist/'+'.'.join(types)
+                        terms = self.add_terms(Harmonic, [[OopDist(*oop)] for oop in oops], basename, ['HC_FC_DIAG'], ['kjmol/A**2', 'A'])
+                        for term in terms:
                             self.set_params(term.index, rv0=0.0)
-                            nharm += 1
+                        nharm += len(terms)
                     else:
                         #add term harmonic in square of oopdist
                         log.dump('Mean absolute value of OopDist %s is %.3e A, used SQOOPDIST' %('.'.join(types), d0s.mean()/angstrom))
-                        for oop in oops:
-                            basename = 'SqOopdist/'+'.'.join(types)
-                            self.add_term(Harmonic, [SqOopDist(*oop)], basename, ['PT_ALL', 'HC_FC_DIAG'], ['kjmol/A**4', 'A**2'])
-                            nsq += 1
+                        basename = 'SqOopdist/'+'.'.join(types)
+                        terms = self.add_terms(Harmonic, [[SqOopDist(*oop)] for oop in oops], basename, ['PT_ALL', 'HC_FC_DIAG'], ['kjmol/A**4', 'A**2'])
+                        nsq += len(terms)
                 else:
                     log.dump('Excluded %s oopd'%'.'.join(types))
         log.dump('Added %i Harmonic and %i SquareHarmonic out-of-plane distance terms' %(nharm, nsq))
 
     def get_term_index(self, label):
         # Find index of master term(s) matching given label
-        pattern = re.compile(label, re.IGNORECASE)
-        candidates = []
-        for iterm, term in enumerate(self.terms):
-            if pattern.match(term.basename) and term.is_master():
-                candidates.append(iterm)
+        candidates = [term.index for term in self.iter_masters(label, use_re=True)]
         assert len(candidates)<2, 'Multiple masters found for %s: %s' %(label, ','.join([self.terms[iterm].basename for iterm in candidates]))
         if len(candidates)==0:
             if label.startswith('^Bond') or label.startswith('^Bend') or label.startswith('^Tors'):
@@ -696,10 +1038,7 @@ class ValenceFF(ForcePartValence):
                     prefix1, types1 = sublabels[1].lstrip('^').rstrip('$').split('/')
                     label += '|'
                     label += '^'+prefix1+'/'+'\.'.join(types1.split('.')[::-1])+'$'
-                pattern = re.compile(label, re.IGNORECASE)
-                for iterm, term in enumerate(self.terms):
-                    if pattern.match(term.basename) and term.is_master():
-                        candidates.append(iterm)
+                candidates = [term.index for term in self.iter_masters(label, use_re=True)]
             assert len(candidates)<2, 'Multiple masters found for %s: %s' %(label, ','.join([self.terms[iterm].basename for iterm in candidates]))
         assert (len(candidates))==1, "Could not find term for %s" % (label)
         return candidates[0]
@@ -711,12 +1050,10 @@ class ValenceFF(ForcePartValence):
         '''
         with log.section('VAL', 3, 'Initializing'):
             #list of bonds which should be excluded
-            if self.settings.excl_bonds is not None:
-                excl_bonds = self.settings.excl_bonds.split(',')
+            excl_bonds = self.get_exclusion_matcher(self.settings.excl_bonds)
 
             #list of bends which should be excluded
-            if self.settings.excl_bends is not None:
-                excl_bends = self.settings.excl_bends.split(',')
+            excl_bends = self.get_exclusion_matcher(self.settings.excl_bends)
 
             ffatypes = [self.system.ffatypes[i] for i in self.system.ffatype_ids]
             #add cross terms for angle patterns
@@ -727,16 +1064,11 @@ class ValenceFF(ForcePartValence):
                 angle, types = term_sort_atypes(ffatypes, angle, 'angle')
                 anglekind = None
 
-                if self.settings.excl_bends is not None:
-                    bend_opt1 = '.'.join(types)
-                    bend_opt2 = '.'.join(types[::-1])
-                    for excl in excl_bends:
-                        pattern = re.compile(excl, re.IGNORECASE)
-                        if pattern.match(bend_opt1) or pattern.match(bend_opt2):
-                            skip = True
+                if excl_bends is not None:
+                    skip = excl_bends.match('.'.join(types), '.'.join(types[::-1]))
 
                 if not skip:
-                    for term in self.iter_masters('^.*/'+'\.'.join(types)+'$', use_re=True):
+                    for term in self.iter_masters_by_types(types):
                         if len(term.get_atoms())!=3: continue
                         if len(term.ics)>1: continue
                         assert anglekind is None, '2 masters detected for angle %s' %('.'.join(types))
@@ -745,15 +1077,11 @@ class ValenceFF(ForcePartValence):
                     bond0, btypes0 = term_sort_atypes(ffatypes, angle[:2], 'bond')
                     bond1, btypes1 = term_sort_atypes(ffatypes, angle[1:], 'bond')
 
-                    if self.settings.excl_bonds is not None:
-                        bond_opt1 = '.'.join(btypes0)
-                        bond_opt2 = '.'.join(btypes0[::-1])
-                        bond_opt3 = '.'.join(btypes1)
-                        bond_opt4 = '.'.join(btypes1[::-1])
-                        for excl in excl_bonds:
-                            pattern = re.compile(excl, re.IGNORECASE)
-                            if pattern.match(bond_opt1) or pattern.match(bond_opt2) or pattern.match(bond_opt3) or pattern.match(bond_opt4):
-                                skip = True
+                    if excl_bonds is not None:
+                        skip = excl_bonds.match(
+                            '.'.join(btypes0), '.'.join(btypes0[::-1]),
+                            '.'.join(btypes1), '.'.join(btypes1[::-1]),
+                        )
 
                     if not skip:
                         # Find indexes of diagonal terms corresponding to ics
@@ -833,7 +1161,7 @@ class ValenceFF(ForcePartValence):
                 diag_term_indexes.append(self.get_term_index(label))
                 #get multiplicity of dihedral term to determine which DihedCos
                 m, DihedIC = None, None
-                for term in self.iter_masters('^.*/'+'\.'.join(types)+'$', use_re=True):
+                for term in self.iter_masters_by_types(types):
                     if term.kind == 4:
                         assert DihedIC is None and m is None
                         m=self.get_params(term.index, only='m')
@@ -863,12 +1191,12 @@ class ValenceFF(ForcePartValence):
                 #get type of angle012 and angle123
                 angle012_type = None
                 angle123_type = None
-                for term in self.iter_masters('^.*/'+'\.'.join(atypes012)+'$', use_re=True):
+                for term in self.iter_masters_by_types(atypes012):
                     if len(term.get_atoms())!=3: continue
                     if len(term.ics)>1: continue
                     assert angle012_type is None, 'Two masters found for angle %s' %(str(types[:4]))
                     angle012_type = term.ics[0].kind
-                for term in self.iter_masters('^.*/'+'\.'.join(atypes123)+'$', use_re=True):
+                for term in self.iter_masters_by_types(atypes123):
                     if len(term.get_atoms())!=3: continue
                     if len(term.ics)>1: continue
                     assert angle123_type is None, 'Two masters found for angle %s' %(str(types[1:]))
@@ -994,82 +1322,264 @@ class ValenceFF(ForcePartValence):
             master = masters[0]
             for slavename in slavenames:
                 for slave in self.iter_terms(slavename):
+                    self._remove_master(slave.basename, slave.index)
                     slave.basename = master.basename
                     slave.master = master.index
                     slave.slaves = []
                     master.slaves.append(slave.index)
+        self._term_table = None
+
+    def get_vtab(self):
+        '''
+            Return a private copy of the table of valence terms, which can be
+            modified through set_params(..., vtab=vtab) and passed to
+            calc_energy and calc_delta_energy without altering self.
+        '''
+        return self.vlist.vtab[:self.vlist.nv].copy()
 
-    def calc_energy(self, pos):
-        old =  self.system.pos.copy()
-        self.system.pos = pos.copy()
-        self.dlist.forward()
-        self.iclist.forward()
-        energy = self.vlist.forward()
-        #energy = self.compute()
-        self.system.pos = old
-        self.dlist.forward()
-        self.iclist.forward()
-        self.vlist.forward()
+    def calc_energy(self, pos, vtab=None):
+        '''
+            Compute the valence energy in the given positions. The delta,
+            internal coordinate and valence tables are evaluated on private
+            copies, hence neither the state of self nor of self.system is
+            altered and the method can safely be called concurrently.
+
+            **Arguments**
+
+            pos
+                numpy array [natom,3] with the positions
+
+            **Optional Arguments**
+
+            vtab
+                table of valence terms (see get_vtab) to use instead of
+                self.vlist.vtab, e.g. with modified parameters
+        '''
+        if vtab is None: vtab = self.vlist.vtab
+        energy, vtab = self._forward(pos, vtab)
         return energy
 
+    def _forward(self, pos, vtab):
+        '''
+            Evaluate the delta, ic and valence lists in the given positions on
+            private copies of the tables. Returns the energy and the copy of
+            vtab containing the energy of every term.
+        '''
+        nv = self.vlist.nv
+        vtab = vtab[:nv].copy()
+        deltas = self.dlist.deltas.copy()
+        ictab = self.iclist.ictab.copy()
+        dlist_forward(np.ascontiguousarray(pos, dtype=float), self.system.cell, deltas, self.dlist.ndelta)
+        iclist_forward(deltas, ictab, self.iclist.nic)
+        energy = vlist_forward(ictab, vtab, nv)
+        return energy, vtab
+
+    def get_engine(self):
+        '''
+            Return a `ValenceEngine` for vectorized evaluation of all terms
+            on a stack of frames. The engine is cached and rebuilt when terms
+            have been added or modified. Returns None if the engine does not
+            support all internal coordinates of the force field.
+        '''
+        if not ValenceEngine.supports(self):
+            return None
+        engine = self._engine
+        nv = self.vlist.nv
+        if engine is None or engine.nv!=nv \
+        or not np.array_equal(engine.kinds, self.vlist.vtab['kind'][:nv]) \
+        or not np.array_equal(engine.ic0, self.vlist.vtab['ic0'][:nv]):
+            engine = ValenceEngine(self)
+            self._engine = engine
+        return engine
+
+    def calc_energies(self, coords, vtab=None):
+        '''
+            Compute the valence energy of every frame in coords (numpy array
+            [nframe,natom,3]) with the vectorized `ValenceEngine`. The
+            optional vtab overrides the parameters as in calc_energy. If the
+            engine does not support all internal coordinates, the energy of
+            every frame is computed with calc_energy.
+        '''
+        engine = self.get_engine()
+        if engine is None:
+            return np.array([self.calc_energy(pos, vtab=vtab) for pos in coords], float)
+        return engine.compute(coords, vtab=vtab)[0]
+
+    def calc_delta_energy(self, pos, pos0, tol=0.0, vtab=None):
+        '''
+            Compute the valence energy in the given positions by only
+            recomputing the terms that involve atoms which are displaced more
+            than tol with respect to the reference positions pos0. The energy
+            of all other terms is taken from the (cached) energy of the
+            reference positions. Along a perturbation trajectory, the cost
+            therefore scales with the number of terms around the perturbed IC
+            instead of with the system size.
+
+            **Arguments**
+
+            pos
+                numpy array [natom,3] with the positions in which the energy
+                is computed
+
+            pos0
+                numpy array [natom,3] with the reference positions
+
+            **Optional Arguments**
+
+            tol
+                atoms displaced less than tol with respect to pos0 are
+                considered fixed. For tol=0.0, the result is identical to
+                calc_energy(pos).
+
+            vtab
+                table of valence terms (see get_vtab) to use instead of
+                self.vlist.vtab
+        '''
+        if vtab is None: vtab = self.vlist.vtab
+        cache = self._get_delta_cache(pos0, vtab)
+        dists = np.sqrt(((pos-pos0)**2).sum(axis=1))
+        indexes = set(cache['indexes'])
+        for atom in np.where(dists>tol)[0]:
+            indexes.update(self.atom_terms.get(atom, []))
+        if len(indexes)>len(cache['indexes']):
+            self._update_delta_cache(cache, sorted(indexes))
+        part = cache['part']
+        if part is None: return cache['energy']
+        pos = np.ascontiguousarray(pos, dtype=float)
+        dlist_forward(pos, self.system.cell, part.dlist.deltas, part.dlist.ndelta)
+        iclist_forward(part.dlist.deltas, part.iclist.ictab, part.iclist.nic)
+        energy = vlist_forward(part.iclist.ictab, part.vlist.vtab, part.vlist.nv)
+        return cache['rest'] + energy
+
+    def _get_delta_cache(self, pos0, vtab):
+        '''
+            Return the cache for calc_delta_energy with reference positions
+            pos0 and valence table vtab. The cache is rebuilt if the
+            reference positions or the kinds, parameters or ics of the terms
+            have changed.
+        '''
+        nv = self.vlist.nv
+        keys = ['kind', 'par0', 'par1', 'par2', 'par3', 'par4', 'par5', 'ic0', 'ic1']
+        cache = self._delta_cache
+        if cache is not None and np.array_equal(cache['pos0'], pos0):
+            if all([np.array_equal(cache['vtab'][key], vtab[key][:nv]) for key in keys]):
+                return cache
+        #compute the energy of every term in the reference positions on
+        #private copies of the tables, the state of self is not altered
+        energy, vtab = self._forward(pos0, vtab)
+        cache = {
+            'pos0': pos0.copy(), 'vtab': vtab, 'energy': energy,
+            'indexes': [], 'part': None, 'rest': energy,
+        }
+        self._delta_cache = cache
+        return cache
+
+    def _update_delta_cache(self, cache, indexes):
+        '''
+            Construct a separate ForcePartValence containing only the terms
+            with given indexes (with parameters copied from self.vlist.vtab)
+            and store it in the given cache.
+        '''
+        cache['indexes'] = indexes
+        if len(indexes)==0: return
+        part = ForcePartValence(self.system)
+        for index in indexes:
+            term = self.terms[index]
+            kind = self.vlist.vtab[index]['kind']
+            pot = pot_classes[kind]
+            part.add_term(pot(*self._get_pot_args(kind, term.units, term.ics)))
+        for i in range(6):
+            key = 'par%i' %i
+            part.vlist.vtab[key][:len(indexes)] = cache['vtab'][key][indexes]
+        cache['part'] = part
+        cache['rest'] = cache['energy'] - cache['vtab']['energy'][indexes].sum()
+
     def get_hessian_contrib(self, index, fc=None):
         '''
             Get the contribution to the covalent hessian of term with given
             index (and its slaves). If fc is given, set the fc of the master
-            and its slave to the given fc.
+            and its slave to the given fc. If a `Symmetry` instance is
+            assigned to the symmetry attribute (and the system is still in
+            the geometry for which the symmetry was detected), the hessian
+            is only computed for one term of each orbit of equivalent terms
+            and mapped onto the other terms of the orbit.
         '''
-        val = ForcePartValence(self.system)
         kind = self.vlist.vtab[index]['kind']
         masterslaves = [index]+self.terms[index].slaves
         if kind in [5,6,7,8,9]:#Chebychev
             potentials={5: Chebychev1, 6: Chebychev2, 7: Chebychev3, 8: Chebychev4, 9: Chebychev6}
             k, sign = self.get_params(index, only='all')
             if fc is not None: k = fc
-            for jterm in masterslaves:
-                ics = self.terms[jterm].ics
-                pot = potentials[kind]
-                args = (k,) + tuple(ics)
-                val.add_term(pot(*args,sign=sign))
+            get_pot = lambda ics: potentials[kind](*((k,)+tuple(ics)), sign=sign)
         elif kind==4:#Cosine
             m, k, rv = self.get_params(index)
             if fc is not None: k = fc
-            for jterm in masterslaves:
-                ics = self.terms[jterm].ics
-                args = (m, k, rv) + tuple(ics)
-                val.add_term(Cosine(*args))
+            get_pot = lambda ics: Cosine(*((m, k, rv)+tuple(ics)))
         elif kind==3:#cross
             k, rv0, rv1 = self.get_params(index)
             if fc is not None: k = fc
-            for jterm in masterslaves:
-                ics = self.terms[jterm].ics
-                args = (k, rv0, rv1) + tuple(ics)
-                val.add_term(Cross(*args))
+            get_pot = lambda ics: Cross(*((k, rv0, rv1)+tuple(ics)))
         elif kind==1:#Polyfour
             a0, a1, a2, a3 = list(self.get_params(index))
             if fc is not None:
                 a3 = 2.0*fc
                 a1 = -4.0*fc*np.cos(a0)**2
-            for jterm in masterslaves:
-                ics = self.terms[jterm].ics
-                args = ([0.0,a1,0.0,a3],)+tuple(ics)
-                val.add_term(PolyFour(*args))
+            get_pot = lambda ics: PolyFour(*(([0.0,a1,0.0,a3],)+tuple(ics)))
         elif kind in [0,2,11,12]:#[Harmonic,Fues,MM3Quartic,MM3Bend]
             potentials={0:Harmonic,2:Fues,11:MM3Quartic,12:MM3Bend}
             k, rv = self.get_params(index)
             if fc is not None: k = fc
-            for jterm in masterslaves:
-                ics = self.terms[jterm].ics
-                args = (k, rv) + tuple(ics)
-                val.add_term(potentials[kind](*args))
+            get_pot = lambda ics: potentials[kind](*((k, rv)+tuple(ics)))
         else:
             raise ValueError('Term kind %i not supported' %kind)
+        if self.symmetry is not None and np.allclose(self.system.pos, self.symmetry.pos):
+            return self._get_symmetric_hessian(masterslaves, get_pot)
+        val = ForcePartValence(self.system)
+        for jterm in masterslaves:
+            val.add_term(get_pot(self.terms[jterm].ics))
         ff = ForceField(self.system, [val])
         hcov = estimate_cart_hessian(ff)
         return hcov
 
+    def _get_symmetric_hessian(self, indexes, get_pot):
+        '''
+            Compute the hessian of the terms with given indexes by finite
+            differences on the atoms of one representative term per orbit.
+            The block of a representative is mapped onto an equivalent term
+            as H[p(a),p(b)] = R H_rep[a,b] R^T, with p the atom permutation
+            and R the rotation relating both terms.
+        '''
+        orbits = self.symmetry.get_orbits([self.terms[jterm] for jterm in indexes])
+        natom = self.system.natom
+        hcov = np.zeros([3*natom, 3*natom], float)
+        blocks = {}
+        for jterm in indexes:
+            rep, perm, rot = orbits[jterm]
+            if rep not in blocks:
+                atoms = np.array(self._get_ic_atoms(self.terms[rep].ics))
+                val = ForcePartValence(self.system)
+                val.add_term(get_pot(self.terms[rep].ics))
+                ff = ForceField(self.system, [val])
+                block = estimate_cart_hessian(ff, select=atoms)
+                blocks[rep] = (atoms, block.reshape([len(atoms),3,len(atoms),3]))
+            atoms, block = blocks[rep]
+            if perm is not None:
+                block = np.einsum('ab,ibjc,dc->iajd', rot, block, rot)
+                atoms = perm[atoms]
+            indices = (3*atoms[:,None]+np.arange(3)).ravel()
+            hcov[np.ix_(indices, indices)] += block.reshape([3*len(atoms), 3*len(atoms)])
+        return hcov
+
     def set_params(self, term_index, fc=None, rv0=None, rv1=None, m=None,
-            a0=None, a1=None, a2=None, a3=None, sign=None, ediss=None, exp=None):
-        term = self.vlist.vtab[term_index]
+            a0=None, a1=None, a2=None, a3=None, sign=None, ediss=None, exp=None,
+            vtab=None):
+        '''
+            Set the parameters of the term with given index. If vtab is
+            given (e.g. a private copy returned by get_vtab), the parameters
+            are set in that table instead of in self.vlist.vtab.
+        '''
+        if vtab is None: vtab = self.vlist.vtab
+        term = vtab[term_index]
         if term['kind'] in [0,2,11,12]:#['Harmonic', 'Fues', 'MM3Quartic', 'MM3Bend']
             if fc is not None:  term['par0'] = fc
             if rv0 is not None: term['par1'] = rv0
@@ -1079,8 +1589,8 @@ class ValenceFF(ForcePartValence):
             if a2 is not None: term['par2'] = a2
             if a3 is not None: term['par3'] = a3
             if fc is not None or rv0 is not None:
-                if fc is None:  fc = self.get_params(term_index, only='fc')
-                if rv0 is None: rv0 = self.get_params(term_index, only='rv')
+                if fc is None:  fc = self.get_params(term_index, only='fc', vtab=vtab)
+                if rv0 is None: rv0 = self.get_params(term_index, only='rv', vtab=vtab)
                 term['par0'] = rv0
                 term['par1'] = -4.0*fc*np.cos(rv0)**2
                 term['par2'] = 0.0
@@ -1108,8 +1618,13 @@ class ValenceFF(ForcePartValence):
         else:
             raise NotImplementedError('set_params not implemented for Yaff %s term' %term['kind'])
 
-    def get_params(self, term_index, only='all'):
-        term = self.vlist.vtab[term_index]
+    def get_params(self, term_index, only='all', vtab=None):
+        '''
+            Get the parameters of the term with given index from vtab
+            (defaults to self.vlist.vtab).
+        '''
+        if vtab is None: vtab = self.vlist.vtab
+        term = vtab[term_index]
         if term['kind'] in [0,2,11,12]:#['Harmonic', 'Fues', 'MM3Quartic', 'MM3Bend']
             if only.lower()=='all': return term['par0'], term['par1']
             elif only.lower()=='fc': return term['par0']
@@ -1152,6 +1667,156 @@ class ValenceFF(ForcePartValence):
             raise NotImplementedError(
                 'get_params not implemented for Yaff %s term' % term['kind'])
 
+    #number of parameters returned by get_params(only='all') per term kind
+    npars = {0: 2, 1: 4, 2: 2, 3: 3, 4: 3, 5: 2, 6: 2, 7: 2, 8: 2, 9: 2, 11: 2, 12: 2, 14: 3}
+
+    def set_params_many(self, term_indexes, fc=None, rv0=None, rv1=None,
+            m=None, a0=None, a1=None, a2=None, a3=None, sign=None, ediss=None,
+            exp=None, vtab=None):
+        '''
+            Vectorized version of set_params. The parameters are set for all
+            terms in term_indexes at once, each parameter can be a scalar or
+            an array with a value for every term. Parameters that are not
+            applicable to the kind of a term are ignored, as in set_params.
+        '''
+        if vtab is None: vtab = self.vlist.vtab
+        term_indexes = np.asarray(term_indexes, int).ravel()
+        n = len(term_indexes)
+        if n==0: return
+        values = {}
+        for key, value in [('fc', fc), ('rv0', rv0), ('rv1', rv1), ('m', m),
+                ('a0', a0), ('a1', a1), ('a2', a2), ('a3', a3), ('sign', sign),
+                ('ediss', ediss), ('exp', exp)]:
+            if value is not None:
+                values[key] = np.broadcast_to(np.asarray(value, float), (n,))
+        kinds = vtab['kind'][term_indexes]
+        for kind in np.unique(kinds):
+            mask = kinds==kind
+            rows = term_indexes[mask]
+            pars = dict((key, value[mask]) for key, value in values.items())
+            def assign(field, key):
+                if key in pars: vtab[field][rows] = pars[key]
+            if kind in [0,2,11,12]:#['Harmonic', 'Fues', 'MM3Quartic', 'MM3Bend']
+                assign('par0', 'fc')
+                assign('par1', 'rv0')
+            elif kind in [1]:#['PolyFour']
+                for i in range(4):
+                    assign('par%i' %i, 'a%i' %i)
+                if 'fc' in pars or 'rv0' in pars:
+                    fcs = pars.get('fc', 0.5*vtab['par3'][rows])
+                    rvs = pars.get('rv0', vtab['par0'][rows])
+                    vtab['par0'][rows] = rvs
+                    vtab['par1'][rows] = -4.0*fcs*np.cos(rvs)**2
+                    vtab['par2'][rows] = 0.0
+                    vtab['par3'][rows] = 2.0*fcs
+            elif kind in [4]:#['Cosine']
+                assign('par0', 'm')
+                assign('par1', 'fc')
+                assign('par2', 'rv0')
+            elif kind in [5,6,7,8,9]: #Chebychevs
+                assign('par0', 'fc')
+                assign('par1', 'sign')
+            elif kind in [3]:#['Cross']
+                assign('par0', 'fc')
+                assign('par1', 'rv0')
+                assign('par2', 'rv1')
+            elif kind in [14]: #Morse
+                if 'fc' in pars and 'exp' in pars:
+                    raise IOError('When fc is set in Morse, exp cannot be set, but will be adapted to Ediss and fc')
+                assign('par0', 'ediss')
+                if 'fc' in pars:
+                    vtab['par1'][rows] = np.sqrt(pars['fc']/(2.0*vtab['par0'][rows]))
+                assign('par1', 'exp')
+                assign('par2', 'rv0')
+            else:
+                raise NotImplementedError('set_params not implemented for Yaff %s term' %kind)
+
+    def get_params_many(self, term_indexes, only='all', vtab=None):
+        '''
+            Vectorized version of get_params. Returns an array with the
+            requested parameter for all terms in term_indexes. If only is
+            'all', a two-dimensional array [nterm,npar] is returned, which
+            requires all terms to have the same number of parameters.
+        '''
+        if vtab is None: vtab = self.vlist.vtab
+        term_indexes = np.asarray(term_indexes, int).ravel()
+        kinds = vtab['kind'][term_indexes]
+        only = only.lower()
+        if only=='all':
+            npars = set(self.npars.get(kind) for kind in np.unique(kinds))
+            if None in npars:
+                raise NotImplementedError('get_params not implemented for Yaff terms of kinds %s' %str(np.unique(kinds)))
+            if len(npars)>1:
+                raise ValueError('All terms should have the same number of parameters when only=all')
+            npar = npars.pop() if len(npars)==1 else 0
+            result = np.zeros([len(term_indexes), npar], float)
+            for i in range(npar):
+                result[:,i] = vtab['par%i' %i][term_indexes]
+            return result
+        result = np.zeros(len(term_indexes), float)
+        for kind in np.unique(kinds):
+            mask = kinds==kind
+            rows = vtab[term_indexes[mask]]
+            if kind in [0,2,11,12]:#['Harmonic', 'Fues', 'MM3Quartic', 'MM3Bend']
+                columns = {'fc': rows['par0'], 'rv': rows['par1']}
+            elif kind in [1]:#['PolyFour']
+                columns = {
+                    'a0': rows['par0'], 'a1': rows['par1'], 'a2': rows['par2'],
+                    'a3': rows['par3'], 'fc': 0.5*rows['par3'], 'rv': rows['par0'],
+                }
+            elif kind in [4]:#['Cosine']
+                columns = {'m': rows['par0'], 'fc': rows['par1'], 'rv': rows['par2']}
+            elif kind in [5,6,7,8,9]: #Chebychevs
+                columns = {'fc': rows['par0'], 'sign': rows['par1']}
+            elif kind in [3]:#['Cross']
+                columns = {'fc': rows['par0'], 'rv0': rows['par1'], 'rv1': rows['par2']}
+            elif kind in [14]: #Morse
+                columns = {
+                    'ediss': rows['par0'], 'exp': rows['par1'], 'rv0': rows['par2'],
+                    'fc': 2.0*rows['par0']*rows['par1']**2,
+                }
+            else:
+                raise NotImplementedError('get_params not implemented for Yaff %s term' %kind)
+            if only not in columns:
+                raise ValueError('Invalid par kind definition %s' %only)
+            result[mask] = columns[only]
+        return result
+
+    def broadcast_master_params(self, masters=None, only='all', vtab=None):
+        '''
+            Copy parameters from master terms to all of their slaves.
+
+            **Optional Arguments**
+
+            masters
+                list of master indexes of which the parameters should be
+                copied, defaults to all masters
+
+            only
+                the parameter to copy (see get_params), by default all
+                parameters of the master are copied
+
+            vtab
+                the table in which the parameters are copied, defaults to
+                self.vlist.vtab
+        '''
+        if vtab is None: vtab = self.vlist.vtab
+        table = self.get_term_table()
+        slaves = np.where(table['master']!=table['index'])[0]
+        if masters is not None:
+            selected = np.zeros(len(table), bool)
+            selected[np.asarray(masters, int)] = True
+            slaves = slaves[selected[table['master'][slaves]]]
+        if len(slaves)==0: return
+        sources = table['master'][slaves]
+        if only.lower()=='all':
+            for i in range(6):
+                vtab['par%i' %i][slaves] = vtab['par%i' %i][sources]
+        else:
+            key = {'rv': 'rv0'}.get(only.lower(), only.lower())
+            values = self.get_params_many(sources, only=only, vtab=vtab)
+            self.set_params_many(slaves, vtab=vtab, **{key: values})
+
     def is_negligible(self, term_index):
         """Return True if the given term can be neglected (e.g. in parameter files)."""
         # Note that the units may not be strictly correct: below per angstrom, radian
@@ -1219,3 +1884,293 @@ class ValenceFF(ForcePartValence):
                 for line in sorted(lines):
                     log.dump(line)
                     log.dump('')
+
+
+class ValenceEngine(object):
+    '''
+        Vectorized evaluation of the valence energy (and gradient) for a
+        stack of frames. The relative vectors, internal coordinates and
+        valence terms are taken from the Yaff tables of a `ValenceFF`
+        instance, after which all internal coordinates and term energies of
+        all frames are computed with a few NumPy array operations instead
+        of a call to the Yaff delta, ic and valence lists per frame. The
+        parameters are read from the valence table at every call, hence
+        the engine remains valid as long as no terms are added or modified.
+        The cell images of the relative vectors are fixed to those in the
+        reference geometry, which is valid for frames close to it (such as
+        perturbation trajectories).
+    '''
+    #internal coordinates that can be evaluated by the engine
+    supported_ic_kinds = [0, 1, 2, 3, 4, 5, 10, 11, 12, 13, 14, 15]
+    #multiplicity m of the DihedCos2, DihedCos3, DihedCos4 and DihedCos6
+    #internal coordinates, which are equal to cos(m*phi)
+    dihedcos_multiplicities = {12: 2, 13: 3, 14: 4, 15: 6}
+
+    @classmethod
+    def supports(cls, valence):
+        '''
+            Return True if all internal coordinates of the given `ValenceFF`
+            instance can be evaluated by the engine.
+        '''
+        kinds = valence.iclist.ictab['kind'][:valence.iclist.nic]
+        return set(kinds).issubset(cls.supported_ic_kinds)
+
+    def __init__(self, valence, pos0=None):
+        '''
+            **Arguments**
+
+            valence
+                a `ValenceFF` instance
+
+            **Optional Arguments**
+
+            pos0
+                numpy array [natom,3] with the reference geometry used to fix
+                the cell images, defaults to the positions of the system
+        '''
+        self.valence = valence
+        system = valence.system
+        if pos0 is None: pos0 = system.pos
+        pos0 = np.ascontiguousarray(pos0, dtype=float)
+        self.natom = system.natom
+        ndelta = valence.dlist.ndelta
+        nic = valence.iclist.nic
+        self.nv = valence.vlist.nv
+        #relative vectors with the image shifts of the reference geometry
+        deltas = valence.dlist.deltas.copy()
+        dlist_forward(pos0, system.cell, deltas, ndelta)
+        deltas = deltas[:ndelta]
+        self.atoms_i = deltas['i'].copy()
+        self.atoms_j = deltas['j'].copy()
+        mic = np.array([deltas['dx'], deltas['dy'], deltas['dz']]).T.reshape([ndelta, 3])
+        self.shifts = mic - (pos0[self.atoms_j]-pos0[self.atoms_i])
+        #internal coordinates, unused relative vectors get sign 0
+        ictab = valence.iclist.ictab[:nic]
+        self.ic_kinds = ictab['kind'].copy()
+        unsupported = set(self.ic_kinds) - set(self.supported_ic_kinds)
+        if len(unsupported)>0:
+            raise NotImplementedError('ValenceEngine does not support internal coordinates of kind %s' %str(sorted(unsupported)))
+        self.ic_deltas = np.array([ictab['i%i' %k] for k in range(3)]).T.reshape([nic, 3])
+        self.ic_signs = np.array([ictab['sign%i' %k] for k in range(3)], float).T.reshape([nic, 3])
+        self.ic_signs[self.ic_deltas<0] = 0.0
+        self.ic_deltas[self.ic_deltas<0] = 0
+        #valence terms
+        vtab = valence.vlist.vtab[:self.nv]
+        self.kinds = vtab['kind'].copy()
+        self.ic0 = vtab['ic0'].copy()
+        self.ic1 = np.where(vtab['ic1']>=0, vtab['ic1'], 0)
+
+    def compute(self, coords, vtab=None, do_gradient=False):
+        '''
+            Compute the valence energy of a stack of frames.
+
+            **Arguments**
+
+            coords
+                numpy array [nframe,natom,3] (or [natom,3] for a single frame)
+
+            **Optional Arguments**
+
+            vtab
+                table of valence terms (see ValenceFF.get_vtab) to take the
+                parameters from instead of valence.vlist.vtab
+
+            do_gradient
+                if True, also compute the cartesian gradient
+
+            Returns a tuple (energies, term_energies, gpos) with the energy of
+            each frame [nframe], the energy of each term in each frame
+            [nframe,nv] and the gradient [nframe,natom,3] (None if
+            do_gradient is False). For a single frame, the leading dimension
+            is dropped.
+        '''
+        coords = np.asarray(coords, dtype=float)
+        single = coords.ndim==2
+        if single: coords = coords.reshape((1,)+coords.shape)
+        if vtab is None: vtab = self.valence.vlist.vtab
+        vtab = vtab[:self.nv]
+        deltas = coords[:,self.atoms_j,:] - coords[:,self.atoms_i,:] + self.shifts
+        qs, dqs = self._compute_ics(deltas, do_gradient)
+        q0 = qs[:,self.ic0]
+        q1 = qs[:,self.ic1]
+        energies, de0, de1 = self._compute_terms(vtab, q0, q1, do_gradient)
+        gpos = None
+        if do_gradient:
+            #derivative of the energy towards the internal coordinates
+            gic = np.zeros(qs.shape, float)
+            np.add.at(gic, (slice(None), self.ic0), de0)
+            np.add.at(gic, (slice(None), self.ic1), de1)
+            #derivative towards the relative vectors and the positions
+            gdeltas = np.zeros(deltas.shape, float)
+            for k in range(3):
+                contrib = gic[:,:,None]*dqs[:,:,k,:]*self.ic_signs[None,:,k,None]
+                np.add.at(gdeltas, (slice(None), self.ic_deltas[:,k]), contrib)
+            gpos = np.zeros(coords.shape, float)
+            np.add.at(gpos, (slice(None), self.atoms_j), gdeltas)
+            np.add.at(gpos, (slice(None), self.atoms_i), -gdeltas)
+        total = energies.sum(axis=1)
+        if single:
+            total, energies = total[0], energies[0]
+            if gpos is not None: gpos = gpos[0]
+        return total, energies, gpos
+
+    def _compute_ics(self, deltas, do_gradient):
+        '''
+            Compute the values [nframe,nic] of all internal coordinates and,
+            if required, their derivatives [nframe,nic,3,3] towards the
+            (signed) relative vectors.
+        '''
+        nframe = deltas.shape[0]
+        nic = len(self.ic_kinds)
+        qs = np.zeros([nframe, nic], float)
+        dqs = None
+        if do_gradient: dqs = np.zeros([nframe, nic, 3, 3], float)
+        def get(indexes, k):
+            return self.ic_signs[indexes,k][None,:,None]*deltas[:,self.ic_deltas[indexes,k],:]
+        dot = lambda x, y: (x*y).sum(axis=-1)
+        norm = lambda x: np.sqrt(dot(x, x))
+        #bonds and Urey-Bradley
+        indexes = np.where((self.ic_kinds==0) | (self.ic_kinds==5))[0]
+        if len(indexes)>0:
+            d0 = get(indexes, 0)
+            r = norm(d0)
+            qs[:,indexes] = r
+            if do_gradient: dqs[:,indexes,0,:] = d0/r[:,:,None]
+        #bend cosines and angles
+        indexes = np.where((self.ic_kinds==1) | (self.ic_kinds==2))[0]
+        if len(indexes)>0:
+            d0, d1 = get(indexes, 0), get(indexes, 1)
+            n0, n1 = norm(d0), norm(d1)
+            c = dot(d0, d1)/(n0*n1)
+            isangle = self.ic_kinds[indexes]==2
+            qs[:,indexes] = np.where(isangle, np.arccos(np.clip(c, -1.0, 1.0)), c)
+            if do_gradient:
+                fac = np.where(isangle, self._dacos(c), 1.0)[:,:,None]
+                dqs[:,indexes,0,:] = fac*(d1/(n0*n1)[:,:,None] - (c/n0**2)[:,:,None]*d0)
+                dqs[:,indexes,1,:] = fac*(d0/(n0*n1)[:,:,None] - (c/n1**2)[:,:,None]*d1)
+        #dihedral cosines, angles and cosines of multiples of the angle
+        indexes = np.where(np.isin(self.ic_kinds, [3, 4]+list(self.dihedcos_multiplicities.keys())))[0]
+        if len(indexes)>0:
+            d0, d1, d2 = get(indexes, 0), get(indexes, 1), get(indexes, 2)
+            n1 = norm(d1)
+            e = d1/n1[:,:,None]
+            p0, p2 = dot(d0, e), dot(d2, e)
+            a = d0 - p0[:,:,None]*e
+            b = d2 - p2[:,:,None]*e
+            na, nb = norm(a), norm(b)
+            c = dot(a, b)/(na*nb)
+            kinds = self.ic_kinds[indexes]
+            isangle = kinds==4
+            q = np.where(isangle, np.arccos(np.clip(c, -1.0, 1.0)), c)
+            if do_gradient:
+                fac = np.where(isangle, self._dacos(c), 1.0)
+            #cos(m*phi) is the Chebychev polynomial T_m of cos(phi)
+            for kind, m in self.dihedcos_multiplicities.items():
+                mask = kinds==kind
+                if not mask.any(): continue
+                cheb = np.polynomial.Chebyshev.basis(m)
+                q[:,mask] = cheb(c[:,mask])
+                if do_gradient: fac[:,mask] = cheb.deriv()(c[:,mask])
+            qs[:,indexes] = q
+            if do_gradient:
+                fac = fac[:,:,None]
+                ga = (b/nb[:,:,None] - (c/na)[:,:,None]*a)/na[:,:,None]
+                gb = (a/na[:,:,None] - (c/nb)[:,:,None]*b)/nb[:,:,None]
+                pga = ga - dot(ga, e)[:,:,None]*e
+                pgb = gb - dot(gb, e)[:,:,None]*e
+                dqs[:,indexes,0,:] = fac*pga
+                dqs[:,indexes,2,:] = fac*pgb
+                dqs[:,indexes,1,:] = -fac*(
+                    dot(ga, e)[:,:,None]*a + p0[:,:,None]*pga
+                    + dot(gb, e)[:,:,None]*b + p2[:,:,None]*pgb
+                )/n1[:,:,None]
+        #out-of-plane distances and their squares
+        indexes = np.where((self.ic_kinds==10) | (self.ic_kinds==11))[0]
+        if len(indexes)>0:
+            d0, d1, d2 = get(indexes, 0), get(indexes, 1), get(indexes, 2)
+            n = np.cross(d0, d1)
+            nn = norm(n)
+            o = dot(n, d2)/nn
+            issquare = self.ic_kinds[indexes]==11
+            qs[:,indexes] = np.where(issquare, o**2, o)
+            if do_gradient:
+                fac = np.where(issquare, 2.0*o, 1.0)[:,:,None]
+                gn = d2/nn[:,:,None] - (o/nn**2)[:,:,None]*n
+                dqs[:,indexes,0,:] = fac*np.cross(d1, gn)
+                dqs[:,indexes,1,:] = fac*np.cross(gn, d0)
+                dqs[:,indexes,2,:] = fac*n/nn[:,:,None]
+        return qs, dqs
+
+    @staticmethod
+    def _dacos(c):
+        'Derivative of arccos(c), set to zero where c equals +-1'
+        s = np.sqrt(np.clip(1.0-c**2, 0.0, None))
+        return -1.0/np.where(s>0.0, s, np.inf)
+
+    def _compute_terms(self, vtab, q0, q1, do_gradient):
+        '''
+            Compute the energy [nframe,nv] of all terms and, if required,
+            the derivatives towards their first and second internal
+            coordinate.
+        '''
+        energies = np.zeros(q0.shape, float)
+        de0 = np.zeros(q0.shape, float)
+        de1 = np.zeros(q0.shape, float)
+        pars = [vtab['par%i' %i][None,:] for i in range(6)]
+        for kind in np.unique(self.kinds):
+            m = np.where(self.kinds==kind)[0]
+            p0, p1, p2, p3, p4, p5 = [par[:,m] for par in pars]
+            q, r = q0[:,m], q1[:,m]
+            if kind==0:#Harmonic
+                x = q-p1
+                e, g = 0.5*p0*x**2, p0*x
+            elif kind==1:#PolyFour
+                e = p0*q + p1*q**2 + p2*q**3 + p3*q**4
+                g = p0 + 2.0*p1*q + 3.0*p2*q**2 + 4.0*p3*q**3
+            elif kind==2:#Fues
+                x = p1/q
+                e, g = 0.5*p0*p1**2*(1.0+x*(x-2.0)), p0*p1*(x**2-x**3)
+            elif kind==3:#Cross
+                e = p0*(q-p1)*(r-p2)
+                g = p0*(r-p2)
+                de1[:,m] = p0*(q-p1)
+            elif kind==4:#Cosine
+                e = 0.5*p1*(1.0-np.cos(p0*(q-p2)))
+                g = 0.5*p1*p0*np.sin(p0*(q-p2))
+            elif kind==5:#Chebychev1
+                e, g = 0.5*p0*(1.0+p1*q), 0.5*p0*p1*np.ones(q.shape)
+            elif kind==6:#Chebychev2
+                e, g = 0.5*p0*(1.0+p1*(2.0*q**2-1.0)), 2.0*p0*p1*q
+            elif kind==7:#Chebychev3
+                e, g = 0.5*p0*(1.0+p1*q*(4.0*q**2-3.0)), 1.5*p0*p1*(4.0*q**2-1.0)
+            elif kind==8:#Chebychev4
+                c = q**2
+                e, g = 0.5*p0*(1.0+p1*(8.0*c**2-8.0*c+1.0)), 8.0*p0*p1*q*(2.0*c-1.0)
+            elif kind==9:#Chebychev6
+                c = q**2
+                e = 0.5*p0*(1.0+p1*(32.0*c**3-48.0*c**2+18.0*c-1.0))
+                g = 6.0*p0*p1*q*(16.0*c**2-16.0*c+3.0)
+            elif kind==10:#PolySix
+                e = p0*q + p1*q**2 + p2*q**3 + p3*q**4 + p4*q**5 + p5*q**6
+                g = p0 + 2.0*p1*q + 3.0*p2*q**2 + 4.0*p3*q**3 + 5.0*p4*q**4 + 6.0*p5*q**5
+            elif kind==11:#MM3Quartic
+                x = q-p1
+                e = 0.5*p0*x**2*(1.0-1.349402*x+1.062183*x**2)
+                g = p0*(x-2.024103*x**2+2.124366*x**3)
+            elif kind==12:#MM3Bend
+                x = q-p1
+                e = 0.5*p0*x**2*(1.0-0.802141*x+0.183837*x**2-0.131664*x**3+0.237090*x**4)
+                g = p0*(x-1.203211*x**2+0.367674*x**3-0.329159*x**4+0.711270*x**5)
+            elif kind==13:#BondDoubleWell
+                K = p0/(p1-p2)**4
+                x, z = q-p1, q-p2
+                e, g = 0.5*K*x**2*z**4, 0.5*K*(2.0*x*z**4+4.0*x**2*z**3)
+            elif kind==14:#Morse
+                a = p1*(q-p2)
+                e = p0*(np.exp(-2.0*a)-2.0*np.exp(-a))
+                g = -2.0*p1*p0*(np.exp(-2.0*a)-np.exp(-a))
+            else:
+                raise NotImplementedError('ValenceEngine does not support valence terms of kind %i' %kind)
+            energies[:,m] = e
+            if do_gradient: de0[:,m] = g
+        return energies, de0, de1